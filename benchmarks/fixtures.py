@@ -0,0 +1,115 @@
+"""
+Fixed inputs for the benchmarks. Everything is made up
+deterministically (the consensus and events come from a
+:class:`txtorcon.faketor.FakeTor` with a fixed seed) so results from
+different runs and releases are comparable.
+"""
+
+from zope.interface import implements
+from twisted.internet import defer, task
+
+from txtorcon import ITorControlProtocol
+from txtorcon.faketor import FakeTor
+
+## (name, type) for config/names; roughly the mix a real Tor has
+CONFIG_TYPES = [('Boolean', '0'), ('Boolean+Auto', 'auto'), ('Integer', '42'),
+                ('Port', '9050'), ('TimeInterval', '3600'), ('DataSize', '1048576'),
+                ('Float', '0.5'), ('CommaList', 'a,b,c'), ('String', 'foo'),
+                ('LineList', '127.0.0.1:9050'), ('Filename', '/tmp/foo'),
+                ('RouterList', '$0123456789ABCDEF0123456789ABCDEF01234567')]
+
+ADDRMAP_EXPIRY = '"2037-01-01 00:00:00" EXPIRES="2037-01-01 00:00:00"'
+
+
+class StubProtocol(object):
+    """
+    Answers GETINFO and GETCONF immediately, so the benchmarks time
+    txtorcon's parsing rather than a connection.
+    """
+
+    implements(ITorControlProtocol)
+
+    post_bootstrap = None
+
+    def __init__(self, info=None, conf=None):
+        self.info = info or {}
+        self.conf = conf or {}
+
+    def get_info_raw(self, key):
+        return defer.succeed(self.info.get(key, '%s=\nOK' % key))
+
+    def get_conf(self, key):
+        return defer.succeed({key: self.conf.get(key, '')})
+
+    def get_conf_raw(self, key):
+        return defer.succeed('%s=%s' % (key, self.conf.get(key, '')))
+
+    def add_event_listener(self, *args, **kwargs):
+        pass
+
+
+def fake_tor(routers):
+    return FakeTor(routers=routers, circuits=10, seed=0, clock=task.Clock())
+
+
+def consensus(routers):
+    "ns/all (as one string, lines separated by newlines)"
+    return '\n'.join(fake_tor(routers).ns_all())
+
+
+def events(tor, source, count):
+    "the first ``count`` event texts from one of FakeTor's lifecycles"
+    out = []
+    while len(out) < count:
+        out.extend(source())
+    return out[:count]
+
+
+def circ_events(tor, count):
+    return events(tor, tor._circuit_lifecycle, count)
+
+
+def stream_events(tor, count):
+    return events(tor, tor._stream_lifecycle, count)
+
+
+def addrmap_events(count):
+    return ['host%d.example.com 10.%d.%d.%d %s' % (i, i >> 16 & 255, i >> 8 & 255, i & 255, ADDRMAP_EXPIRY)
+            for i in range(count)]
+
+
+def keyword_lines(count):
+    "GETINFO-style reply text with ``count`` key=value lines"
+    return '\n'.join('key/number%d=value %d with some spaces' % (i, i) for i in range(count)) + '\nOK'
+
+
+def keyword_args(count):
+    "split event arguments with ``count`` KEY=value pairs"
+    return ['123', 'BUILT', '$0123456789ABCDEF0123456789ABCDEF01234567~foo'] + \
+        ['KEY%d=value%d' % (i, i) for i in range(count)]
+
+
+def config_protocol(count):
+    "a StubProtocol with ``count`` config options"
+    names = []
+    conf = {}
+    for i in range(count):
+        (kind, value) = CONFIG_TYPES[i % len(CONFIG_TYPES)]
+        name = 'Option%d' % i
+        names.append('%s %s' % (name, kind))
+        conf[name] = value
+    return StubProtocol(info={'config/names': 'config/names=\n' + '\n'.join(names) + '\nOK'},
+                        conf=conf)
+
+
+def info_protocol(count):
+    "a StubProtocol with ``count`` info/names entries, some nested"
+    names = []
+    for i in range(count):
+        if i % 3 == 0:
+            names.append('dir%d/leaf%d Something about leaf %d' % (i % 7, i, i))
+        elif i % 3 == 1:
+            names.append('dir%d/sub%d/* Takes an argument' % (i % 5, i))
+        else:
+            names.append('key%d Something about key %d' % (i, i))
+    return StubProtocol(info={'info/names': 'info/names=\n' + '\n'.join(names) + '\nOK'})
@@ -0,0 +1,244 @@
+"""
+Times txtorcon's hot paths and writes the results as JSON::
+
+    make bench
+    PYTHONPATH=. python benchmarks/run.py --output results.json parse_keywords circuit
+
+Each benchmark is run ``--repeat`` times; the JSON has the best,
+median and mean seconds per repeat and the best per-item time (items
+being lines, events, options... see each benchmark's ``items``), so
+results from different releases can be compared directly.
+"""
+
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import timeit
+
+from twisted.test import iosim
+
+import txtorcon
+from txtorcon import TorState, TorConfig, TorInfo, TorControlProtocol
+from txtorcon.addrmap import AddrMap
+from txtorcon.torcontrolprotocol import parse_keywords
+from txtorcon.util import find_keywords
+
+import fixtures
+
+benchmarks = []
+
+
+def benchmark(items):
+    """
+    Decorator for a benchmark: a function taking the options and
+    returning a no-argument callable to time. ``items`` is how many
+    things (lines, events...) one call handles, given the options.
+    """
+
+    def decorate(setup):
+        setup.items = items
+        benchmarks.append(setup)
+        return setup
+    return decorate
+
+
+@benchmark(lambda options: 1000)
+def parse_keywords_lines(options):
+    data = fixtures.keyword_lines(1000)
+    return lambda: parse_keywords(data)
+
+
+@benchmark(lambda options: options.routers * 4)
+def parse_keywords_multiline(options):
+    data = 'ns/all=' + fixtures.consensus(options.routers).replace('=', ':') + '\nOK'
+    return lambda: parse_keywords(data)
+
+
+@benchmark(lambda options: 1000)
+def find_keywords_args(options):
+    args = fixtures.keyword_args(1000)
+    return lambda: find_keywords(args)
+
+
+@benchmark(lambda options: options.routers)
+def network_status(options):
+    data = fixtures.consensus(options.routers)
+
+    def run():
+        state = TorState(fixtures.StubProtocol(), bootstrap=False)
+        state._update_network_status(data)
+    return run
+
+
+def _state_with_routers(options):
+    tor = fixtures.fake_tor(options.routers)
+    state = TorState(fixtures.StubProtocol(), bootstrap=False)
+    state._update_network_status('\n'.join(tor.ns_all()))
+    return (tor, state)
+
+
+@benchmark(lambda options: options.events)
+def circuit_update(options):
+    (tor, state) = _state_with_routers(options)
+    events = fixtures.circ_events(tor, options.events)
+
+    def run():
+        state.circuits = {}
+        for event in events:
+            state._circuit_update(event)
+    return run
+
+
+@benchmark(lambda options: options.events)
+def stream_update(options):
+    (tor, state) = _state_with_routers(options)
+    for line in tor._circuit_status().split('\n'):
+        state._circuit_update(line)
+    events = fixtures.stream_events(tor, options.events)
+
+    def run():
+        state.streams = {}
+        for event in events:
+            state._stream_update(event)
+    return run
+
+
+@benchmark(lambda options: options.events)
+def addrmap_update(options):
+    events = fixtures.addrmap_events(options.events)
+
+    def run():
+        ## the expiries are decades away, so the reactor's delayed
+        ## calls never run (task.Clock would make this quadratic)
+        addrmap = AddrMap()
+        for event in events:
+            addrmap.update(event)
+    return run
+
+
+@benchmark(lambda options: 300)
+def torconfig_setup(options):
+    protocol = fixtures.config_protocol(300)
+
+    def run():
+        config = TorConfig(protocol)
+        if len(config.config) < 300:
+            raise RuntimeError("setup didn't finish")
+    return run
+
+
+@benchmark(lambda options: 300)
+def torinfo_setup(options):
+    protocol = fixtures.info_protocol(300)
+    return lambda: TorInfo(protocol)
+
+
+@benchmark(lambda options: options.routers)
+def router_scan(options):
+    "fast, stable exits allowing port 443, by looping over the routers"
+    (tor, state) = _state_with_routers(options)
+    routers = [r for (k, r) in state.routers.items() if k.startswith('$')]
+    wanted = ['fast', 'stable', 'exit']
+    return lambda: [r for r in routers if all(f in r.flags for f in wanted) and r.accepts_port(443)]
+
+
+@benchmark(lambda options: options.routers)
+def router_table_select(options):
+    "router_scan, with TorState.router_table (built once, untimed)"
+    (tor, state) = _state_with_routers(options)
+    table = state.router_table
+    return lambda: table.select(flags=['fast', 'stable', 'exit'], port=443)
+
+
+def _bootstrap(options, **kwargs):
+    tor = fixtures.fake_tor(options.routers)
+    tor.password = 'foo'
+    tor.ns_all()
+
+    def run():
+        client = TorControlProtocol(password_function=lambda: 'foo')
+        state = TorState(client, **kwargs)
+        server = tor.factory().buildProtocol(None)
+        pump = iosim.connect(server, iosim.FakeTransport(server, True),
+                             client, iosim.FakeTransport(client, False))
+        pump.flush()
+        if not state.post_bootstrap.called:
+            raise RuntimeError("bootstrap didn't finish")
+    return run
+
+
+@benchmark(lambda options: options.routers)
+def bootstrap(options):
+    """
+    A whole TorControlProtocol and TorState bootstrap against a
+    FakeTor, over an in-memory connection.
+    """
+
+    return _bootstrap(options)
+
+
+@benchmark(lambda options: options.routers)
+def bootstrap_lazy(options):
+    "bootstrap, with lazy_routers (so, without the consensus)"
+
+    return _bootstrap(options, lazy_routers=True)
+
+
+def run_benchmark(bench, options):
+    fn = bench(options)
+    fn()                                # warm up (and check it works)
+    times = timeit.repeat(fn, repeat=options.repeat, number=1)
+    times.sort()
+    items = bench.items(options)
+    return dict(best=times[0],
+                median=times[len(times) // 2],
+                mean=sum(times) / len(times),
+                repeat=options.repeat,
+                items=items,
+                best_per_item=times[0] / items)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark txtorcon's hot paths.")
+    parser.add_argument('--routers', type=int, default=10000,
+                        help='size of the consensus (default 10000)')
+    parser.add_argument('--events', type=int, default=10000,
+                        help='events per event benchmark (default 10000)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=None, help='write JSON here (default: stdout)')
+    parser.add_argument('names', nargs='*',
+                        help='run only benchmarks whose names contain one of these')
+    options = parser.parse_args(argv)
+
+    results = {}
+    for bench in benchmarks:
+        name = bench.__name__
+        if options.names and not any(n in name for n in options.names):
+            continue
+        gc.collect()
+        results[name] = run_benchmark(bench, options)
+        sys.stderr.write('%-24s best %.4fs (%.2fus per item)\n' % (name, results[name]['best'],
+                                                                   results[name]['best_per_item'] * 1e6))
+
+    report = dict(txtorcon=txtorcon.__version__,
+                  python=platform.python_version(),
+                  implementation=platform.python_implementation(),
+                  platform=platform.platform(),
+                  time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                  routers=options.routers,
+                  events=options.events,
+                  benchmarks=results)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -60,7 +60,7 @@ class MyAttacher(txtorcon.CircuitListenerMixin):
         self.waiting_circuits = []
 
     def waiting_on(self, circuit):
-        for (circid, d, stream_cc) in self.waiting_circuits:
+        for (circid, d, target) in self.waiting_circuits:
             if circuit.id == circid:
                 return True
         return False
@@ -83,25 +83,25 @@ class MyAttacher(txtorcon.CircuitListenerMixin):
         print "circuit built", circuit.id, '->'.join(map(lambda r:
                                                          r.location.countrycode,
                                                          circuit.path))
-        for (circid, d, stream_cc) in self.waiting_circuits:
+        for (circid, d, target) in self.waiting_circuits:
             if circid == circuit.id:
-                self.waiting_circuits.remove((circid, d, stream_cc))
+                self.waiting_circuits.remove((circid, d, target))
                 d.callback(circuit)
 
     def circuit_failed(self, circuit, kw):
         if self.waiting_on(circuit):
             print "A circuit we requested", circuit.id, "has failed. Reason:", kw['REASON']
 
-            circid, d, stream_cc = None, None, None
+            circid, d, target = None, None, None
             for x in self.waiting_circuits:
                 if x[0] == circuit.id:
-                    circid, d, stream_cc = x
+                    circid, d, target = x
             if d is None:
                 raise Exception("Expected to find circuit.")
 
-            self.waiting_circuits.remove((circid, d, stream_cc))
+            self.waiting_circuits.remove((circid, d, target))
             print "Trying a new circuit build for", circid
-            self.request_circuit_build(stream_cc, d)
+            self.request_circuit_build(target, d)
 
     def attach_stream(self, stream, circuits):
         """
@@ -136,7 +136,10 @@ class MyAttacher(txtorcon.CircuitListenerMixin):
 
         ## if we get here, we haven't found a circuit that exits in
         ## the country GeoIP claims our target server is in, so we
-        ## need to build one.
+        ## need to build one (if there are any exits there).
+        if not self.state.router_table.select(flags=['exit'], country=stream_cc, port=stream.target_port):
+            print "   no exits in", stream_cc, "for port", stream.target_port, "so Tor will assign stream"
+            return None
         print "Didn't find a circuit, building one"
 
         ## we need to return a Deferred which will callback with our
@@ -147,14 +150,16 @@ class MyAttacher(txtorcon.CircuitListenerMixin):
         ## when the circuit_built() listener callback happens.
 
         d = defer.Deferred()
-        self.request_circuit_build(stream_cc, d)
+        self.request_circuit_build((stream_cc, stream.target_port), d)
         return d
 
-    def request_circuit_build(self, stream_cc, deferred_to_callback):
-        ## for exits, we can select from any router that's in the
-        ## correct country.
-        last = filter(lambda x: x.location.countrycode == stream_cc,
-                      self.state.routers.values())
+    def request_circuit_build(self, target, deferred_to_callback):
+        ## for exits, we can select from any exit that's in the
+        ## correct country and allows the stream's port. The
+        ## router_table answers this from its columns rather than
+        ## looking at every Router.
+        (stream_cc, port) = target
+        last = self.state.router_table.select(flags=['exit'], country=stream_cc, port=port)
 
         ## start with an entry guard, put anything in the middle and
         ## put one of our exits at the end.
@@ -167,10 +172,10 @@ class MyAttacher(txtorcon.CircuitListenerMixin):
                                                        path))
 
         class AppendWaiting:
-            def __init__(self, attacher, d, stream_cc):
+            def __init__(self, attacher, d, target):
                 self.attacher = attacher
                 self.d = d
-                self.stream_cc = stream_cc
+                self.target = target
 
             def __call__(self, circ):
                 """
@@ -181,14 +186,21 @@ class MyAttacher(txtorcon.CircuitListenerMixin):
                 """
                 print "  my circuit is in progress", circ.id
                 self.attacher.waiting_circuits.append((circ.id, self.d,
-                                                       self.stream_cc))
+                                                       self.target))
 
-        return self.state.build_circuit(path).addCallback(AppendWaiting(self, deferred_to_callback, stream_cc)).addErrback(log.err)
+        return self.state.build_circuit(path).addCallback(AppendWaiting(self, deferred_to_callback, target)).addErrback(log.err)
 
 
 def do_setup(state):
     print "Connected to a Tor version", state.protocol.version
 
+    ## the router_table needs every router's country; look them all
+    ## up now, on a worker thread, rather than when the first stream arrives
+    return txtorcon.router.resolve_locations(state.routers.values()).addCallback(lambda _: state)
+
+
+def do_attach(state):
+
     attacher = MyAttacher(state)
     state.set_attacher(attacher, reactor)
     state.add_circuit_listener(attacher)
@@ -212,5 +224,5 @@ def setup_failed(arg):
     reactor.stop()
 
 d = txtorcon.build_local_tor_connection(reactor)
-d.addCallback(do_setup).addErrback(setup_failed)
+d.addCallback(do_setup).addCallback(do_attach).addErrback(setup_failed)
 reactor.run()
@@ -9,9 +9,11 @@ __copyright__ = 'Copyright 2012'
 
 
 from txtorcon.router import Router
+from txtorcon.routertable import RouterTable
 from txtorcon.circuit import Circuit
 from txtorcon.stream import Stream
 from txtorcon.torcontrolprotocol import TorControlProtocol, TorProtocolError, TorProtocolFactory, DEFAULT_VALUE
+from txtorcon.torcontrolprotocol import PRIORITY_CRITICAL, PRIORITY_NORMAL, PRIORITY_BULK
 from txtorcon.torstate import TorState, build_tor_connection, build_local_tor_connection
 from txtorcon.torconfig import TorConfig, HiddenService, TorProcessProtocol, TCPHiddenServiceEndpoint, launch_tor
 from txtorcon.torinfo import TorInfo
@@ -20,11 +22,12 @@ import util
 import interface
 from txtorcon.interface import *
 
-__all__ = ["Router",
+__all__ = ["Router", "RouterTable",
            "Circuit",
            "Stream",
            "TorControlProtocol", "TorProtocolError", "TorProtocolFactory",
            "TorState", "DEFAULT_VALUE",
+           "PRIORITY_CRITICAL", "PRIORITY_NORMAL", "PRIORITY_BULK",
            "TorInfo",
            "build_tor_connection", "build_local_tor_connection", "launch_tor",
            "TorConfig", "HiddenService", "TorProcessProtocol",
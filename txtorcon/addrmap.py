@@ -1,11 +1,11 @@
 from txtorcon.interface import IAddrListener
-from txtorcon.util import maybe_ip_addr
+from txtorcon.util import maybe_ip_addr, split_args
+from txtorcon.events import AddrMapEvent
 
 from twisted.internet.interfaces import IReactorTime
 from twisted.internet import reactor
 
 import datetime
-import shlex
 
 
 class Addr(object):
@@ -94,9 +94,15 @@ class AddrMap(object):
         """
         Deal with an update from Tor; either creates a new Addr object
         or find existing one and calls update() on it.
+
+        :param update: a :class:`txtorcon.events.AddrMapEvent` or the
+            text of one.
         """
 
-        params = shlex.split(update)
+        if isinstance(update, AddrMapEvent):
+            params = update.args
+        else:
+            params = split_args(update)
         if params[0] in self.addr:
             self.addr[params[0]].update(*params)
 
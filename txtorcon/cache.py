@@ -0,0 +1,154 @@
+"""
+A cache for GETINFO and GETCONF replies; see
+:meth:`txtorcon.TorControlProtocol.enable_cache`.
+"""
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+
+class ResponseCache(object):
+    """
+    Caches the raw replies to GETINFO and GETCONF commands, and shares
+    a single command (and its reply) between identical requests while
+    it's in flight.
+
+    How long a reply is kept depends on the keys asked for (see
+    :attr:`ttls`); a request for several keys is kept for the shortest
+    of their times. Replies are also thrown out when Tor tells us
+    they've changed: :meth:`conf_changed` (the CONF_CHANGED event, or
+    our own SETCONF) and :meth:`new_consensus` (NEWCONSENSUS).
+    """
+
+    ttls = [
+        ## effectively static for the lifetime of a connection
+        ('version', None),
+        ('config/names', None),
+        ('config/defaults', None),
+        ('info/names', None),
+        ('events/names', None),
+        ('features/names', None),
+        ('signal/names', None),
+        ('exit-policy/default', None),
+        ('process/', None),
+
+        ## changes all the time: never stored (but concurrent requests
+        ## still share one command)
+        ('traffic/', 0),
+        ('circuit-status', 0),
+        ('stream-status', 0),
+        ('orconn-status', 0),
+        ('entry-guards', 0),
+        ('address-mappings/', 0),
+        ('accounting/', 0),
+        ('status/', 0),
+        ('uptime', 0),
+    ]
+    """(key prefix, seconds) pairs; the first matching prefix wins. None
+    means "until invalidated" and 0 means "don't cache"."""
+
+    default_ttl = 60.0
+    """Seconds to keep replies for keys not in :attr:`ttls` (and all
+    GETCONF replies)."""
+
+    config_prefixes = ('config', 'net/listeners/')
+    """GETINFO keys thrown out on CONF_CHANGED, along with all GETCONF
+    replies"""
+
+    consensus_prefixes = ('ns/', 'network-status', 'desc/', 'md/', 'dir/')
+    """GETINFO keys thrown out on NEWCONSENSUS"""
+
+    def __init__(self, scheduler):
+        """
+        :param scheduler: an IReactorTime provider, for the current
+            time.
+        """
+        self.scheduler = scheduler
+        self.entries = {}               # (verb, keys) -> (reply, expiry time or None)
+        self.hits = 0
+        self.misses = 0
+        self._waiting = {}              # (verb, keys) -> Deferreds waiting on the in-flight command
+        self._generation = 0            # bumped on every invalidation
+
+    def ttl(self, verb, keys):
+        """
+        :return: how long (in seconds) to keep a reply to ``verb`` for
+            these keys, or None to keep it until invalidated.
+        """
+
+        if verb != 'GETINFO':
+            return self.default_ttl
+        rtn = None
+        for key in keys:
+            for (prefix, ttl) in self.ttls:
+                if key.startswith(prefix):
+                    break
+            else:
+                ttl = self.default_ttl
+            if ttl is not None and (rtn is None or ttl < rtn):
+                rtn = ttl
+        return rtn
+
+    def fetch(self, verb, keys, issue):
+        """
+        :param issue: a zero-argument callable which sends the command
+            and returns its Deferred; only called if there's no usable
+            cached reply and no identical command in flight.
+
+        :return: a Deferred which fires with the raw reply.
+        """
+
+        key = (verb, ' '.join(keys))
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[1] is None or entry[1] > self.scheduler.seconds():
+                self.hits += 1
+                return defer.succeed(entry[0])
+            del self.entries[key]
+
+        self.misses += 1
+        d = defer.Deferred()
+        if key in self._waiting:
+            self._waiting[key].append(d)
+            return d
+
+        self._waiting[key] = [d]
+        issue().addBoth(self._answer, key, keys, self._generation)
+        return d
+
+    def _answer(self, reply, key, keys, generation):
+        "callback/errback for a command issued by fetch"
+
+        waiting = self._waiting.pop(key)
+        if isinstance(reply, Failure):
+            for d in waiting:
+                d.errback(reply)
+            return None
+
+        ttl = self.ttl(key[0], keys)
+        if generation == self._generation and ttl != 0:
+            if ttl is not None:
+                ttl = self.scheduler.seconds() + ttl
+            self.entries[key] = (reply, ttl)
+        for d in waiting:
+            d.callback(reply)
+        return None
+
+    def _invalidate(self, verbs, prefixes):
+        self._generation += 1
+        for (verb, keys) in self.entries.keys():
+            if verb in verbs or any(k.startswith(prefixes) for k in keys.split()):
+                del self.entries[(verb, keys)]
+
+    def conf_changed(self, data=None):
+        "Listener for CONF_CHANGED events; also called after our own SETCONF."
+        self._invalidate(('GETCONF',), self.config_prefixes)
+
+    def new_consensus(self, data=None):
+        "Listener for NEWCONSENSUS events."
+        self._invalidate((), self.consensus_prefixes)
+
+    def clear(self):
+        "Forget everything (e.g. we've connected to a different Tor)."
+        self._generation += 1
+        self.entries = {}
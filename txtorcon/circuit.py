@@ -1,7 +1,7 @@
 from twisted.python import log
 from interface import IRouterContainer
 
-from txtorcon.util import find_keywords
+from txtorcon.events import CircEvent
 
 
 class Circuit(object):
@@ -76,38 +76,38 @@ class Circuit(object):
     def unlisten(self, listener):
         self.listeners.remove(listener)
 
-    def _create_flags(self, kw):
-        "this clones the kw dict, adding a lower-case version of every key (duplicated in stream.py; put in util?)"
-
-        flags = {}
-        for k in kw.keys():
-            flags[k] = kw[k]
-            flags[k.lower()] = kw[k]
-        return flags
-
     def update(self, args):
+        """
+        :param args: a :class:`txtorcon.events.CircEvent`, or the
+            already-split arguments of a CIRC event.
+        """
         ##print "Circuit.update:",args
+        if isinstance(args, CircEvent):
+            event = args
+        else:
+            event = CircEvent(args=args)
+
         if self.id is None:
-            self.id = int(args[0])
+            self.id = event.id
             [x.circuit_new(self) for x in self.listeners]
 
         else:
-            if int(args[0]) != self.id:
+            if event.id != self.id:
                 raise RuntimeError("Update for wrong circuit.")
-        self.state = args[1]
+        self.state = event.state
 
-        kw = find_keywords(args)
+        kw = event.keywords
         if 'PURPOSE' in kw:
             self.purpose = kw['PURPOSE']
         if 'BUILD_FLAGS' in kw:
-            self.build_flags = kw['BUILD_FLAGS'].split(',')
+            self.build_flags = event.build_flags
 
         if self.state == 'LAUNCHED':
             self.path = []
             [x.circuit_launched(self) for x in self.listeners]
         else:
-            if self.state != 'FAILED' and self.state != 'CLOSED' and len(args) > 2:
-                self.update_path(args[2].split(','))
+            if self.state != 'FAILED' and self.state != 'CLOSED' and len(event.args) > 2:
+                self.update_path(event.path)
 
         if self.state == 'BUILT':
             [x.circuit_built(self) for x in self.listeners]
@@ -116,15 +116,13 @@ class Circuit(object):
             if len(self.streams) > 0:
                 log.err(RuntimeError("Circuit is %s but still has %d streams" %
                                      (self.state, len(self.streams))))
-            flags = self._create_flags(kw)
-            [x.circuit_closed(self, **flags) for x in self.listeners]
+            [x.circuit_closed(self, **event.flags) for x in self.listeners]
 
         elif self.state == 'FAILED':
             if len(self.streams) > 0:
                 log.err(RuntimeError("Circuit is %s but still has %d streams" %
                                      (self.state, len(self.streams))))
-            flags = self._create_flags(kw)
-            [x.circuit_failed(self, **flags) for x in self.listeners]
+            [x.circuit_failed(self, **event.flags) for x in self.listeners]
 
     def update_path(self, path):
         """
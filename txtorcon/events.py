@@ -0,0 +1,412 @@
+"""
+Lightweight objects representing Tor's asynchronous events (see
+control-spec section 4.1). These are what listeners added with
+``add_event_listener(name, callback, typed=True)`` receive instead of
+the raw string.
+
+Each object keeps the raw text and only splits it -- or finds the
+keywords, the path, etc. -- the first time a field is asked for, so
+all the listeners for an event share one parse of it.
+"""
+
+from collections import deque
+
+from twisted.python import log
+
+from txtorcon.util import find_keywords, split_args, keyword_flags
+
+
+class TorEvent(object):
+    """
+    Base class for events; also used as-is (well, via a subclass
+    named after the event; see :func:`event_class`) for events
+    without a more-specific class.
+
+    :ivar data: the raw text of the event, minus the ``650`` and the
+        event's name.
+    """
+
+    __slots__ = ('data', '_args', '_keywords', '_flags')
+
+    name = None
+    """The event's name, like ``CIRC``"""
+
+    def __init__(self, data=None, args=None):
+        """
+        :param data: the raw text of the event.
+
+        :param args: the already-split text, if the caller has it
+            (then data may be None).
+        """
+        self.data = data
+        self._args = args
+        self._keywords = None
+        self._flags = None
+
+    @property
+    def args(self):
+        """
+        The whitespace-separated parts of the event; quoted strings
+        are kept together, unquoted (see
+        :func:`txtorcon.util.split_args`).
+        """
+        if self._args is None:
+            self._args = split_args(self.data)
+        return self._args
+
+    @property
+    def keywords(self):
+        """
+        A dict of the ``KEY=value`` arguments; see
+        :func:`txtorcon.util.find_keywords`.
+        """
+        if self._keywords is None:
+            self._keywords = find_keywords(self.args)
+        return self._keywords
+
+    @property
+    def flags(self):
+        """
+        :attr:`keywords` plus a lower-case copy of each key, as passed
+        to listeners like ``circuit_closed`` (built once per event).
+        TorState always listens, so this is built for every CLOSED,
+        FAILED and DETACHED event; as listeners take it as ``**kw``,
+        each still gets its own copy.
+        """
+        if self._flags is None:
+            self._flags = keyword_flags(self.keywords)
+        return self._flags
+
+    def __str__(self):
+        if self.data is None:
+            self.data = ' '.join(self._args)
+        return self.data
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, str(self))
+
+
+class CircEvent(TorEvent):
+    """
+    A CIRC event (control-spec 4.1.1)
+    """
+
+    __slots__ = ('_path',)
+    name = 'CIRC'
+
+    def __init__(self, data=None, args=None):
+        TorEvent.__init__(self, data, args)
+        self._path = None
+
+    @property
+    def id(self):
+        return int(self.args[0])
+
+    @property
+    def state(self):
+        return self.args[1]
+
+    @property
+    def path(self):
+        """
+        The routers (LongName-style strings like ``$hexid=name``) in
+        the path; empty if the event doesn't have one.
+        """
+        if self._path is None:
+            args = self.args
+            if len(args) > 2 and args[2][:1] == '$':
+                self._path = args[2].split(',')
+            else:
+                self._path = []
+        return self._path
+
+    @property
+    def purpose(self):
+        return self.keywords.get('PURPOSE')
+
+    @property
+    def build_flags(self):
+        flags = self.keywords.get('BUILD_FLAGS')
+        if flags is None:
+            return []
+        return flags.split(',')
+
+
+class StreamEvent(TorEvent):
+    """
+    A STREAM event (control-spec 4.1.2)
+    """
+
+    __slots__ = ()
+    name = 'STREAM'
+
+    @property
+    def id(self):
+        return int(self.args[0])
+
+    @property
+    def state(self):
+        return self.args[1]
+
+    @property
+    def circuit_id(self):
+        "0 if the stream isn't attached"
+        return int(self.args[2])
+
+    @property
+    def target(self):
+        "``host:port``"
+        return self.args[3]
+
+    @property
+    def target_host(self):
+        return self.target[:self.target.rfind(':')]
+
+    @property
+    def target_port(self):
+        return int(self.target[self.target.rfind(':') + 1:])
+
+
+class AddrMapEvent(TorEvent):
+    """
+    An ADDRMAP event (control-spec 4.1.7). The expiry times are quoted
+    strings, which come out of :attr:`args` as one argument each.
+    """
+
+    __slots__ = ()
+    name = 'ADDRMAP'
+
+    @property
+    def hostname(self):
+        return self.args[0]
+
+    @property
+    def address(self):
+        return self.args[1]
+
+
+def event_key(event):
+    """
+    The default key for :class:`EventBatcher`'s ``collapse``: the
+    first word of the event, which is the circuit or stream ID for
+    CIRC and STREAM events (or the hostname for ADDRMAP).
+    """
+
+    if isinstance(event, TorEvent):
+        return event.args[0]
+    return event.split(None, 1)[0]
+
+
+class ListenerWrapper(object):
+    """
+    Base for the wrappers add_event_listener may put around a
+    callback. These compare equal to the callback they wrap, so
+    ``remove_event_listener`` works with the original callback.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def __eq__(self, other):
+        return other is self or other == self.callback
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.callback)
+
+
+class EventBatcher(ListenerWrapper):
+    """
+    Wraps an event callback so it's called with a list of events at
+    most once per ``interval`` seconds (0 meaning: once at the end of
+    this reactor turn) instead of once per event.
+    """
+
+    def __init__(self, callback, scheduler, interval=0, collapse=None):
+        """
+        :param scheduler: an IReactorTime provider
+
+        :param collapse: if not None, a one-argument callable
+            returning a key for an event (see :func:`event_key`); a
+            later event with the same key replaces the earlier one in
+            the pending batch (keeping the earlier one's position), so
+            the callback only sees the latest state of, e.g., each
+            circuit.
+        """
+        ListenerWrapper.__init__(self, callback)
+        self.scheduler = scheduler
+        self.interval = interval
+        self.collapse = collapse
+        self.pending = []
+        self._positions = {}            # collapse key -> index in pending
+        self._delayed = None
+
+    def __call__(self, event):
+        if self.collapse is not None:
+            key = self.collapse(event)
+            try:
+                self.pending[self._positions[key]] = event
+                return
+            except KeyError:
+                self._positions[key] = len(self.pending)
+        self.pending.append(event)
+        if self._delayed is None:
+            self._delayed = self.scheduler.callLater(self.interval, self.flush)
+
+    def flush(self):
+        "Deliver any pending events now."
+        if self._delayed is not None and self._delayed.active():
+            self._delayed.cancel()
+        self._delayed = None
+        pending = self.pending
+        self.pending = []
+        self._positions = {}
+        if pending:
+            self.callback(pending)
+
+
+class EventQueue(ListenerWrapper):
+    """
+    Wraps an event callback in a bounded queue: events are queued as
+    they arrive and handed to the callback on a later reactor turn,
+    so a slow listener can't hold up reading from Tor (which will,
+    eventually, close a controller connection that doesn't keep up)
+    and an exception from it is logged rather than breaking the
+    connection.
+
+    What happens when ``maxsize`` events are waiting depends on
+    ``policy``:
+
+     - ``"drop-oldest"``: the oldest waiting event is thrown away;
+     - ``"coalesce"``: an event replaces a waiting one with the same
+       key (see :func:`event_key`) -- whether or not the queue is full
+       -- and otherwise the oldest is thrown away;
+     - ``"block"``: nothing is thrown away; instead ``producer`` (the
+       control connection) is paused until the queue has been drained
+       below ``maxsize``. Lines Tor already sent us are still
+       delivered, so the queue may briefly exceed ``maxsize``.
+
+    :ivar dropped: how many events were thrown away
+
+    :ivar coalesced: how many events replaced a waiting one
+
+    :ivar max_depth: the most events that have been waiting at once
+
+    :ivar errors: how many times the callback raised an exception
+    """
+
+    policies = ('drop-oldest', 'coalesce', 'block')
+
+    def __init__(self, callback, scheduler, maxsize, policy='drop-oldest',
+                 producer=None, key=event_key):
+        """
+        :param scheduler: an IReactorTime provider
+
+        :param producer: for the ``"block"`` policy, something with
+            ``pauseProducing`` and ``resumeProducing`` methods.
+
+        :param key: for the ``"coalesce"`` policy.
+        """
+        if policy not in self.policies:
+            raise ValueError("Unknown policy '%s'; use one of: %s" % (policy, ', '.join(self.policies)))
+        if policy == 'block' and producer is None:
+            raise ValueError("The block policy needs a producer to pause.")
+        ListenerWrapper.__init__(self, callback)
+        self.scheduler = scheduler
+        self.maxsize = maxsize
+        self.policy = policy
+        self.producer = producer
+        self.key = key
+
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.errors = 0
+
+        self.queue = deque()
+        self._keys = {}                 # for "coalesce": key -> [event], an entry in queue
+        self._delayed = None
+        self._paused = False
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __call__(self, event):
+        if self.policy == 'coalesce':
+            k = self.key(event)
+            try:
+                self._keys[k][0] = event
+                self.coalesced += 1
+                return
+            except KeyError:
+                entry = [event]
+                self._keys[k] = entry
+                event = entry
+
+        if len(self.queue) >= self.maxsize:
+            if self.policy == 'block':
+                if not self._paused:
+                    self._paused = True
+                    self.producer.pauseProducing()
+            else:
+                self._discard(self.queue.popleft())
+                self.dropped += 1
+
+        self.queue.append(event)
+        if len(self.queue) > self.max_depth:
+            self.max_depth = len(self.queue)
+        if self._delayed is None:
+            self._delayed = self.scheduler.callLater(0, self._drain)
+
+    def _discard(self, event):
+        "forget the coalescing key of an event leaving the queue"
+        if self.policy == 'coalesce':
+            del self._keys[self.key(event[0])]
+            return event[0]
+        return event
+
+    def _drain(self):
+        """
+        Delivers the events waiting when we were scheduled; any that
+        arrive meanwhile wait for the next reactor turn.
+        """
+
+        self._delayed = None
+        for _ in range(len(self.queue)):
+            event = self._discard(self.queue.popleft())
+            try:
+                self.callback(event)
+            except Exception:
+                self.errors += 1
+                log.err()
+
+        if self._paused and len(self.queue) < self.maxsize:
+            self._paused = False
+            self.producer.resumeProducing()
+        if len(self.queue) and self._delayed is None:
+            self._delayed = self.scheduler.callLater(0, self._drain)
+
+
+event_classes = {}
+"""event name -> TorEvent subclass"""
+
+for _cls in [CircEvent, StreamEvent, AddrMapEvent]:
+    event_classes[_cls.name] = _cls
+del _cls
+
+
+def event_class(name):
+    """
+    :return: the :class:`TorEvent` subclass for the named event,
+        creating a plain one if there's no specific class for it.
+    """
+
+    try:
+        return event_classes[name]
+    except KeyError:
+        cls = type('%sEvent' % name.title().replace('_', ''), (TorEvent,),
+                   dict(__slots__=(), name=name))
+        event_classes[name] = cls
+        return cls
@@ -0,0 +1,638 @@
+"""
+A stand-in for Tor's control port, for load- and scale-testing
+txtorcon (or anything else) without a Tor or a network. It knows
+enough of the control protocol to let
+:func:`txtorcon.build_tor_connection` bootstrap a
+:class:`txtorcon.TorState`: PROTOCOLINFO, AUTHENTICATE, GETINFO
+(``ns/all``, ``circuit-status``, ``stream-status`` and so on),
+GETCONF, SETCONF, SETEVENTS, ATTACHSTREAM, EXTENDCIRCUIT and a few
+more. The consensus is synthesized (of any size) and CIRC, STREAM and
+ADDRMAP events can be generated at fixed rates::
+
+    from twisted.internet import reactor
+    from twisted.internet.endpoints import TCP4ServerEndpoint
+    from txtorcon.faketor import FakeTor
+
+    tor = FakeTor(routers=20000, password='foo')
+    TCP4ServerEndpoint(reactor, 9052).listen(tor.factory())
+    tor.start_events(circ=100, stream=1000, addrmap=50)
+
+(connect with ``password_function=lambda: 'foo'``) or, from a shell::
+
+    python -m txtorcon.faketor --port 9052 --routers 20000 --password foo --stream-rate 1000
+
+Nothing is validated beyond what's needed to give sensible replies.
+"""
+
+import hashlib
+import os
+import random
+import time
+from collections import deque
+
+from twisted.internet import reactor, task
+from twisted.internet.interfaces import IReactorTime
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import LineOnlyReceiver
+
+VERSION = '0.2.4.10-alpha (fake)'
+
+EVENT_NAMES = ('CIRC CIRC_MINOR STREAM ORCONN BW DEBUG INFO NOTICE WARN ERR '
+               'NEWDESC ADDRMAP AUTHDIR_NEWDESCS DESCCHANGED NS STATUS_GENERAL '
+               'STATUS_CLIENT STATUS_SERVER GUARD STREAM_BW CLIENTS_SEEN '
+               'NEWCONSENSUS BUILDTIMEOUT_SET SIGNAL CONF_CHANGED '
+               'TRANSPORT_LAUNCHED')
+
+COUNTRIES = ('us', 'de', 'fr', 'nl', 'se', 'gb', 'ca', 'ru', 'ch', 'ro', 'at', 'jp')
+
+FLAG_SETS = ('Fast Running Valid',
+             'Fast Running Stable Valid',
+             'Fast Guard Running Stable V2Dir Valid',
+             'Exit Fast Running Stable Valid',
+             'Exit Fast Guard Running Stable V2Dir Valid')
+
+
+def _b64(data):
+    "the base-64, without padding, Tor uses for digests in consensuses"
+    return data.encode('base64').strip().rstrip('=')
+
+
+class FakeRouter(object):
+    """
+    One router of a :class:`FakeTor`'s consensus.
+    """
+
+    def __init__(self, name, digest, ip, or_port, flags, bandwidth):
+        self.name = name
+        self.digest = digest            # 20 bytes
+        self.ip = ip
+        self.or_port = or_port
+        self.flags = flags
+        self.bandwidth = bandwidth
+        self.id_hex = '$' + digest.encode('hex').upper()
+
+    @property
+    def long_name(self):
+        "``$HEXID~name``, as used in CIRC events and circuit-status"
+        return '%s~%s' % (self.id_hex, self.name)
+
+    def consensus_lines(self, published):
+        if 'Exit' in self.flags:
+            policy = 'accept 20-23,43,53,79-81,88,110,143,194,220,389,443,464,531,543-544,554,563'
+        else:
+            policy = 'reject 1-65535'
+        return ['r %s %s %s %s %s %d 0' % (self.name, _b64(self.digest),
+                                           _b64(hashlib.sha1(self.digest).digest()),
+                                           published, self.ip, self.or_port),
+                's ' + self.flags,
+                'w Bandwidth=%d' % self.bandwidth,
+                'p ' + policy]
+
+
+class FakeTor(object):
+    """
+    The state of a fake Tor: a consensus, the circuits, streams and
+    address-maps, configuration and the connected controllers.
+
+    :ivar routers: list of :class:`FakeRouter`
+
+    :ivar circuits: circuit id -> ``[state, path, purpose]`` where
+        path is a list of :class:`FakeRouter`
+
+    :ivar streams: stream id -> ``[state, circuit id, target]``
+
+    :ivar addrmaps: hostname -> ``(address, expiry)``
+
+    :ivar config: name -> value, for GETCONF and SETCONF
+
+    :ivar events_sent: how many events have been written to
+        controllers, by name (an event going to two controllers counts
+        twice)
+    """
+
+    def __init__(self, routers=1000, circuits=10, password=None, cookie_file=None,
+                 seed=0, clock=None):
+        """
+        :param routers: how many routers to put in the consensus.
+
+        :param circuits: how many BUILT circuits exist to begin with;
+            generated STREAM events use these (and they're never
+            closed).
+
+        :param password: if set, controllers must AUTHENTICATE with it
+            (HASHEDPASSWORD authentication).
+
+        :param cookie_file: if set, 32 random bytes are written to this
+            file and controllers may AUTHENTICATE with them (COOKIE
+            authentication). With neither this nor password, any
+            AUTHENTICATE succeeds (NULL authentication) -- but note
+            txtorcon itself wants COOKIE or a password_function.
+
+        :param seed: for the random numbers used to make up routers,
+            so a given size of consensus is always the same.
+
+        :param clock: an IReactorTime provider, for generating events
+            (default: the reactor).
+        """
+
+        self.random = random.Random(seed)
+        self.clock = IReactorTime(clock or reactor)
+        self.password = password
+        self.cookie_file = cookie_file
+        self.cookie = None
+        if cookie_file is not None:
+            self.cookie = os.urandom(32)
+            with open(cookie_file, 'w') as f:
+                f.write(self.cookie)
+
+        self.published = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        self.routers = []
+        self.routers_by_id = {}
+        self.routers_by_name = {}
+        self._ns_all = None
+        for i in range(routers):
+            self.add_router()
+
+        self.circuits = {}
+        self.streams = {}
+        self.addrmaps = {}
+        self.config = {'SocksPort': '9050', 'ControlPort': '9052', 'ORPort': '0',
+                       '__LeaveStreamsUnattached': '0'}
+        self.connections = []
+        self.events_sent = {}
+
+        self._next_circuit = 1
+        self._next_stream = 1
+        self._next_host = 1
+        self.stable_circuits = []
+        for i in range(circuits):
+            cid = self._new_circuit_id()
+            self.circuits[cid] = ['BUILT', self.pick_path(), 'GENERAL']
+            self.stable_circuits.append(cid)
+
+        self._generators = {}           # event name -> EventGenerator
+
+    def factory(self):
+        "A ServerFactory of control connections to this fake Tor."
+        factory = ServerFactory()
+        factory.protocol = FakeTorControlProtocol
+        factory.tor = self
+        return factory
+
+    def add_router(self):
+        "Make up another router for the consensus."
+        n = len(self.routers)
+        r = self.random
+        router = FakeRouter('fake%05d' % n,
+                            ''.join(chr(r.randint(0, 255)) for _ in range(20)),
+                            '%d.%d.%d.%d' % (r.randint(1, 223), r.randint(0, 255),
+                                             r.randint(0, 255), r.randint(1, 254)),
+                            r.choice((443, 9001, 9090)),
+                            r.choice(FLAG_SETS),
+                            int(r.expovariate(1 / 500.0)) + 20)
+        self.routers.append(router)
+        self.routers_by_id[router.id_hex[1:]] = router
+        self.routers_by_name[router.name] = router
+        self._ns_all = None
+        return router
+
+    def ns_all(self):
+        "the consensus, as lines (built once, until routers change)"
+        if self._ns_all is None:
+            lines = []
+            for router in self.routers:
+                lines.extend(router.consensus_lines(self.published))
+            self._ns_all = lines
+        return self._ns_all
+
+    def pick_path(self, length=3):
+        return self.random.sample(self.routers, min(length, len(self.routers)))
+
+    def country(self, ip):
+        "the made-up country for ip-to-country"
+        return COUNTRIES[hash(ip) % len(COUNTRIES)]
+
+    def _new_circuit_id(self):
+        cid = self._next_circuit
+        self._next_circuit += 1
+        return cid
+
+    ## events
+
+    def emit(self, name, text):
+        """
+        Send an event to every controller which has asked for it. If
+        text has several lines it's sent as a multi-line event.
+        """
+
+        if '\n' in text:
+            first, rest = text.split('\n', 1)
+            head = name + (first and ' ' + first)
+            line = '650+%s\r\n%s\r\n.\r\n650 OK\r\n' % (head, rest.replace('\n', '\r\n'))
+        else:
+            line = '650 %s %s\r\n' % (name, text)
+        for conn in self.connections:
+            if name in conn.events:
+                conn.transport.write(line)
+                self.events_sent[name] = self.events_sent.get(name, 0) + 1
+
+    def new_consensus(self):
+        "Send a NEWCONSENSUS event with the whole consensus."
+        self.emit('NEWCONSENSUS', '\n' + '\n'.join(self.ns_all()))
+
+    def start_events(self, circ=0, stream=0, addrmap=0, tick=0.01):
+        """
+        Start generating events at the given rates (per second); see
+        :meth:`stop_events`. Events are sent in bursts every ``tick``
+        seconds. CIRC events take circuits through LAUNCHED, EXTENDED
+        and BUILT to CLOSED; STREAM events take streams through NEW,
+        SENTCONNECT and SUCCEEDED to CLOSED, on the initial circuits
+        (unless ``__LeaveStreamsUnattached`` is set, in which case
+        they wait at NEW for an ATTACHSTREAM).
+        """
+
+        for (name, rate, source) in [('CIRC', circ, self._circuit_lifecycle),
+                                     ('STREAM', stream, self._stream_lifecycle),
+                                     ('ADDRMAP', addrmap, self._addrmap_events)]:
+            if rate > 0:
+                generator = EventGenerator(self, name, rate, source)
+                generator.start(tick)
+                self._generators[name] = generator
+
+    def stop_events(self):
+        for generator in self._generators.values():
+            generator.stop()
+        self._generators = {}
+
+    def _circuit_lifecycle(self):
+        "one circuit's CIRC events"
+        cid = self._new_circuit_id()
+        path = self.pick_path()
+        circuit = self.circuits[cid] = ['LAUNCHED', [], 'GENERAL']
+        yield '%d LAUNCHED PURPOSE=GENERAL' % cid
+        for router in path:
+            circuit[0] = 'EXTENDED'
+            circuit[1].append(router)
+            yield '%d EXTENDED %s PURPOSE=GENERAL' % (cid, ','.join(r.long_name for r in circuit[1]))
+        circuit[0] = 'BUILT'
+        yield '%d BUILT %s PURPOSE=GENERAL' % (cid, ','.join(r.long_name for r in circuit[1]))
+        del self.circuits[cid]
+        yield '%d CLOSED %s PURPOSE=GENERAL REASON=FINISHED' % (cid, ','.join(r.long_name for r in circuit[1]))
+
+    def _stream_lifecycle(self):
+        "one stream's STREAM events"
+        sid = self._next_stream
+        self._next_stream += 1
+        target = 'host%d.example.com:80' % self.random.randint(1, 1000)
+        self.streams[sid] = ['NEW', 0, target]
+        yield '%d NEW 0 %s SOURCE_ADDR=127.0.0.1:%d PURPOSE=USER' % (sid, target, 10000 + sid % 50000)
+        if self.config.get('__LeaveStreamsUnattached') == '1':
+            return                      # ATTACHSTREAM does the rest
+        for text in self._stream_attached(sid, self.random.choice(self.stable_circuits or [0])):
+            yield text
+
+    def _stream_attached(self, sid, cid):
+        "the rest of a stream's events, once it's on a circuit"
+        stream = self.streams[sid]
+        stream[0] = 'SENTCONNECT'
+        stream[1] = cid
+        yield '%d SENTCONNECT %d %s' % (sid, cid, stream[2])
+        stream[0] = 'SUCCEEDED'
+        yield '%d SUCCEEDED %d %s' % (sid, cid, stream[2])
+        del self.streams[sid]
+        yield '%d CLOSED %d %s REASON=DONE' % (sid, cid, stream[2])
+
+    def _addrmap_events(self):
+        "ADDRMAP events, forever"
+        while True:
+            host = 'host%d.example.com' % self._next_host
+            self._next_host += 1
+            address = '10.%d.%d.%d' % (self.random.randint(0, 255), self.random.randint(0, 255),
+                                       self.random.randint(1, 254))
+            when = time.time() + 1800
+            expires = (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)),
+                       time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(when)))
+            self.addrmaps[host] = (address, expires)
+            yield '%s %s "%s" EXPIRES="%s" CACHED="YES"' % ((host, address) + expires)
+
+    ## GETINFO
+
+    def get_info(self, key):
+        """
+        :return: the value for a GETINFO key, or None if it isn't one
+            we know (a multi-line value is a string containing
+            newlines).
+        """
+
+        simple = {'version': lambda: VERSION,
+                  'events/names': lambda: EVENT_NAMES,
+                  'process/pid': lambda: str(os.getpid()),
+                  'ns/all': lambda: '\n'.join(self.ns_all()),
+                  'circuit-status': self._circuit_status,
+                  'stream-status': self._stream_status,
+                  'address-mappings/all': self._address_mappings,
+                  'entry-guards': self._entry_guards,
+                  'net/listeners/socks': lambda: '"127.0.0.1:%s"' % self.config['SocksPort'],
+                  'config/names': lambda: '\n'.join('%s String' % k for k in sorted(self.config)),
+                  'status/bootstrap-phase': lambda: 'NOTICE BOOTSTRAP PROGRESS=100 TAG=done SUMMARY="Done"'}
+        if key in simple:
+            return simple[key]()
+
+        if key.startswith('ns/id/'):
+            router = self.routers_by_id.get(key[6:].lstrip('$').upper())
+        elif key.startswith('ns/name/'):
+            router = self.routers_by_name.get(key[8:])
+        elif key.startswith('ip-to-country/'):
+            return self.country(key[14:])
+        else:
+            return None
+        if router is None:
+            return None
+        return '\n'.join(router.consensus_lines(self.published))
+
+    def _circuit_status(self):
+        return '\n'.join('%d %s %s PURPOSE=%s' % (cid, state, ','.join(r.long_name for r in path), purpose)
+                         for (cid, (state, path, purpose)) in sorted(self.circuits.items()))
+
+    def _stream_status(self):
+        return '\n'.join('%d %s %d %s' % (sid, state, cid, target)
+                         for (sid, (state, cid, target)) in sorted(self.streams.items()))
+
+    def _address_mappings(self):
+        return '\n'.join('%s %s "%s"' % (host, address, expires[1])
+                         for (host, (address, expires)) in sorted(self.addrmaps.items()))
+
+    def _entry_guards(self):
+        guards = [r for r in self.routers[:100] if 'Guard' in r.flags][:3]
+        return '\n'.join('%s up' % r.long_name for r in guards)
+
+
+class EventGenerator(object):
+    """
+    Sends events of one type from a :class:`FakeTor` at a fixed rate.
+    ``source`` is a callable returning an iterator of event texts (for
+    example, one circuit's lifecycle); several are interleaved so
+    there are always a few circuits or streams part-way through.
+    """
+
+    concurrency = 8
+
+    def __init__(self, tor, name, rate, source):
+        self.tor = tor
+        self.name = name
+        self.rate = rate
+        self.source = source
+        self.active = deque()
+        self._due = 0.0
+        self._last = None
+        self._loop = task.LoopingCall(self._tick)
+        self._loop.clock = tor.clock
+
+    def start(self, tick):
+        self._last = self.tor.clock.seconds()
+        self._loop.start(tick, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def _tick(self):
+        now = self.tor.clock.seconds()
+        self._due += (now - self._last) * self.rate
+        self._last = now
+        for _ in range(int(self._due)):
+            self._due -= 1
+            self.tor.emit(self.name, self._next())
+
+    def _next(self):
+        while len(self.active) < self.concurrency:
+            self.active.append(iter(self.source()))
+        while True:
+            events = self.active.popleft()
+            try:
+                text = events.next()
+            except StopIteration:
+                self.active.append(iter(self.source()))
+                continue
+            self.active.append(events)
+            return text
+
+
+class FakeTorControlProtocol(LineOnlyReceiver):
+    """
+    One controller's connection to a :class:`FakeTor` (the factory's
+    ``tor``).
+    """
+
+    delimiter = '\r\n'
+    MAX_LENGTH = 65536
+
+    def connectionMade(self):
+        self.tor = self.factory.tor
+        self.authenticated = False
+        self.events = set()
+        self.tor.connections.append(self)
+
+    def connectionLost(self, reason):
+        if self in self.tor.connections:
+            self.tor.connections.remove(self)
+
+    def reply(self, code, lines):
+        "A reply with one or more lines (each without the status code)."
+        out = ['%d-%s\r\n' % (code, line) for line in lines[:-1]]
+        out.append('%d %s\r\n' % (code, lines[-1]))
+        self.transport.write(''.join(out))
+
+    def lineReceived(self, line):
+        parts = line.split(' ', 1)
+        verb = parts[0].upper()
+        arg = parts[1] if len(parts) > 1 else ''
+
+        if not self.authenticated and verb not in ('PROTOCOLINFO', 'AUTHENTICATE', 'QUIT'):
+            self.reply(514, ['Authentication required.'])
+            self.transport.loseConnection()
+            return
+
+        handler = getattr(self, 'tor_' + verb, None)
+        if handler is None:
+            self.reply(510, ['Unrecognized command "%s"' % parts[0]])
+            return
+        handler(arg)
+
+    def tor_PROTOCOLINFO(self, arg):
+        methods = []
+        if self.tor.cookie is not None:
+            methods.append('COOKIE')
+        if self.tor.password is not None:
+            methods.append('HASHEDPASSWORD')
+        auth = 'METHODS=' + (','.join(methods) or 'NULL')
+        if self.tor.cookie is not None:
+            auth += ' COOKIEFILE="%s"' % self.tor.cookie_file
+        self.reply(250, ['PROTOCOLINFO 1', 'AUTH ' + auth,
+                         'VERSION Tor="%s"' % VERSION.split()[0], 'OK'])
+
+    def tor_AUTHENTICATE(self, arg):
+        secret = arg.strip().strip('"')
+        try:
+            secret = secret.decode('hex')
+        except TypeError:
+            pass
+        if self.tor.cookie is None and self.tor.password is None:
+            self.authenticated = True
+        elif secret in (self.tor.cookie, self.tor.password):
+            self.authenticated = True
+        if self.authenticated:
+            self.reply(250, ['OK'])
+        else:
+            self.reply(515, ['Authentication failed: Password did not match HashedControlPassword value from configuration'])
+            self.transport.loseConnection()
+
+    def tor_GETINFO(self, arg):
+        keys = arg.split()
+        values = []
+        for key in keys:
+            value = self.tor.get_info(key)
+            if value is None:
+                self.reply(552, ['Unrecognized key "%s"' % key])
+                return
+            values.append((key, value))
+
+        out = []
+        for (key, value) in values:
+            if '\n' in value:
+                out.append('250+%s=\r\n%s\r\n.\r\n' % (key, value.replace('\n', '\r\n')))
+            else:
+                out.append('250-%s=%s\r\n' % (key, value))
+        out.append('250 OK\r\n')
+        self.transport.write(''.join(out))
+
+    def tor_GETCONF(self, arg):
+        lines = []
+        for key in arg.split():
+            if key not in self.tor.config:
+                self.reply(552, ['Unrecognized configuration key "%s"' % key])
+                return
+            lines.append('%s=%s' % (key, self.tor.config[key]))
+        self.reply(250, lines or ['OK'])
+
+    def tor_SETCONF(self, arg):
+        changed = []
+        for pair in arg.split():
+            if '=' in pair:
+                (key, value) = pair.split('=', 1)
+                value = value.strip('"')
+            else:
+                (key, value) = (pair, '')
+            self.tor.config[key] = value
+            changed.append('%s=%s' % (key, value))
+        self.reply(250, ['OK'])
+        if changed:
+            self.tor.emit('CONF_CHANGED', '\n' + '\n'.join(changed))
+
+    tor_RESETCONF = tor_SETCONF
+
+    def tor_SETEVENTS(self, arg):
+        names = arg.split()
+        if names[:1] == ['EXTENDED']:
+            names = names[1:]
+        known = EVENT_NAMES.split()
+        for name in names:
+            if name not in known:
+                self.reply(552, ['Unrecognized event "%s"' % name])
+                return
+        self.events = set(names)
+        self.reply(250, ['OK'])
+
+    def tor_USEFEATURE(self, arg):
+        self.reply(250, ['OK'])
+
+    def tor_SIGNAL(self, arg):
+        self.reply(250, ['OK'])
+
+    def tor_ATTACHSTREAM(self, arg):
+        args = arg.split()
+        sid = int(args[0])
+        cid = int(args[1])
+        if sid not in self.tor.streams:
+            self.reply(552, ['Unknown stream "%d"' % sid])
+            return
+        if cid == 0:
+            cid = self.tor.random.choice(self.tor.stable_circuits or [0])
+        elif cid not in self.tor.circuits:
+            self.reply(552, ['Unknown circuit "%d"' % cid])
+            return
+        self.reply(250, ['OK'])
+        for text in self.tor._stream_attached(sid, cid):
+            self.tor.emit('STREAM', text)
+
+    def tor_EXTENDCIRCUIT(self, arg):
+        args = arg.split()
+        if args[0] != '0':
+            self.reply(552, ['Unknown circuit "%s"' % args[0]])
+            return
+        if len(args) > 1 and not args[1].startswith('purpose='):
+            path = []
+            for name in args[1].split(','):
+                router = self.tor.routers_by_id.get(name.lstrip('$').upper()) or self.tor.routers_by_name.get(name)
+                if router is None:
+                    self.reply(552, ['No such router "%s"' % name])
+                    return
+                path.append(router)
+        else:
+            path = self.tor.pick_path()
+        cid = self.tor._new_circuit_id()
+        self.tor.circuits[cid] = ['BUILT', path, 'GENERAL']
+        self.reply(250, ['EXTENDED %d' % cid])
+        self.tor.emit('CIRC', '%d LAUNCHED PURPOSE=GENERAL' % cid)
+        self.tor.emit('CIRC', '%d BUILT %s PURPOSE=GENERAL' % (cid, ','.join(r.long_name for r in path)))
+
+    def tor_CLOSECIRCUIT(self, arg):
+        cid = int(arg.split()[0])
+        if cid not in self.tor.circuits:
+            self.reply(552, ['Unknown circuit "%d"' % cid])
+            return
+        path = self.tor.circuits.pop(cid)[1]
+        if cid in self.tor.stable_circuits:
+            self.tor.stable_circuits.remove(cid)
+        self.reply(250, ['OK'])
+        self.tor.emit('CIRC', '%d CLOSED %s PURPOSE=GENERAL REASON=REQUESTED' % (cid, ','.join(r.long_name for r in path)))
+
+    def tor_CLOSESTREAM(self, arg):
+        sid = int(arg.split()[0])
+        if sid not in self.tor.streams:
+            self.reply(552, ['Unknown stream "%d"' % sid])
+            return
+        (state, cid, target) = self.tor.streams.pop(sid)
+        self.reply(250, ['OK'])
+        self.tor.emit('STREAM', '%d CLOSED %d %s REASON=MISC' % (sid, cid, target))
+
+    def tor_QUIT(self, arg):
+        self.reply(250, ['closing connection'])
+        self.transport.loseConnection()
+
+
+def main(argv=None):
+    import argparse
+    from twisted.internet.endpoints import TCP4ServerEndpoint
+
+    parser = argparse.ArgumentParser(description='A fake Tor control port, for testing.')
+    parser.add_argument('--port', type=int, default=9052)
+    parser.add_argument('--routers', type=int, default=1000)
+    parser.add_argument('--circuits', type=int, default=10)
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--cookie-file', default=None)
+    parser.add_argument('--circ-rate', type=float, default=0)
+    parser.add_argument('--stream-rate', type=float, default=0)
+    parser.add_argument('--addrmap-rate', type=float, default=0)
+    options = parser.parse_args(argv)
+
+    tor = FakeTor(routers=options.routers, circuits=options.circuits,
+                  password=options.password, cookie_file=options.cookie_file)
+    TCP4ServerEndpoint(reactor, options.port, interface='127.0.0.1').listen(tor.factory())
+    tor.start_events(options.circ_rate, options.stream_rate, options.addrmap_rate)
+    print "Fake Tor with %d routers listening on 127.0.0.1:%d" % (len(tor.routers), options.port)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
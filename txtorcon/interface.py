@@ -277,13 +277,14 @@ class ITorControlProtocol(Interface):
         the existing ones)
         """
 
-    def add_event_listener(evt, callback):
+    def add_event_listener(evt, callback, typed=False):
         """
         Add a listener to an Event object. This may be called multiple
         times for the same event. Every time the event happens, the
         callback method will be called. The callback has one argument
         (a string, the contents of the event, minus the '650' and the
-        name of the event)
+        name of the event -- or, if typed is True, a
+        :class:`txtorcon.events.TorEvent` wrapping that string)
 
         FIXME: should have an interface for the callback.
         """
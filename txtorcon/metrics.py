@@ -0,0 +1,159 @@
+"""
+Cheap, always-on counters for a control connection; see
+:attr:`txtorcon.TorControlProtocol.metrics`.
+"""
+
+import bisect
+
+
+class Histogram(object):
+    """
+    Counts values into fixed buckets (by default, powers of two from
+    100 microseconds to about 52 seconds, for timings) and keeps the
+    count, total and largest value. Adding a value is a bisect and an
+    increment.
+    """
+
+    timing_bounds = [0.0001 * 2 ** i for i in range(20)]
+    """default bucket upper bounds, in seconds"""
+
+    def __init__(self, bounds=None):
+        """
+        :param bounds: sorted upper bounds of the buckets; values
+            larger than the last go in one more bucket.
+        """
+        self.bounds = bounds or self.timing_bounds
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        if self.count == 0:
+            return 0
+        return self.total / float(self.count)
+
+    def percentile(self, pct):
+        """
+        :return: the upper bound of the bucket containing the
+            ``pct``'th percentile (or :attr:`max` if that's smaller, or
+            in the last bucket).
+        """
+
+        if self.count == 0:
+            return 0
+        want = self.count * pct / 100.0
+        seen = 0
+        for (bound, count) in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= want:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return dict(count=self.count, total=self.total, max=self.max,
+                    mean=self.mean(), p50=self.percentile(50),
+                    p90=self.percentile(90), p99=self.percentile(99))
+
+
+class ProtocolMetrics(object):
+    """
+    What a :class:`txtorcon.TorControlProtocol` has been up to. Things
+    keyed by command are keyed on the verb (``GETINFO``, ``SETCONF``,
+    ...) and things keyed by event on its name (``CIRC``, ...).
+
+    :ivar queue_wait: verb -> :class:`Histogram` of the seconds
+        commands waited in the queue before being sent to Tor.
+
+    :ivar wire_time: verb -> :class:`Histogram` of the seconds from
+        sending a command to having its whole reply.
+
+    :ivar queue_depth: a :class:`Histogram` of how many commands were
+        already waiting each time one was queued.
+
+    :ivar bytes_received: total bytes read from Tor
+
+    :ivar lines_received: total lines read from Tor
+
+    :ivar events: event name -> how many we've received
+
+    :ivar callback_time: event name -> :class:`Histogram` of the
+        seconds spent in that event's listeners, per event.
+    """
+
+    depth_bounds = [2 ** i for i in range(16)]
+
+    def __init__(self, clock):
+        """
+        :param clock: an IReactorTime provider, to work out rates.
+        """
+        self.clock = clock
+        self.reset()
+
+    def reset(self):
+        "Zero everything (and restart the clock for the rates)."
+        self.started = self.clock.seconds()
+        self.queue_wait = {}
+        self.wire_time = {}
+        self.queue_depth = Histogram(self.depth_bounds)
+        self.bytes_received = 0
+        self.lines_received = 0
+        self.events = {}
+        self.callback_time = {}
+
+    def _histogram(self, histograms, key):
+        try:
+            return histograms[key]
+        except KeyError:
+            h = histograms[key] = Histogram()
+            return h
+
+    def command_queued(self, depth):
+        self.queue_depth.add(depth)
+
+    def command_sent(self, verb, waited):
+        self._histogram(self.queue_wait, verb).add(waited)
+
+    def command_answered(self, verb, elapsed):
+        self._histogram(self.wire_time, verb).add(elapsed)
+
+    def event_delivered(self, name, elapsed):
+        self.events[name] = self.events.get(name, 0) + 1
+        self._histogram(self.callback_time, name).add(elapsed)
+
+    def events_per_second(self):
+        """
+        :return: a dict of event name -> average events per second
+            since we started (or were :meth:`reset`)
+        """
+
+        elapsed = self.clock.seconds() - self.started
+        if elapsed <= 0:
+            return dict((name, 0.0) for name in self.events)
+        return dict((name, count / elapsed) for (name, count) in self.events.items())
+
+    def as_dict(self):
+        """
+        :return: everything as plain dicts, lists and numbers (e.g.
+            for JSON)
+        """
+
+        def histograms(h):
+            return dict((k, v.as_dict()) for (k, v) in h.items())
+
+        return dict(elapsed=self.clock.seconds() - self.started,
+                    queue_wait=histograms(self.queue_wait),
+                    wire_time=histograms(self.wire_time),
+                    queue_depth=self.queue_depth.as_dict(),
+                    bytes_received=self.bytes_received,
+                    lines_received=self.lines_received,
+                    events=dict(self.events),
+                    events_per_second=self.events_per_second(),
+                    callback_time=histograms(self.callback_time))
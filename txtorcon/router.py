@@ -1,4 +1,10 @@
-from util import NetLocation
+from twisted.internet import defer, reactor, threads
+from twisted.internet.interfaces import IReactorTime
+from twisted.python import log
+
+from torcontrolprotocol import parse_keywords, TorProtocolError
+from util import NetLocation, LRUDict, location_cache
+import binascii
 import types
 
 
@@ -19,10 +25,33 @@ def hashFromHexId(hexid):
     return hexid.decode("hex").encode("base64")[:-2]
 
 
+FLAGS = ('authority', 'badexit', 'baddirectory', 'exit', 'fast', 'guard', 'hsdir',
+         'named', 'noedconsensus', 'running', 'stable', 'stabledesc', 'unnamed',
+         'v2dir', 'valid')
+"""The router flags Tor knows about (in the order it lists them);
+flag ``FLAGS[n]`` is bit ``1 << n`` of :attr:`Router.flag_mask`."""
+
+FLAG_BITS = dict((flag, 1 << i) for (i, flag) in enumerate(FLAGS))
+"""flag name (lower-case) -> its bit in :attr:`Router.flag_mask`"""
+
+
+def _digest(thehash):
+    "the 20 bytes of a base-64 encoded hash (as in the consensus)"
+    return binascii.a2b_base64(thehash + "=")
+
+
+def _hash(digest):
+    "the reverse of _digest"
+    return binascii.b2a_base64(digest)[:-2]
+
+
 class PortRange(object):
     """
     Represents a range of ports for Router policies.
     """
+
+    __slots__ = ('min', 'max')
+
     def __init__(self, a, b):
         self.min = a
         self.max = b
@@ -42,7 +71,9 @@ class Router(object):
 
     The controller you pass in is really only used to do get_info
     calls for ip-to-country/IP in case the
-    :class:`txtorcon.util.NetLocation` stuff fails to find a country.
+    :class:`txtorcon.util.NetLocation` stuff fails to find a country
+    (batched up each reactor turn, using its ``scheduler`` if it
+    has one and the reactor otherwise; see :data:`tor_countries`).
 
     After an .update() call, the id_hex attribute contains a
     hex-encoded long hash (suitable, for example, to use in a
@@ -51,37 +82,128 @@ class Router(object):
     After setting the policy property you may call accepts_port() to
     find out if the router will accept a given port. This works with
     the reject or accept based policies.
+
+    There's one of these for every router in the consensus, so they're
+    kept small: the identity is kept as its 20 bytes
+    (:attr:`fingerprint`; ``id_hex`` and ``id_hash`` are worked out
+    from it when asked for) and the flags as a bitmask
+    (:attr:`flag_mask`; see :data:`FLAGS`).
     """
 
+    __slots__ = ('controller', 'name', 'fingerprint', '_or_digest', 'modified', 'ip',
+                 'or_port', 'dir_port', '_location', 'flag_mask', '_other_flags',
+                 '_bandwidth', 'name_is_unique', 'accepted_ports', 'rejected_ports',
+                 'from_consensus', 'ip_v6')
+
     def __init__(self, controller):
         self.controller = controller
-        self._flags = []
+        self.fingerprint = None
+        """The router's identity: 20 bytes (binary)."""
+        self.flag_mask = 0
+        """The router's flags: bit ``FLAG_BITS[name]`` is set for each
+        it has (see :attr:`flags`)."""
+        self._other_flags = ()          # any not in FLAGS
         self.bandwidth = 0
         self.name_is_unique = False
         self.accepted_ports = None
         self.rejected_ports = None
-        self.id_hex = None
-        self.location = NetLocation('0.0.0.0')
+        self._location = None
         self.from_consensus = False
         self.ip_v6 = []                 # most routers have no IPv6 addresses
 
     unique_name = property(lambda x: x.name_is_unique and x.name or x.id_hex)
     "has the hex id if this router's name is not unique, or its name otherwise"
 
+    @property
+    def id_hex(self):
+        """
+        The fingerprint, hex-encoded with a leading ``$`` (None
+        before update() is called).
+        """
+        if self.fingerprint is None:
+            return None
+        return '$' + binascii.b2a_hex(self.fingerprint).upper()
+
+    @id_hex.setter
+    def id_hex(self, hexid):
+        self.fingerprint = None if hexid is None else binascii.a2b_hex(hexid.lstrip('$'))
+
+    @property
+    def id_hash(self):
+        "The fingerprint, base-64 encoded as in the consensus."
+        return _hash(self.fingerprint)
+
+    @id_hash.setter
+    def id_hash(self, idhash):
+        self.fingerprint = _digest(idhash)
+
+    @property
+    def or_hash(self):
+        "The descriptor digest, base-64 encoded as in the consensus."
+        return _hash(self._or_digest)
+
+    @or_hash.setter
+    def or_hash(self, orhash):
+        self._or_digest = _digest(orhash)
+
     def update(self, name, idhash, orhash, modified, ip, orport, dirport):
         self.name = name
-        self.id_hash = idhash
-        self.or_hash = orhash
+        self.fingerprint = _digest(idhash)
+        self._or_digest = _digest(orhash)
         self.modified = modified
         self.ip = ip
         self.or_port = orport
         self.dir_port = dirport
-        self.location = NetLocation(self.ip)
-        if self.location.countrycode is None and self.ip != 'unknown':
-            ## see if Tor is magic and knows more...
-            self.controller.get_info_raw('ip-to-country/' + self.ip).addCallback(self._set_country)
+        self._location = None           # looked up when it's asked for
+
+    @property
+    def location(self):
+        """
+        A :class:`txtorcon.util.NetLocation` for this router's IP
+        address. It's looked up the first time it's asked for (in
+        :data:`txtorcon.util.location_cache`, shared by all routers),
+        so routers nobody asks about cost no GeoIP lookups; see
+        :func:`resolve_locations` to do them all on a worker thread.
+        """
+
+        if self._location is None:
+            ip = getattr(self, 'ip', None)
+            if ip is None:              # not update()-ed yet
+                self._location = NetLocation('0.0.0.0')
+            else:
+                try:
+                    self._location = location_cache[ip]
+                except KeyError:
+                    self._location = location_cache[ip] = NetLocation(ip)
+                    self._check_country()
+        return self._location
+
+    @location.setter
+    def location(self, location):
+        self._location = location
+
+    def _check_country(self):
+        """
+        called once for each new location: if GeoIP didn't find a
+        country, see if Tor is magic and knows more...
+        """
 
-        self.id_hex = hexIdFromHash(self.id_hash)
+        if self._location.countrycode is None and self.ip != 'unknown':
+            _ask_tor_for_country(self.controller, self._location)
+
+    def _update_from(self, other):
+        """
+        Takes on all of other's values (other being this router as of
+        a newer consensus), so everything referring to this Router
+        object sees them.
+        """
+
+        ip = getattr(self, 'ip', None)
+        for name in Router.__slots__:
+            if name not in ('controller', '_location') and hasattr(other, name):
+                setattr(self, name, getattr(other, name))
+        if self.ip != ip:
+            self._location = None
 
     @property
     def flags(self):
@@ -89,7 +211,8 @@ class Router(object):
         A list of all the flags for this Router, each one an
         all-lower-case string.
         """
-        return self._flags
+        mask = self.flag_mask
+        return [flag for flag in FLAGS if mask & FLAG_BITS[flag]] + list(self._other_flags)
 
     @flags.setter
     def flags(self, flags):
@@ -103,8 +226,18 @@ class Router(object):
         """
         if isinstance(flags, types.StringType):
             flags = flags.split()
-        self._flags = map(lambda x: x.lower(), flags)
-        self.name_is_unique = 'named' in self._flags
+        mask = 0
+        other = []
+        for flag in flags:
+            flag = flag.lower()
+            bit = FLAG_BITS.get(flag)
+            if bit is None:
+                other.append(flag)
+            else:
+                mask |= bit
+        self.flag_mask = mask
+        self._other_flags = tuple(other)
+        self.name_is_unique = bool(mask & FLAG_BITS['named'])
 
     @property
     def bandwidth(self):
@@ -174,16 +307,148 @@ class Router(object):
                 return True
         return False
 
-    def _set_country(self, c):
-        """
-        callback if we used Tor's GETINFO ip-to-country
-        """
-
-        self.location.countrycode = c[:-3].split('=')[1].strip().upper()
-
     def __repr__(self):
         n = self.id_hex
         if self.name_is_unique:
             n = self.name
         return "<Router %s %s %s>" % (n, self.location.countrycode,
                                       self.policy)
+
+
+tor_countries = LRUDict(10000)
+"""
+The country codes Tor gave (``GETINFO ip-to-country/...``) for IP
+addresses GeoIP couldn't place, by address -- None where Tor couldn't
+either. Kept across consensuses, so each address is asked about once.
+"""
+
+_country_lookups = {}                   # controller -> {ip: [NetLocation, ...]}
+
+
+def _scheduler(controller):
+    """
+    The controller's ``scheduler`` (as TorControlProtocol has), or
+    the reactor for controllers without one: Routers only need
+    ``get_info_raw`` from them.
+    """
+
+    scheduler = getattr(controller, 'scheduler', None)
+    return IReactorTime(reactor if scheduler is None else scheduler)
+
+
+def _ask_tor_for_country(controller, location):
+    """
+    Fills in location.countrycode from Tor: every address asked about
+    during one reactor turn goes in a few multi-key GETINFOs (see
+    _lookup_countries), rather than one GETINFO each.
+    """
+
+    if location.ip in tor_countries:
+        location.countrycode = tor_countries[location.ip]
+        return
+    pending = _country_lookups.get(controller)
+    if pending is None:
+        pending = _country_lookups[controller] = {}
+        _scheduler(controller).callLater(0, _lookup_countries, controller)
+    pending.setdefault(location.ip, []).append(location)
+
+
+def _lookup_countries(controller, chunk=500):
+    "Sends the GETINFOs for the addresses queued by _ask_tor_for_country."
+
+    pending = _country_lookups.pop(controller)
+    ips = pending.keys()
+    for start in xrange(0, len(ips), chunk):
+        _get_countries(controller, pending, ips[start:start + chunk])
+
+
+def _get_countries(controller, pending, ips):
+    d = controller.get_info_raw(*['ip-to-country/' + ip for ip in ips])
+    d.addCallback(_got_countries, pending)
+    d.addErrback(_countries_failed, controller, pending, ips)
+    ## anything else (e.g. the connection went away): these stay
+    ## without a country, and will be asked about again next time
+    d.addErrback(log.err, "looking up router countries")
+    return d
+
+
+def _got_countries(reply, pending):
+    for (key, country) in parse_keywords(reply).items():
+        ip = key[len('ip-to-country/'):]
+        country = country.strip().upper()
+        tor_countries[ip] = country
+        for location in pending.get(ip, ()):
+            location.countrycode = country
+
+
+def _countries_failed(fail, controller, pending, ips):
+    """
+    Tor refuses the whole GETINFO if it can't answer for one of the
+    addresses, so each is asked about on its own; ones it can't answer
+    are remembered (as None) and not asked about again.
+    """
+
+    fail.trap(TorProtocolError)
+    if len(ips) == 1:
+        tor_countries[ips[0]] = None
+        return None
+    for ip in ips:
+        _get_countries(controller, pending, [ip])
+
+
+def _locate(ips):
+    "(in a thread) the NetLocation of each of ips"
+    return [NetLocation(ip) for ip in ips]
+
+
+def resolve_locations(routers, executor=None):
+    """
+    Looks up the :attr:`Router.location` of each of routers that
+    hasn't got one yet, in one go on a worker thread (rather than one
+    at a time on the reactor thread, the first time each is used).
+    Useful before, say, sorting every router by country. The GeoIP
+    readers can only be used by one thread at a time, so the lookups
+    run one after another; this keeps them off the reactor thread,
+    it doesn't make them any faster.
+
+    :param executor: a callable like (and defaulting to)
+        :func:`twisted.internet.threads.deferToThread`, given a
+        function and the list of IP addresses to look up.
+
+    :return: a Deferred that fires (with None) when they all have
+        their location.
+    """
+
+    if executor is None:
+        executor = threads.deferToThread
+    waiting = {}                        # ip -> routers without a location
+    for router in routers:
+        if router._location is None and getattr(router, 'ip', None) is not None:
+            if router.ip in location_cache:
+                router._location = location_cache[router.ip]
+            else:
+                waiting.setdefault(router.ip, []).append(router)
+
+    if not waiting:
+        return defer.succeed(None)
+    d = executor(_locate, waiting.keys())
+    d.addCallback(_located, waiting)
+    return d
+
+
+def _located(locations, waiting):
+    "(on the reactor thread) callback for the locations _locate() found"
+    for location in locations:
+        if location.ip in location_cache:
+            ## something asked for one of these routers meanwhile
+            location = location_cache[location.ip]
+            new = False
+        else:
+            location_cache[location.ip] = location
+            new = True
+        routers = waiting[location.ip]
+        for router in routers:
+            if router._location is None:
+                router._location = location
+        if new:
+            routers[0]._check_country()
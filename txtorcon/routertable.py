@@ -0,0 +1,252 @@
+"""
+A column store of the routers in a consensus; see
+:attr:`txtorcon.TorState.router_table`.
+"""
+
+import array
+import re
+import socket
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from txtorcon.router import FLAG_BITS
+
+
+EXIT_PORTS = (21, 22, 23, 25, 53, 80, 110, 143, 194, 443, 465, 587, 993, 995, 5222, 6667)
+"""The ports summarised in :attr:`RouterTable.exit_ports`: port
+``EXIT_PORTS[n]`` is bit ``1 << n``."""
+
+PORT_BITS = dict((port, 1 << i) for (i, port) in enumerate(EXIT_PORTS))
+"""port -> its bit in :attr:`RouterTable.exit_ports`"""
+
+_asn_re = re.compile(r'AS(\d+)')
+
+
+def _ipv4(ip):
+    "an IPv4 dotted-quad as an int (0 if it isn't one)"
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    except (socket.error, TypeError):
+        return 0
+
+
+def _asn(asn):
+    "the number from a GeoIP ASN ('AS1234 Some Org'), or 0"
+    match = _asn_re.match(asn or '')
+    return int(match.group(1)) if match else 0
+
+
+def _accepts(router, port):
+    "like router.accepts_port(), but False if it has no policy yet"
+    if router.accepted_ports is None and router.rejected_ports is None:
+        return False
+    return router.accepts_port(port)
+
+
+def _port_bits(router):
+    bits = 0
+    for (port, bit) in PORT_BITS.iteritems():
+        if _accepts(router, port):
+            bits |= bit
+    return bits
+
+
+def _column(typecode, values):
+    "a NumPy array if we have NumPy, or an array.array"
+    if numpy is not None:
+        return numpy.array(values, dtype=typecode)
+    return array.array(typecode, values)
+
+
+def _extend(column, typecode, values):
+    "column (from _column) with values added on the end"
+    if numpy is not None:
+        return numpy.concatenate((column, numpy.array(values, dtype=typecode)))
+    column.extend(values)
+    return column
+
+
+## (attribute, array typecode) for each column, in the order
+## RouterTable._values gives them
+_COLUMNS = (('bandwidth', 'l'), ('flag_mask', 'i'), ('country', 'H'),
+            ('asn', 'I'), ('ipv4', 'I'), ('exit_ports', 'H'))
+
+
+class RouterTable(object):
+    """
+    The routers from a consensus as columns -- NumPy arrays if NumPy
+    is installed, :mod:`array` otherwise -- one row per router, so
+    questions about the whole network ("Fast, Stable exits in DE with
+    bandwidth over X allowing port 443") are a few array operations
+    rather than a loop over thousands of :class:`txtorcon.Router`
+    objects. See :meth:`select`, or use the columns directly.
+
+    Row ``n`` is ``routers[n]``. The columns are:
+
+    - ``bandwidth``
+    - ``flag_mask``: :attr:`txtorcon.Router.flag_mask`
+    - ``country``: an index into ``countries`` (0 is unknown)
+    - ``asn``: the AS number (0 if unknown)
+    - ``ipv4``: the address as an integer
+    - ``exit_ports``: bit ``PORT_BITS[port]`` is set for each of
+      :data:`EXIT_PORTS` the router's policy accepts
+
+    Building it looks up every router's
+    :attr:`txtorcon.Router.location`; see
+    :func:`txtorcon.router.resolve_locations` to do that on a worker
+    thread first. A router whose country isn't known yet (GeoIP
+    couldn't place it and Tor's ``ip-to-country`` answer hasn't
+    arrived) is in country 0 until a query by country finds it has
+    one.
+
+    :meth:`update` brings individual rows up to date when routers
+    change.
+    """
+
+    def __init__(self, routers=()):
+        self.routers = []
+        self.countries = [None]
+        self._country_index = {}
+        self._row = {}                  # Router.fingerprint -> row
+        self._unknown_country = set()   # rows to look at again; see _refresh_countries
+        for (name, typecode) in _COLUMNS:
+            setattr(self, name, _column(typecode, []))
+        self.update(routers)
+
+    def _values(self, router):
+        "the column values for router"
+        location = router.location
+        return (router.bandwidth, router.flag_mask, self._country(location.countrycode),
+                _asn(location.asn), _ipv4(router.ip), _port_bits(router))
+
+    def update(self, routers):
+        """
+        Rewrites the rows of routers from their current values, adding
+        rows for any not in the table yet.
+        """
+
+        base = len(self.routers)
+        new = [[] for column in _COLUMNS]
+        for router in routers:
+            if router is None:
+                continue
+            values = self._values(router)
+            row = self._row.get(router.fingerprint)
+            if row is None:
+                row = self._row[router.fingerprint] = len(self.routers)
+                self.routers.append(router)
+                for (column, value) in zip(new, values):
+                    column.append(value)
+            elif row >= base:           # added earlier in this call
+                for (column, value) in zip(new, values):
+                    column[row - base] = value
+            else:
+                self.routers[row] = router
+                for ((name, typecode), value) in zip(_COLUMNS, values):
+                    getattr(self, name)[row] = value
+
+            if router.location.countrycode is None:
+                self._unknown_country.add(row)
+            else:
+                self._unknown_country.discard(row)
+
+        if new[0]:
+            for ((name, typecode), values) in zip(_COLUMNS, new):
+                setattr(self, name, _extend(getattr(self, name), typecode, values))
+
+    def _refresh_countries(self):
+        """
+        Fills in the country of rows whose router had none when the
+        row was written: Tor's ``ip-to-country`` answers arrive later.
+        """
+
+        for row in list(self._unknown_country):
+            code = self.routers[row].location.countrycode
+            if code is not None:
+                self.country[row] = self._country(code)
+                self._unknown_country.discard(row)
+
+    def _country(self, code):
+        "the index in self.countries of code (added if it's new)"
+        if not code:
+            return 0
+        try:
+            return self._country_index[code]
+        except KeyError:
+            self.countries.append(code)
+            index = self._country_index[code] = len(self.countries) - 1
+            return index
+
+    def __len__(self):
+        return len(self.routers)
+
+    def rows(self, flags=(), country=None, min_bandwidth=None, port=None, asn=None):
+        """
+        :return: the (ascending) row numbers of the routers with all of
+            ``flags`` (names, any case), in ``country`` (a country
+            code), with at least ``min_bandwidth``, accepting exits to
+            ``port`` and in AS number ``asn``; each is ignored if it's
+            None (or, for flags, empty).
+
+        A port not in :data:`EXIT_PORTS` is checked with
+        :meth:`txtorcon.Router.accepts_port` on the rows the rest
+        leave.
+        """
+
+        bits = 0
+        for flag in flags:
+            bits |= FLAG_BITS[flag.lower()]
+        if country is not None:
+            self._refresh_countries()
+            country = self._country_index.get(country.upper(), -1)
+
+        if numpy is not None:
+            mask = numpy.ones(len(self.routers), dtype=bool)
+            if bits:
+                mask &= (self.flag_mask & bits) == bits
+            if country is not None:
+                mask &= self.country == country
+            if min_bandwidth is not None:
+                mask &= self.bandwidth >= min_bandwidth
+            if asn is not None:
+                mask &= self.asn == asn
+            if port in PORT_BITS:
+                mask &= (self.exit_ports & PORT_BITS[port]) != 0
+            rows = numpy.flatnonzero(mask).tolist()
+
+        else:
+            rows = xrange(len(self.routers))
+            if bits:
+                column = self.flag_mask
+                rows = [i for i in rows if column[i] & bits == bits]
+            if country is not None:
+                column = self.country
+                rows = [i for i in rows if column[i] == country]
+            if min_bandwidth is not None:
+                column = self.bandwidth
+                rows = [i for i in rows if column[i] >= min_bandwidth]
+            if asn is not None:
+                column = self.asn
+                rows = [i for i in rows if column[i] == asn]
+            if port in PORT_BITS:
+                column = self.exit_ports
+                bit = PORT_BITS[port]
+                rows = [i for i in rows if column[i] & bit]
+            rows = list(rows)
+
+        if port is not None and port not in PORT_BITS:
+            rows = [i for i in rows if _accepts(self.routers[i], port)]
+        return rows
+
+    def select(self, *args, **kwargs):
+        """
+        :return: a list of the :class:`txtorcon.Router` objects in the
+            rows :meth:`rows` finds (it takes the same arguments).
+        """
+
+        routers = self.routers
+        return [routers[i] for i in self.rows(*args, **kwargs)]
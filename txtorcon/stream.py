@@ -11,7 +11,8 @@ to attach streams to circuits "by hand"
 
 from twisted.python import log
 from txtorcon.interface import ICircuitContainer, IStreamListener
-from txtorcon.util import find_keywords, maybe_ip_addr
+from txtorcon.util import maybe_ip_addr
+from txtorcon.events import StreamEvent
 
 
 class Stream(object):
@@ -114,25 +115,24 @@ class Stream(object):
     def unlisten(self, listener):
         self.listeners.remove(listener)
 
-    def _create_flags(self, kw):
-        "this clones the kw dict, adding a lower-case version of every key (duplicated in circuit.py; consider putting in util?)"
-
-        flags = {}
-        for k in kw.keys():
-            flags[k] = kw[k]
-            flags[k.lower()] = flags[k]
-        return flags
-
     def update(self, args):
+        """
+        :param args: a :class:`txtorcon.events.StreamEvent`, or the
+            already-split arguments of a STREAM event.
+        """
         ## print "update",self.id,args
+        if isinstance(args, StreamEvent):
+            event = args
+        else:
+            event = StreamEvent(args=args)
 
         if self.id is None:
-            self.id = int(args[0])
+            self.id = event.id
         else:
-            if self.id != int(args[0]):
+            if self.id != event.id:
                 raise RuntimeError("Update for wrong stream.")
 
-        kw = find_keywords(args)
+        kw = event.keywords
 
         if 'SOURCE_ADDR' in kw:
             last_colon = kw['SOURCE_ADDR'].rfind(':')
@@ -141,12 +141,11 @@ class Stream(object):
                 self.source_addr = maybe_ip_addr(self.source_addr)
             self.source_port = int(kw['SOURCE_ADDR'][last_colon + 1:])
 
-        self.state = args[1]
+        self.state = event.state
         if self.state in ['NEW', 'SUCCEEDED']:
             if self.target_host is None:
-                last_colon = args[3].rfind(':')
-                self.target_host = args[3][:last_colon]
-                self.target_port = int(args[3][last_colon + 1:])
+                self.target_host = event.target_host
+                self.target_port = event.target_port
 
             self.target_port = int(self.target_port)
             if self.state == 'NEW':
@@ -157,22 +156,19 @@ class Stream(object):
                 [x.stream_succeeded(self) for x in self.listeners]
 
         elif self.state == 'REMAP':
-            self.target_addr = maybe_ip_addr(args[3][:args[3].rfind(':')])
+            self.target_addr = maybe_ip_addr(event.target_host)
 
         elif self.state == 'CLOSED':
             if self.circuit:
                 self.circuit.streams.remove(self)
             self.circuit = None
-            flags = self._create_flags(kw)
-            [x.stream_closed(self, **flags) for x in self.listeners]
+            [x.stream_closed(self, **event.flags) for x in self.listeners]
 
         elif self.state == 'FAILED':
             if self.circuit:
                 self.circuit.streams.remove(self)
             self.circuit = None
-            # build lower-case version of all flags
-            flags = self._create_flags(kw)
-            [x.stream_failed(self, **flags) for x in self.listeners]
+            [x.stream_failed(self, **event.flags) for x in self.listeners]
 
         elif self.state == 'SENTCONNECT':
             pass  # print 'SENTCONNECT',self,args
@@ -182,8 +178,7 @@ class Stream(object):
                 self.circuit.streams.remove(self)
                 self.circuit = None
 
-            flags = self._create_flags(kw)
-            [x.stream_detach(self, **flags) for x in self.listeners]
+            [x.stream_detach(self, **event.flags) for x in self.listeners]
 
         elif self.state == 'NEWRESOLVE':
             pass  # print 'NEWRESOLVE',self,args
@@ -199,7 +194,7 @@ class Stream(object):
         ## we don't immediately re-add the circuit we just detached
         ## from
         if self.state not in ['CLOSED', 'FAILED', 'DETACHED']:
-            cid = int(args[2])
+            cid = event.circuit_id
             if cid == 0:
                 if self.circuit and self in self.circuit.streams:
                     self.circuit.streams.remove(self)
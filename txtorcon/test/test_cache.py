@@ -0,0 +1,197 @@
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import defer, task
+
+from txtorcon import TorControlProtocol
+from txtorcon.torcontrolprotocol import Event
+from txtorcon.cache import ResponseCache
+
+
+class ResponseCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = ResponseCache(self.clock)
+        self.issued = []
+
+    def issue(self):
+        d = defer.Deferred()
+        self.issued.append(d)
+        return d
+
+    def test_ttl_classes(self):
+        self.assertEqual(self.cache.ttl('GETINFO', ['version']), None)
+        self.assertEqual(self.cache.ttl('GETINFO', ['config/names']), None)
+        self.assertEqual(self.cache.ttl('GETINFO', ['traffic/read']), 0)
+        self.assertEqual(self.cache.ttl('GETINFO', ['ns/all']), self.cache.default_ttl)
+        self.assertEqual(self.cache.ttl('GETINFO', ['version', 'traffic/read']), 0)
+        self.assertEqual(self.cache.ttl('GETINFO', ['version', 'ns/all']), self.cache.default_ttl)
+        self.assertEqual(self.cache.ttl('GETCONF', ['SocksPort']), self.cache.default_ttl)
+
+    def test_static_hit(self):
+        d0 = self.cache.fetch('GETINFO', ['version'], self.issue)
+        self.issued[0].callback('version=0.2.4')
+        self.assertEqual(d0.result, 'version=0.2.4')
+
+        self.clock.advance(10000)
+        d1 = self.cache.fetch('GETINFO', ['version'], self.issue)
+        self.assertEqual(len(self.issued), 1)
+        self.assertEqual(d1.result, 'version=0.2.4')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_volatile_not_stored(self):
+        self.cache.fetch('GETINFO', ['traffic/read'], self.issue)
+        self.issued[0].callback('traffic/read=1')
+        d = self.cache.fetch('GETINFO', ['traffic/read'], self.issue)
+        self.assertEqual(len(self.issued), 2)
+        self.issued[1].callback('traffic/read=2')
+        self.assertEqual(d.result, 'traffic/read=2')
+
+    def test_expiry(self):
+        self.cache.fetch('GETINFO', ['ns/all'], self.issue)
+        self.issued[0].callback('ns')
+        self.clock.advance(self.cache.default_ttl - 1)
+        self.cache.fetch('GETINFO', ['ns/all'], self.issue)
+        self.assertEqual(len(self.issued), 1)
+        self.clock.advance(1)
+        self.cache.fetch('GETINFO', ['ns/all'], self.issue)
+        self.assertEqual(len(self.issued), 2)
+        self.assertEqual(self.cache.entries, {})
+
+    def test_in_flight_shared(self):
+        d0 = self.cache.fetch('GETINFO', ['traffic/read'], self.issue)
+        d1 = self.cache.fetch('GETINFO', ['traffic/read'], self.issue)
+        self.assertEqual(len(self.issued), 1)
+        self.assertFalse(d0.called or d1.called)
+        self.issued[0].callback('traffic/read=1')
+        self.assertEqual(d0.result, 'traffic/read=1')
+        self.assertEqual(d1.result, 'traffic/read=1')
+
+    def test_in_flight_error_shared(self):
+        d0 = self.cache.fetch('GETINFO', ['version'], self.issue)
+        d1 = self.cache.fetch('GETINFO', ['version'], self.issue)
+        self.issued[0].errback(RuntimeError('oops'))
+        self.assertFailure(d0, RuntimeError)
+        self.assertFailure(d1, RuntimeError)
+        self.assertEqual(self.cache.entries, {})
+        return defer.DeferredList([d0, d1])
+
+    def test_conf_changed(self):
+        self.cache.fetch('GETCONF', ['SocksPort'], self.issue)
+        self.cache.fetch('GETINFO', ['config-file'], self.issue)
+        self.cache.fetch('GETINFO', ['version'], self.issue)
+        for d in self.issued:
+            d.callback('foo')
+        self.assertEqual(len(self.cache.entries), 3)
+        self.cache.conf_changed('SocksPort=9050')
+        self.assertEqual(self.cache.entries.keys(), [('GETINFO', 'version')])
+
+    def test_new_consensus(self):
+        self.cache.fetch('GETINFO', ['ns/all'], self.issue)
+        self.cache.fetch('GETINFO', ['version'], self.issue)
+        for d in self.issued:
+            d.callback('foo')
+        self.cache.new_consensus('')
+        self.assertEqual(self.cache.entries.keys(), [('GETINFO', 'version')])
+
+    def test_invalidated_while_in_flight(self):
+        d = self.cache.fetch('GETCONF', ['SocksPort'], self.issue)
+        self.cache.conf_changed()
+        self.issued[0].callback('SocksPort=9050')
+        self.assertEqual(d.result, 'SocksPort=9050')
+        self.assertEqual(self.cache.entries, {})
+
+    def test_clear(self):
+        self.cache.fetch('GETINFO', ['version'], self.issue)
+        self.issued[0].callback('version=0.2.4')
+        self.cache.clear()
+        self.cache.fetch('GETINFO', ['version'], self.issue)
+        self.assertEqual(len(self.issued), 2)
+
+
+class ProtocolCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.protocol.scheduler = task.Clock()
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.cache = self.protocol.enable_cache()
+
+    def send(self, line):
+        self.protocol.dataReceived(line.strip() + "\r\n")
+
+    def test_enable_twice(self):
+        self.assertTrue(self.protocol.enable_cache() is self.cache)
+
+    def test_get_info_shared(self):
+        d0 = self.protocol.get_info('version')
+        d1 = self.protocol.get_info('version')
+        self.assertEqual(self.transport.value(), 'GETINFO version\r\n')
+        self.send('250-version=0.2.4')
+        self.send('250 OK')
+        self.assertEqual(d0.result, {'version': '0.2.4'})
+        self.assertEqual(d1.result, {'version': '0.2.4'})
+
+        d2 = self.protocol.get_info('version')
+        self.assertEqual(self.transport.value(), 'GETINFO version\r\n')
+        self.assertEqual(d2.result, {'version': '0.2.4'})
+
+    def test_set_conf_invalidates(self):
+        self.protocol.get_conf('SocksPort')
+        self.send('250 SocksPort=9050')
+        self.protocol.set_conf('SocksPort', '9051')
+        self.send('250 OK')
+        self.transport.clear()
+        self.protocol.get_conf('SocksPort')
+        self.assertEqual(self.transport.value(), 'GETCONF SocksPort\r\n')
+
+    def test_events_invalidate(self):
+        for name in ['CONF_CHANGED', 'NEWCONSENSUS']:
+            self.protocol.valid_events[name] = Event(name)
+        self.protocol.post_bootstrap.callback(self.protocol)
+        self.send('250 OK')
+        self.send('250 OK')
+        self.assertEqual(self.transport.value().count('SETEVENTS'), 2)
+
+        self.transport.clear()
+        self.protocol.get_conf('SocksPort')
+        self.send('250 SocksPort=9050')
+        self.send('650-CONF_CHANGED')
+        self.send('650-SocksPort=9051')
+        self.send('650 OK')
+        self.protocol.get_conf('SocksPort')
+        self.assertEqual(self.transport.value(), 'GETCONF SocksPort\r\nGETCONF SocksPort\r\n')
+
+    def test_enable_after_bootstrap(self):
+        protocol = TorControlProtocol()
+        protocol.connectionMade = lambda: None
+        protocol.scheduler = task.Clock()
+        protocol.makeConnection(self.transport)
+        for name in ['CONF_CHANGED', 'NEWCONSENSUS']:
+            protocol.valid_events[name] = Event(name)
+        ## what _bootstrap leaves behind
+        protocol.post_bootstrap.callback(protocol)
+        protocol.post_bootstrap = None
+
+        self.transport.clear()
+        cache = protocol.enable_cache()
+        self.assertEqual(self.transport.value(), 'SETEVENTS CONF_CHANGED\r\n')
+        protocol.dataReceived('250 OK\r\n')
+        self.assertEqual(self.transport.value().count('SETEVENTS'), 2)
+        protocol.dataReceived('250 OK\r\n')
+
+        protocol.get_conf('SocksPort')
+        protocol.dataReceived('250 SocksPort=9050\r\n')
+        self.assertEqual(len(cache.entries), 1)
+        protocol.dataReceived('650-CONF_CHANGED\r\n650-SocksPort=9051\r\n650 OK\r\n')
+        self.assertEqual(cache.entries, {})
+
+    def test_reconnect_clears(self):
+        self.protocol.get_info('version')
+        self.send('250-version=0.2.4')
+        self.send('250 OK')
+        self.assertEqual(len(self.cache.entries), 1)
+        TorControlProtocol.connectionMade(self.protocol)
+        self.assertEqual(self.cache.entries, {})
@@ -0,0 +1,229 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+from txtorcon.events import TorEvent, CircEvent, StreamEvent, AddrMapEvent, event_class
+from txtorcon.events import EventBatcher, EventQueue, event_key
+
+
+class EventTests(unittest.TestCase):
+
+    def test_lazy(self):
+        e = CircEvent('1 BUILT $E11D2B2269CC25E67CA6C9FB5843497539A74FD0=eris PURPOSE=GENERAL')
+        self.assertEqual(e._args, None)
+        self.assertEqual(e._keywords, None)
+        self.assertEqual(e.id, 1)
+        self.assertTrue(e._args is not None)
+        self.assertEqual(e._keywords, None)
+        self.assertEqual(e.purpose, 'GENERAL')
+        self.assertTrue(e.keywords is e.keywords)
+
+    def test_slots(self):
+        e = StreamEvent('1 NEW 0 www.example.com:80')
+        self.assertRaises(AttributeError, setattr, e, 'foo', 1)
+        self.assertFalse(hasattr(e, '__dict__'))
+
+    def test_circ(self):
+        e = CircEvent('1 EXTENDED $E11D2B2269CC25E67CA6C9FB5843497539A74FD0=eris,$50DD343021E509EB3A5A7FD0D8A4F8364AFBDCB5=venus BUILD_FLAGS=IS_INTERNAL,NEED_CAPACITY PURPOSE=GENERAL')
+        self.assertEqual(e.state, 'EXTENDED')
+        self.assertEqual(len(e.path), 2)
+        self.assertEqual(e.path[1], '$50DD343021E509EB3A5A7FD0D8A4F8364AFBDCB5=venus')
+        self.assertEqual(e.build_flags, ['IS_INTERNAL', 'NEED_CAPACITY'])
+        ## $hexid=name aren't keywords
+        self.assertEqual(sorted(e.keywords.keys()), ['BUILD_FLAGS', 'PURPOSE'])
+
+    def test_circ_no_path(self):
+        e = CircEvent('1 LAUNCHED PURPOSE=GENERAL')
+        self.assertEqual(e.path, [])
+        self.assertEqual(e.build_flags, [])
+
+    def test_quoted_keyword(self):
+        e = CircEvent('1 BUILT $E11D2B2269CC25E67CA6C9FB5843497539A74FD0=eris SOCKS_USERNAME="a \\"user\\"" REASON=FINISHED')
+        self.assertEqual(e.keywords['SOCKS_USERNAME'], 'a "user"')
+        self.assertEqual(e.flags['reason'], 'FINISHED')
+        self.assertTrue(e.flags is e.flags)
+
+    def test_from_args(self):
+        e = CircEvent(args=['1', 'BUILT'])
+        self.assertEqual(e.state, 'BUILT')
+        self.assertEqual(str(e), '1 BUILT')
+
+    def test_stream(self):
+        e = StreamEvent('4 SUCCEEDED 12 [::1]:443 SOURCE_ADDR=127.0.0.1:1234')
+        self.assertEqual(e.id, 4)
+        self.assertEqual(e.circuit_id, 12)
+        self.assertEqual(e.target_host, '[::1]')
+        self.assertEqual(e.target_port, 443)
+        self.assertEqual(e.keywords['SOURCE_ADDR'], '127.0.0.1:1234')
+
+    def test_addrmap(self):
+        e = AddrMapEvent('www.example.com 127.0.0.1 "2013-01-01 00:00:00" EXPIRES="2013-01-01 00:00:00"')
+        self.assertEqual(e.hostname, 'www.example.com')
+        self.assertEqual(e.address, '127.0.0.1')
+        self.assertEqual(len(e.args), 4)
+        self.assertEqual(e.keywords['EXPIRES'], '2013-01-01 00:00:00')
+
+    def test_generic(self):
+        cls = event_class('STATUS_CLIENT')
+        self.assertTrue(issubclass(cls, TorEvent))
+        self.assertTrue(event_class('STATUS_CLIENT') is cls)
+        self.assertEqual(cls.__name__, 'StatusClientEvent')
+        e = cls('NOTICE CIRCUIT_ESTABLISHED')
+        self.assertEqual(e.name, 'STATUS_CLIENT')
+        self.assertEqual(e.args, ['NOTICE', 'CIRCUIT_ESTABLISHED'])
+        self.assertEqual(repr(e), '<StatusClientEvent NOTICE CIRCUIT_ESTABLISHED>')
+
+    def test_registered(self):
+        self.assertTrue(event_class('CIRC') is CircEvent)
+        self.assertTrue(event_class('STREAM') is StreamEvent)
+        self.assertTrue(event_class('ADDRMAP') is AddrMapEvent)
+
+
+class BatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.batches = []
+
+    def test_per_turn(self):
+        b = EventBatcher(self.batches.append, self.clock)
+        b('1 NEW')
+        b('2 NEW')
+        self.assertEqual(self.batches, [])
+        self.clock.advance(0)
+        self.assertEqual(self.batches, [['1 NEW', '2 NEW']])
+        self.clock.advance(10)
+        self.assertEqual(len(self.batches), 1)
+
+    def test_window(self):
+        b = EventBatcher(self.batches.append, self.clock, interval=0.05)
+        b('1 NEW')
+        self.clock.advance(0.04)
+        b('2 NEW')
+        self.assertEqual(self.batches, [])
+        self.clock.advance(0.01)
+        self.assertEqual(self.batches, [['1 NEW', '2 NEW']])
+        b('3 NEW')
+        self.clock.advance(0.05)
+        self.assertEqual(self.batches[1], ['3 NEW'])
+
+    def test_collapse(self):
+        b = EventBatcher(self.batches.append, self.clock, collapse=event_key)
+        b(CircEvent('1 LAUNCHED'))
+        b('2 LAUNCHED')
+        b(CircEvent('1 EXTENDED'))
+        b(CircEvent('1 BUILT'))
+        self.clock.advance(0)
+        self.assertEqual([str(e) for e in self.batches[0]], ['1 BUILT', '2 LAUNCHED'])
+
+        b(CircEvent('1 CLOSED'))
+        self.clock.advance(0)
+        self.assertEqual([str(e) for e in self.batches[1]], ['1 CLOSED'])
+
+    def test_flush(self):
+        b = EventBatcher(self.batches.append, self.clock, interval=1)
+        b('1 NEW')
+        b.flush()
+        self.assertEqual(self.batches, [['1 NEW']])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        b.flush()
+        self.assertEqual(len(self.batches), 1)
+
+    def test_equals_callback(self):
+        b = EventBatcher(self.batches.append, self.clock)
+        self.assertEqual(b, self.batches.append)
+        self.assertTrue(self.batches.append in [b])
+        self.assertNotEqual(b, self.batches.remove)
+
+
+class FakeProducer(object):
+    def __init__(self):
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class QueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.got = []
+
+    def test_delivered_later(self):
+        q = EventQueue(self.got.append, self.clock, 10)
+        q('1 NEW')
+        q('2 NEW')
+        self.assertEqual(self.got, [])
+        self.assertEqual(len(q), 2)
+        self.clock.advance(0)
+        self.assertEqual(self.got, ['1 NEW', '2 NEW'])
+        self.assertEqual(q.max_depth, 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_drop_oldest(self):
+        q = EventQueue(self.got.append, self.clock, 2)
+        for i in range(5):
+            q('%d NEW' % i)
+        self.clock.advance(0)
+        self.assertEqual(self.got, ['3 NEW', '4 NEW'])
+        self.assertEqual(q.dropped, 3)
+        self.assertEqual(q.max_depth, 2)
+
+    def test_coalesce(self):
+        q = EventQueue(self.got.append, self.clock, 2, 'coalesce')
+        q('1 LAUNCHED')
+        q('2 LAUNCHED')
+        q('1 BUILT')
+        self.assertEqual(q.coalesced, 1)
+        q('3 LAUNCHED')
+        self.assertEqual(q.dropped, 1)
+        q('1 CLOSED')
+        self.clock.advance(0)
+        self.assertEqual(self.got, ['3 LAUNCHED', '1 CLOSED'])
+        self.assertEqual(q.dropped, 2)
+
+        q('3 CLOSED')
+        self.clock.advance(0)
+        self.assertEqual(self.got[-1], '3 CLOSED')
+
+    def test_block(self):
+        producer = FakeProducer()
+        q = EventQueue(self.got.append, self.clock, 2, 'block', producer)
+        q('1 NEW')
+        q('2 NEW')
+        self.assertFalse(producer.paused)
+        q('3 NEW')
+        self.assertTrue(producer.paused)
+        self.assertEqual(q.dropped, 0)
+        self.assertEqual(q.max_depth, 3)
+        self.clock.advance(0)
+        self.assertFalse(producer.paused)
+        self.assertEqual(len(self.got), 3)
+
+    def test_listener_error(self):
+        def broken(event):
+            raise RuntimeError("oops")
+        q = EventQueue(broken, self.clock, 10)
+        q('1 NEW')
+        q('2 NEW')
+        self.clock.advance(0)
+        self.assertEqual(q.errors, 2)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 2)
+
+    def test_arrivals_during_drain(self):
+        def listener(event):
+            self.got.append(event)
+            if len(self.got) == 1:
+                q('2 NEW')
+                self.assertEqual(len(self.got), 1)
+        q = EventQueue(listener, self.clock, 10)
+        q('1 NEW')
+        self.clock.advance(0)
+        self.assertEqual(self.got, ['1 NEW', '2 NEW'])
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, EventQueue, self.got.append, self.clock, 1, 'foo')
+        self.assertRaises(ValueError, EventQueue, self.got.append, self.clock, 1, 'block')
@@ -0,0 +1,159 @@
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.test import iosim
+
+from txtorcon import TorControlProtocol, TorState
+from txtorcon.faketor import FakeTor
+
+
+class FakeTorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.tor = FakeTor(routers=50, circuits=3, password='foo', clock=self.clock)
+
+    def connect(self, protocol):
+        server = self.tor.factory().buildProtocol(None)
+        self.pump = iosim.connect(server, iosim.FakeTransport(server, True),
+                                  protocol, iosim.FakeTransport(protocol, False))
+        self.pump.flush()
+        return server
+
+    def test_consensus(self):
+        lines = self.tor.ns_all()
+        self.assertEqual(len(lines), 4 * 50)
+        self.assertEqual(lines[0].split()[1], 'fake00000')
+        self.assertEqual(FakeTor(routers=50).ns_all(), lines)
+
+    def test_bootstrap_state(self):
+        protocol = TorControlProtocol(password_function=lambda: 'foo')
+        state = TorState(protocol)
+        self.connect(protocol)
+        self.pump.flush()
+
+        self.assertTrue(state.post_bootstrap.called)
+        self.assertEqual(protocol.version, '0.2.4.10-alpha (fake)')
+        self.assertEqual(len(set(state.routers.values())), 50)
+        self.assertEqual(sorted(state.circuits.keys()), [1, 2, 3])
+        self.assertEqual(len(state.circuits[1].path), 3)
+
+    def test_bad_password(self):
+        protocol = TorControlProtocol(password_function=lambda: 'bar')
+        protocol.post_bootstrap.addErrback(lambda f: None)
+        self.connect(protocol)
+        self.pump.flush()
+        self.assertEqual(self.tor.connections, [])
+
+    def test_unauthenticated(self):
+        protocol = TorControlProtocol()
+        protocol.connectionMade = lambda: None
+        self.connect(protocol)
+        d = protocol.get_info_raw('version')
+        self.pump.flush()
+        return self.assertFailure(d, Exception)
+
+    def authenticated(self):
+        protocol = TorControlProtocol()
+        protocol.connectionMade = lambda: None
+        self.connect(protocol)
+        protocol.authenticate('foo')
+        protocol._set_valid_events('CIRC STREAM ADDRMAP CONF_CHANGED')
+        self.pump.flush()
+        return protocol
+
+    def test_getinfo(self):
+        protocol = self.authenticated()
+        router = self.tor.routers[7]
+        results = []
+        protocol.get_info('ip-to-country/1.2.3.4').addCallback(results.append)
+        protocol.get_info_raw('ns/id/' + router.id_hex[1:]).addCallback(results.append)
+        self.pump.flush()
+        self.assertEqual(results[0], {'ip-to-country/1.2.3.4': self.tor.country('1.2.3.4')})
+        self.assertTrue(' fake00007 ' in results[1])
+
+    def test_unknown_getinfo(self):
+        protocol = self.authenticated()
+        d = protocol.get_info_raw('foo/bar')
+        self.pump.flush()
+        return self.assertFailure(d, Exception)
+
+    def test_setconf(self):
+        protocol = self.authenticated()
+        changes = []
+        protocol.add_event_listener('CONF_CHANGED', changes.append)
+        results = []
+        protocol.set_conf('SocksPort', '9999')
+        protocol.get_conf('SocksPort').addCallback(results.append)
+        self.pump.flush()
+        self.assertEqual(results, [{'SocksPort': '9999'}])
+        self.assertEqual(changes, ['SocksPort=9999\nOK'])
+
+    def test_generated_events(self):
+        protocol = self.authenticated()
+        circ = []
+        stream = []
+        addrmap = []
+        protocol.add_event_listener('CIRC', circ.append)
+        protocol.add_event_listener('STREAM', stream.append)
+        protocol.add_event_listener('ADDRMAP', addrmap.append)
+        self.pump.flush()
+
+        self.tor.start_events(circ=100, stream=200, addrmap=10)
+        for i in range(100):
+            self.clock.advance(0.01)
+        self.pump.flush()
+        self.tor.stop_events()
+
+        self.assertEqual(len(circ), 100)
+        self.assertEqual(len(stream), 200)
+        self.assertEqual(len(addrmap), 10)
+        self.assertEqual(circ[0].split()[1], 'LAUNCHED')
+        self.assertTrue(stream[0].split()[1], 'NEW')
+        self.assertEqual(self.tor.events_sent['STREAM'], 200)
+
+    def test_state_follows_events(self):
+        protocol = TorControlProtocol(password_function=lambda: 'foo')
+        state = TorState(protocol)
+        self.connect(protocol)
+        self.pump.flush()
+
+        self.tor.start_events(circ=50, stream=50)
+        for i in range(100):
+            self.clock.advance(0.01)
+            self.pump.flush()
+        self.tor.stop_events()
+        self.assertEqual(sorted(state.circuits.keys()), sorted(self.tor.circuits.keys()))
+        self.assertEqual(sorted(state.streams.keys()), sorted(self.tor.streams.keys()))
+
+    def test_attach_stream(self):
+        protocol = self.authenticated()
+        self.tor.config['__LeaveStreamsUnattached'] = '1'
+        stream = []
+        protocol.add_event_listener('STREAM', stream.append)
+        self.pump.flush()
+        self.tor.start_events(stream=100)
+        self.clock.advance(0.01)
+        self.tor.stop_events()
+        self.pump.flush()
+        self.assertEqual(stream, ['1 NEW 0 %s SOURCE_ADDR=127.0.0.1:10001 PURPOSE=USER' % self.tor.streams[1][2]])
+
+        protocol.queue_command('ATTACHSTREAM 1 2')
+        self.pump.flush()
+        self.assertEqual([s.split()[1:3] for s in stream[1:]],
+                         [['SENTCONNECT', '2'], ['SUCCEEDED', '2'], ['CLOSED', '2']])
+        self.assertEqual(self.tor.streams, {})
+
+    def test_extend_and_close_circuit(self):
+        protocol = self.authenticated()
+        circ = []
+        protocol.add_event_listener('CIRC', circ.append)
+        results = []
+        protocol.queue_command('EXTENDCIRCUIT 0 fake00001,fake00002').addCallback(results.append)
+        self.pump.flush()
+        self.assertEqual(results, ['EXTENDED 4'])
+        self.assertEqual(circ[-1].split()[:2], ['4', 'BUILT'])
+
+        protocol.queue_command('CLOSECIRCUIT 4')
+        self.pump.flush()
+        self.assertEqual(circ[-1].split()[:2], ['4', 'CLOSED'])
+        self.assertTrue(4 not in self.tor.circuits)
@@ -0,0 +1,73 @@
+import json
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from txtorcon.metrics import Histogram, ProtocolMetrics
+
+
+class HistogramTests(unittest.TestCase):
+
+    def test_empty(self):
+        h = Histogram()
+        self.assertEqual(h.mean(), 0)
+        self.assertEqual(h.percentile(50), 0)
+
+    def test_add(self):
+        h = Histogram([1, 2, 4, 8])
+        for v in [0.5, 1.5, 3, 3, 100]:
+            h.add(v)
+        self.assertEqual(h.counts, [1, 1, 2, 0, 1])
+        self.assertEqual(h.count, 5)
+        self.assertEqual(h.max, 100)
+        self.assertEqual(h.mean(), 108 / 5.0)
+
+    def test_percentile(self):
+        h = Histogram([1, 2, 4, 8])
+        for v in [0.5, 1.5, 3, 3, 100]:
+            h.add(v)
+        self.assertEqual(h.percentile(20), 1)
+        self.assertEqual(h.percentile(50), 4)
+        self.assertEqual(h.percentile(99), 100)
+
+    def test_percentile_capped_at_max(self):
+        h = Histogram([1, 2, 4, 8])
+        h.add(0.1)
+        self.assertEqual(h.percentile(50), 0.1)
+
+
+class ProtocolMetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = ProtocolMetrics(self.clock)
+
+    def test_events_per_second(self):
+        self.assertEqual(self.metrics.events_per_second(), {})
+        for i in range(10):
+            self.metrics.event_delivered('CIRC', 0.001)
+        self.assertEqual(self.metrics.events_per_second(), {'CIRC': 0.0})
+        self.clock.advance(2)
+        self.assertEqual(self.metrics.events_per_second(), {'CIRC': 5.0})
+        self.assertEqual(self.metrics.callback_time['CIRC'].count, 10)
+
+    def test_reset(self):
+        self.metrics.command_sent('GETINFO', 1)
+        self.metrics.bytes_received = 10
+        self.clock.advance(5)
+        self.metrics.reset()
+        self.assertEqual(self.metrics.queue_wait, {})
+        self.assertEqual(self.metrics.bytes_received, 0)
+        self.assertEqual(self.metrics.started, 5)
+
+    def test_as_dict_json(self):
+        self.metrics.command_queued(0)
+        self.metrics.command_sent('GETINFO', 0.5)
+        self.metrics.command_answered('GETINFO', 0.25)
+        self.metrics.event_delivered('STREAM', 0.001)
+        self.clock.advance(1)
+        d = json.loads(json.dumps(self.metrics.as_dict()))
+        self.assertEqual(d['wire_time']['GETINFO']['count'], 1)
+        self.assertEqual(d['queue_wait']['GETINFO']['max'], 0.5)
+        self.assertEqual(d['events'], {'STREAM': 1})
+        self.assertEqual(d['events_per_second'], {'STREAM': 1.0})
@@ -1,7 +1,11 @@
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, task
 
-from txtorcon.router import Router, hexIdFromHash, hashFromHexId
+from txtorcon import router as router_module
+from txtorcon.router import Router, hexIdFromHash, hashFromHexId, FLAG_BITS
+from txtorcon.router import resolve_locations, tor_countries
+from txtorcon.torcontrolprotocol import TorProtocolError
+from txtorcon.util import location_cache
 
 
 class FakeController(object):
@@ -58,6 +62,36 @@ class RouterTests(unittest.TestCase):
         router.flags = "Exit Fast Named Running V2Dir Valid".split()
         self.assertEqual(router.name_is_unique, True)
 
+    def test_fingerprint(self):
+        router = Router(object())
+        self.assertEqual(router.id_hex, None)
+        router.update("foo",
+                      "AHhuQ8zFQJdT8l42Axxc6m6kNwI",
+                      "MAANkj30tnFvmoh7FsjVFr+cmcs",
+                      "2011-12-16 15:11:34",
+                      "77.183.225.114",
+                      "24051", "24052")
+        self.assertEqual(router.fingerprint, '00786E43CCC5409753F25E36031C5CEA6EA43702'.decode('hex'))
+        self.assertEqual(router.id_hash, "AHhuQ8zFQJdT8l42Axxc6m6kNwI")
+        self.assertEqual(router.or_hash, "MAANkj30tnFvmoh7FsjVFr+cmcs")
+        router.id_hex = '$0000000000000000000000000000000000000001'
+        self.assertEqual(router.fingerprint, '\x00' * 19 + '\x01')
+
+        router.id_hash = 'AHhuQ8zFQJdT8l42Axxc6m6kNwI'
+        router.or_hash = 'AHhuQ8zFQJdT8l42Axxc6m6kNwI'
+        self.assertEqual(router.id_hex, "$00786E43CCC5409753F25E36031C5CEA6EA43702")
+        self.assertEqual(router.or_hash, 'AHhuQ8zFQJdT8l42Axxc6m6kNwI')
+        self.assertFalse(hasattr(router, '__dict__'))
+
+    def test_flag_mask(self):
+        router = Router(object())
+        router.flags = "Exit Fast Running Valid Unheardof"
+        self.assertEqual(router.flag_mask,
+                         FLAG_BITS['exit'] | FLAG_BITS['fast'] | FLAG_BITS['running'] | FLAG_BITS['valid'])
+        ## unknown flags are kept (after the known ones)
+        self.assertEqual(router.flags, ['exit', 'fast', 'running', 'valid', 'unheardof'])
+        self.assertEqual(router.name_is_unique, False)
+
     def test_flags_from_string(self):
         controller = object()
         router = Router(controller)
@@ -143,3 +177,176 @@ class RouterTests(unittest.TestCase):
     def test_repr_no_update(self):
         router = Router(FakeController())
         repr(router)
+
+
+class FakeLocation(object):
+    "a NetLocation that GeoIP didn't find a country for"
+    lookups = []
+
+    def __init__(self, ip):
+        self.lookups.append(ip)
+        self.ip = ip
+        self.countrycode = None
+
+
+class CountingController(object):
+    def __init__(self):
+        self.scheduler = task.Clock()
+        self.asked = []
+        self.fail = set()               # keys to refuse
+
+    def get_info_raw(self, *keys):
+        self.asked.append(keys)
+        if self.fail.intersection(keys):
+            return defer.fail(TorProtocolError(552, 'Unrecognized key'))
+        return defer.succeed('\n'.join('%s=xx' % key for key in keys) + '\nOK')
+
+
+class LocationTests(unittest.TestCase):
+
+    def setUp(self):
+        FakeLocation.lookups = []
+        self.patch(router_module, 'NetLocation', FakeLocation)
+        self.patch(location_cache, 'maxsize', location_cache.maxsize)
+        location_cache.clear()
+        self.addCleanup(location_cache.clear)
+        tor_countries.clear()
+        self.addCleanup(tor_countries.clear)
+        self.controller = CountingController()
+
+    def router(self, ip):
+        router = Router(self.controller)
+        router.update("foo", "AHhuQ8zFQJdT8l42Axxc6m6kNwI", "MAANkj30tnFvmoh7FsjVFr+cmcs",
+                      "2011-12-16 15:11:34", ip, "24051", "24052")
+        return router
+
+    def test_lazy(self):
+        router = self.router('1.2.3.4')
+        self.assertEqual(FakeLocation.lookups, [])
+        self.assertEqual(self.controller.asked, [])
+
+        self.assertEqual(router.location.countrycode, None)
+        self.controller.scheduler.advance(0)
+        self.assertEqual(router.location.countrycode, 'XX')
+        self.assertEqual(FakeLocation.lookups, ['1.2.3.4'])
+        self.assertEqual(self.controller.asked, [('ip-to-country/1.2.3.4',)])
+
+    def test_shared(self):
+        a = self.router('1.2.3.4')
+        b = self.router('1.2.3.4')
+        self.assertTrue(a.location is b.location)
+        self.assertEqual(FakeLocation.lookups, ['1.2.3.4'])
+        self.controller.scheduler.advance(0)
+        self.assertEqual(len(self.controller.asked), 1)
+
+    def test_update_forgets(self):
+        router = self.router('1.2.3.4')
+        router.location
+        router.update("foo", "AHhuQ8zFQJdT8l42Axxc6m6kNwI", "MAANkj30tnFvmoh7FsjVFr+cmcs",
+                      "2011-12-16 15:11:34", '5.6.7.8', "24051", "24052")
+        self.assertEqual(router.location.ip, '5.6.7.8')
+
+    def test_bounded(self):
+        location_cache.maxsize = 2
+        for ip in ['1.1.1.1', '2.2.2.2', '3.3.3.3']:
+            self.router(ip).location
+        self.assertEqual(list(location_cache), ['2.2.2.2', '3.3.3.3'])
+        self.router('1.1.1.1').location
+        self.assertEqual(FakeLocation.lookups, ['1.1.1.1', '2.2.2.2', '3.3.3.3', '1.1.1.1'])
+
+    def test_resolve_locations(self):
+        calls = []
+
+        def executor(fn, ips):
+            calls.append(ips)
+            return defer.succeed(fn(ips))
+
+        cached = self.router('9.9.9.9')
+        cached.location
+        routers = [self.router(ip) for ip in ['1.1.1.1', '2.2.2.2', '1.1.1.1', '3.3.3.3', '9.9.9.9']]
+        d = resolve_locations(routers, executor=executor)
+        self.assertEqual(self.successResultOf(d), None)
+        self.controller.scheduler.advance(0)
+
+        ## one worker call, for the addresses not already cached
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(calls[0]), ['1.1.1.1', '2.2.2.2', '3.3.3.3'])
+        self.assertTrue(routers[0].location is routers[2].location)
+        self.assertTrue(routers[4].location is cached.location)
+        for router in routers:
+            self.assertEqual(router.location.countrycode, 'XX')
+        ## one lookup, and one ip-to-country, per address
+        self.assertEqual(sorted(FakeLocation.lookups), ['1.1.1.1', '2.2.2.2', '3.3.3.3', '9.9.9.9'])
+        self.assertEqual(sorted(sum(self.controller.asked, ())),
+                         ['ip-to-country/%s' % ip for ip in ['1.1.1.1', '2.2.2.2', '3.3.3.3', '9.9.9.9']])
+
+    def test_resolve_locations_nothing_to_do(self):
+        router = self.router('1.1.1.1')
+        router.location
+        d = resolve_locations([router], executor=lambda fn, ips: self.fail("executor used"))
+        self.assertEqual(self.successResultOf(d), None)
+
+    def test_resolve_locations_failure(self):
+        d = resolve_locations([self.router('1.1.1.1')],
+                              executor=lambda fn, ips: defer.fail(RuntimeError("oops")))
+        self.failureResultOf(d)
+
+    def test_countries_batched(self):
+        routers = [self.router('10.0.%d.%d' % (i // 256, i % 256)) for i in range(1200)]
+        for router in routers:
+            router.location
+        self.assertEqual(self.controller.asked, [])
+
+        self.controller.scheduler.advance(0)
+        self.assertEqual(sorted(len(keys) for keys in self.controller.asked), [200, 500, 500])
+        for router in routers:
+            self.assertEqual(router.location.countrycode, 'XX')
+        self.assertEqual(tor_countries['10.0.0.1'], 'XX')
+
+    def test_countries_cached(self):
+        self.router('1.2.3.4').location
+        self.controller.scheduler.advance(0)
+        location_cache.clear()          # e.g. a new consensus, much later
+
+        router = self.router('1.2.3.4')
+        self.assertEqual(router.location.countrycode, 'XX')
+        self.assertEqual(FakeLocation.lookups, ['1.2.3.4', '1.2.3.4'])
+        self.assertEqual(len(self.controller.asked), 1)
+
+    def test_controller_without_scheduler(self):
+        ## anything with get_info_raw will do; the reactor is used
+        clock = task.Clock()
+        self.patch(router_module, 'reactor', clock)
+        del self.controller.scheduler
+        router = self.router('1.2.3.4')
+        self.assertEqual(router.location.countrycode, None)
+        clock.advance(0)
+        self.assertEqual(router.location.countrycode, 'XX')
+        self.assertEqual(self.controller.asked, [('ip-to-country/1.2.3.4',)])
+
+    def test_countries_refused(self):
+        self.controller.fail.add('ip-to-country/2.2.2.2')
+        routers = [self.router(ip) for ip in ['1.1.1.1', '2.2.2.2', '3.3.3.3']]
+        for router in routers:
+            router.location
+        self.controller.scheduler.advance(0)
+
+        ## the combined GETINFO, then each on its own
+        self.assertEqual(len(self.controller.asked), 4)
+        self.assertEqual([r.location.countrycode for r in routers], ['XX', None, 'XX'])
+        self.assertEqual(tor_countries['2.2.2.2'], None)
+
+        ## not asked about again
+        location_cache.clear()
+        self.router('2.2.2.2').location
+        self.controller.scheduler.advance(0)
+        self.assertEqual(len(self.controller.asked), 4)
+
+    def test_countries_error(self):
+        self.controller.get_info_raw = lambda *keys: defer.fail(RuntimeError("connection lost"))
+        router = self.router('1.2.3.4')
+        router.location
+        self.controller.scheduler.advance(0)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        self.assertEqual(router.location.countrycode, None)
+        self.assertFalse('1.2.3.4' in tor_countries)
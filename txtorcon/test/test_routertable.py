@@ -0,0 +1,108 @@
+import hashlib
+
+from twisted.trial import unittest
+
+from txtorcon import routertable
+from txtorcon.router import Router
+from txtorcon.routertable import RouterTable, PORT_BITS
+
+
+class FakeLocation(object):
+    def __init__(self, countrycode, asn=None):
+        self.countrycode = countrycode
+        self.asn = asn
+
+
+def router(name, ip, flags, bandwidth, policy, country, asn=None):
+    r = Router(object())
+    r.update(name, hashlib.sha1(name).digest().encode('base64')[:27], "MAANkj30tnFvmoh7FsjVFr+cmcs",
+             "2011-12-16 15:11:34", ip, "9001", "0")
+    r.flags = flags
+    r.bandwidth = bandwidth
+    r.policy = policy.split()
+    r.location = FakeLocation(country, asn)
+    return r
+
+
+class RouterTableTests(unittest.TestCase):
+
+    def setUp(self):
+        self.routers = [
+            router('de_exit', '1.2.3.4', 'Exit Fast Stable Running Valid', 5000, 'accept 80,443', 'DE',
+                   'AS3320 Deutsche Telekom AG'),
+            router('de_slow', '1.2.3.5', 'Exit Fast Stable Running Valid', 50, 'accept 443', 'DE'),
+            router('de_relay', '1.2.3.6', 'Fast Stable Guard Running Valid', 9000, 'reject 1-65535', 'DE'),
+            router('us_exit', '5.6.7.8', 'Exit Fast Stable Running Valid', 9000, 'reject 25', 'US'),
+            router('unstable', '5.6.7.9', 'Exit Fast Running Valid', 9000, 'accept 443,8080', 'DE'),
+            None,
+            router('nowhere', 'unknown', 'Running', 0, 'accept 443', None),
+        ]
+        self.table = RouterTable(self.routers)
+
+    def names(self, **kwargs):
+        return [r.name for r in self.table.select(**kwargs)]
+
+    def test_columns(self):
+        self.assertEqual(len(self.table), 6)
+        self.assertEqual(list(self.table.bandwidth), [5000, 50, 9000, 9000, 9000, 0])
+        self.assertEqual(list(self.table.ipv4), [0x01020304, 0x01020305, 0x01020306,
+                                                 0x05060708, 0x05060709, 0])
+        self.assertEqual(self.table.countries, [None, 'DE', 'US'])
+        self.assertEqual(list(self.table.country), [1, 1, 1, 2, 1, 0])
+        self.assertEqual(list(self.table.asn), [3320, 0, 0, 0, 0, 0])
+        self.assertEqual(self.table.flag_mask[3], self.routers[3].flag_mask)
+        self.assertEqual(self.table.exit_ports[0], PORT_BITS[80] | PORT_BITS[443])
+        self.assertEqual(self.table.exit_ports[2], 0)
+
+    def test_select(self):
+        self.assertEqual(self.names(flags=['fast', 'Stable', 'EXIT'], country='de',
+                                    min_bandwidth=1000, port=443),
+                         ['de_exit'])
+        self.assertEqual(self.names(flags=['exit'], port=443),
+                         ['de_exit', 'de_slow', 'us_exit', 'unstable'])
+        self.assertEqual(self.names(port=80), ['de_exit', 'us_exit'])
+        self.assertEqual(self.names(port=25), [])
+        self.assertEqual(self.names(asn=3320), ['de_exit'])
+        self.assertEqual(self.names(country='FR'), [])
+        self.assertEqual(len(self.names()), 6)
+
+    def test_other_port(self):
+        ## not one of EXIT_PORTS, so checked router by router
+        self.assertEqual(self.names(port=8080), ['us_exit', 'unstable'])
+        self.assertEqual(self.names(country='DE', port=8080), ['unstable'])
+
+    def test_update(self):
+        de_slow = self.routers[1]
+        de_slow.bandwidth = 7000
+        de_slow.flags = 'Fast Running Valid'
+        extra = router('extra', '9.9.9.9', 'Exit Fast Stable Running Valid', 10, 'accept 443', 'US')
+        ## de_slow twice: only the once
+        self.table.update([de_slow, extra, de_slow])
+
+        self.assertEqual(len(self.table), 7)
+        self.assertTrue(self.table.routers[6] is extra)
+        self.assertEqual(list(self.table.bandwidth), [5000, 7000, 9000, 9000, 9000, 0, 10])
+        self.assertEqual(self.names(flags=['exit'], port=443),
+                         ['de_exit', 'us_exit', 'unstable', 'extra'])
+
+    def test_country_arrives_later(self):
+        late = router('late', '9.9.9.9', 'Exit Running Valid', 10, 'accept 443', None)
+        late.location = FakeLocation(None)      # waiting on ip-to-country
+        self.table.update([late])
+        self.assertEqual(self.names(country='NL'), [])
+
+        late.location.countrycode = 'NL'
+        self.assertEqual(self.names(country='NL'), ['late'])
+        self.assertEqual(self.table.countries[self.table.country[6]], 'NL')
+
+    def test_without_numpy(self):
+        self.patch(routertable, 'numpy', None)
+        table = RouterTable(self.routers)
+        self.assertEqual([r.name for r in table.select(flags=['exit', 'stable'], country='DE',
+                                                       min_bandwidth=10, port=443)],
+                         ['de_exit', 'de_slow'])
+
+    def test_with_numpy(self):
+        if routertable.numpy is None:
+            raise unittest.SkipTest("NumPy isn't installed")
+        self.assertEqual(self.table.rows(flags=['exit', 'stable'], country='DE', port=443), [0, 1])
@@ -72,17 +72,15 @@ class StreamTests(unittest.TestCase):
         self.circuits = {}
 
     def test_lowercase_flags(self):
-        ## testing an internal method, maybe a no-no?
+        self.circuits[186] = FakeCircuit(186)
+        listener = Listener([('new', {}),
+                             ('closed', {'kwargs': dict(FOO='bar', foo='bar',
+                                                        BAR='baz', bar='baz')})])
         stream = Stream(self)
-        kw = dict(FOO='bar', BAR='baz')
-        flags = stream._create_flags(kw)
-        self.assertTrue('FOO' in flags)
-        self.assertTrue('foo' in flags)
-        self.assertTrue(flags['foo'] is flags['FOO'])
-
-        self.assertTrue('BAR' in flags)
-        self.assertTrue('bar' in flags)
-        self.assertTrue(flags['bar'] is flags['BAR'])
+        stream.listen(listener)
+        stream.update("316 NEW 0 www.yahoo.com:80 SOURCE_ADDR=127.0.0.1:55877 PURPOSE=USER".split())
+        stream.update("316 CLOSED 186 1.2.3.4:80 FOO=bar BAR=baz".split())
+        self.assertEqual(listener.expected, [])
 
     def test_listener_mixin(self):
         listener = StreamListenerMixin()
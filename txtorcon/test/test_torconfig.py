@@ -455,6 +455,16 @@ class EventTests(unittest.TestCase):
         self.assertEqual(config.Foo, 'bar')
         self.assertEqual(config.Bar, DEFAULT_VALUE)
 
+    def test_conf_changed_repeated(self):
+        control = FakeControlProtocol([])
+        config = TorConfig(control)
+
+        control.events['CONF_CHANGED']('HiddenServicePort=80 127.0.0.1:80\n'
+                                       'HiddenServicePort=90 127.0.0.1:90\n'
+                                       'Nickname="quoted"')
+        self.assertEqual(config.HiddenServicePort, '90 127.0.0.1:90')
+        self.assertEqual(config.Nickname, '"quoted"')
+
 
 class CreateTorrcTests(unittest.TestCase):
 
@@ -3,10 +3,13 @@ from __future__ import with_statement
 from twisted.python import log
 from twisted.trial import unittest
 from twisted.test import proto_helpers
-from twisted.internet import defer
-from txtorcon import TorControlProtocol, TorProtocolFactory, TorState
-from txtorcon.torcontrolprotocol import parse_keywords, DEFAULT_VALUE
+from twisted.internet import defer, task, error
+from twisted.python import failure
+from txtorcon import TorControlProtocol, TorProtocolFactory, TorState, TorProtocolError
+from txtorcon.torcontrolprotocol import parse_keywords, iter_keywords, split_info_reply, DEFAULT_VALUE, TorReplyTooLong, TorCommandTimeout
+from txtorcon.torcontrolprotocol import PRIORITY_CRITICAL, PRIORITY_NORMAL, PRIORITY_BULK
 from txtorcon.util import hmac_sha256
+from txtorcon.events import CircEvent
 
 import types
 import functools
@@ -52,6 +55,10 @@ class FactoryTests(unittest.TestCase):
     def test_create(self):
         TorProtocolFactory().buildProtocol(None)
 
+    def test_max_in_flight(self):
+        proto = TorProtocolFactory(max_in_flight=5).buildProtocol(None)
+        self.assertEqual(proto.max_in_flight, 5)
+
 
 class AuthenticationTests(unittest.TestCase):
 
@@ -153,31 +160,36 @@ class ProtocolTests(unittest.TestCase):
         except RuntimeError, e:
             self.assertTrue('Unknown code' in str(e))
 
-    def test_statemachine_is_finish(self):
-        self.assertTrue(not self.protocol._is_finish_line(''))
-        self.assertTrue(self.protocol._is_finish_line('.'))
-        self.assertTrue(self.protocol._is_finish_line('300 '))
-        self.assertTrue(not self.protocol._is_finish_line('250-'))
-
-    def test_statemachine_singleline(self):
-        self.assertTrue(not self.protocol._is_single_line_response('foo'))
-
-    def test_statemachine_continuation(self):
+    def test_unexpected_code(self):
         try:
-            self.protocol.code = 250
-            self.protocol._is_continuation_line("123 ")
+            self.send("250-a=1")
+            self.send("123-b=2")
             self.fail()
         except RuntimeError, e:
             self.assertTrue('Unexpected code' in str(e))
 
-    def test_statemachine_multiline(self):
+    def test_unexpected_code_data(self):
         try:
-            self.protocol.code = 250
-            self.protocol._is_multi_line("123 ")
+            self.send("250-a=1")
+            self.send("123+b=")
             self.fail()
         except RuntimeError, e:
             self.assertTrue('Unexpected code' in str(e))
 
+    def test_unexpected_line(self):
+        try:
+            self.send("foo")
+            self.fail()
+        except RuntimeError, e:
+            self.assertTrue('Unexpected line' in str(e))
+
+    def test_unexpected_separator(self):
+        try:
+            self.send("250*foo")
+            self.fail()
+        except RuntimeError, e:
+            self.assertTrue('Unexpected line' in str(e))
+
     def auth_failed(self, msg):
         self.assertEqual(str(msg.value), '551 go away')
         self.got_auth_failed = True
@@ -284,9 +296,9 @@ OK''' % cookietmp.name)
         self.protocol._bootstrap()
 
         ## answer all the requests generated by boostrapping etc.
+        ## version and events/names are asked for in one GETINFO
+        self.assertEqual(self.transport.value(), 'GETINFO version events/names\r\n')
         self.send("250-version=foo")
-        self.send("250 OK")
-
         self.send("250-events/names=" + events)
         self.send("250 OK")
 
@@ -294,6 +306,12 @@ OK''' % cookietmp.name)
 
         return d
 
+    def test_bootstrap_pipelined(self):
+        self.protocol.max_in_flight = 5
+        self.protocol._bootstrap()
+        self.assertEqual(self.transport.value(),
+                         'GETINFO version events/names\r\nUSEFEATURE EXTENDED_EVENTS\r\n')
+
     def test_async(self):
         ## test the example from control-spec.txt to see that we
         ## handle interleaved async notifications properly.
@@ -341,6 +359,37 @@ OK''' % cookietmp.name)
         self.send("250 OK")
         return d
 
+    def test_multiline_plus_mid_reply(self):
+        d = self.protocol.get_info_raw("version", "FOO", "BAR")
+        d.addCallback(CallbackChecker("version=0.2\nFOO=\na\nb\nBAR=baz\nOK"))
+        self.send("250-version=0.2")
+        self.send("250+FOO=")
+        self.send("a")
+        self.send("b")
+        self.send(".")
+        self.send("250-BAR=baz")
+        self.send("250 OK")
+        return d
+
+    def test_notify_multiline_during_incremental(self):
+        lines = []
+        self.protocol._set_valid_events('NS')
+        self.protocol.add_event_listener('NS', CallbackChecker("r foo\ns Fast\nOK"))
+        self.send("250 OK")
+
+        d = self.protocol.get_info_incremental("FOO", lines.append)
+        self.send("650+NS")
+        self.send("r foo")
+        self.send("s Fast")
+        self.send(".")
+        self.send("650 OK")
+        self.send("250+FOO=")
+        self.send("bar")
+        self.send(".")
+        self.send("250 OK")
+        self.assertEqual(lines, ["FOO=", "bar", "OK"])
+        return d
+
     def incremental_check(self, expected, actual):
         if '=' in actual or actual == 'OK':
             return
@@ -363,6 +412,34 @@ OK''' % cookietmp.name)
         self.send("250 OK")
         return d
 
+    def test_getinfo_lines(self):
+        d = self.protocol.get_info_lines("FOO", "BAR")
+        d.addCallback(CallbackChecker(["FOO=", "a", "b", "BAR=baz", "OK"]))
+        self.send("250+FOO=")
+        self.send("a")
+        self.send("b")
+        self.send(".")
+        self.send("250-BAR=baz")
+        self.send("250 OK")
+        self.assertEqual(self.transport.value(), "GETINFO FOO BAR\r\n")
+        return d
+
+    def test_getinfo_lines_error(self):
+        d = self.protocol.get_info_lines("FOO")
+        self.send('552 Unrecognized key "FOO"')
+        return self.assertFailure(d, TorProtocolError)
+
+    def test_large_multiline_reply(self):
+        lines = ['line %d' % x for x in range(5000)]
+        d = self.protocol.get_info_raw("FOO")
+        d.addCallback(CallbackChecker('\n'.join(['FOO='] + lines + ['OK'])))
+        self.send("250+FOO=")
+        for line in lines:
+            self.send(line)
+        self.send(".")
+        self.send("250 OK")
+        return d
+
     def test_getconf(self):
         d = self.protocol.get_conf("SOCKSPORT ORPORT")
         d.addCallback(CallbackChecker({'SocksPort': '9050', 'ORPort': '0'}))
@@ -418,6 +495,100 @@ OK''' % cookietmp.name)
 
         return d2
 
+    def test_pipelined_commands_on_wire(self):
+        self.protocol.max_in_flight = 3
+        self.protocol.get_info_raw("a")
+        self.protocol.get_info_raw("b")
+        self.protocol.get_info_raw("c")
+        self.protocol.get_info_raw("d")
+        self.assertEqual(self.transport.value(),
+                         "GETINFO a\r\nGETINFO b\r\nGETINFO c\r\n")
+        self.assertEqual(len(self.protocol.in_flight), 3)
+        self.assertEqual(len(self.protocol.commands), 1)
+
+        self.send("250 a=1")
+        self.assertEqual(self.transport.value().split('\r\n')[-2], "GETINFO d")
+        self.assertEqual(len(self.protocol.in_flight), 3)
+        self.assertEqual(len(self.protocol.commands), 0)
+
+    def test_pipelined_replies_in_order(self):
+        self.protocol.max_in_flight = 4
+        self.protocol._set_valid_events('CIRC')
+        self.protocol.add_event_listener('CIRC', CallbackChecker("1000 EXTENDED moria1,moria2"))
+
+        d0 = self.protocol.get_info("a")
+        d0.addCallback(CallbackChecker({'a': 'one'}))
+        d1 = self.protocol.get_info_raw("b")
+        d2 = self.protocol.get_conf("c")
+        d2.addCallback(CallbackChecker({'c': '1', 'd': '2'}))
+        self.assertEqual(len(self.protocol.in_flight), 4)
+
+        self.send("250 OK")             # SETEVENTS
+        self.send("650 CIRC 1000 EXTENDED moria1,moria2")
+        self.send("250-a=one")
+        self.send("250 OK")
+        self.send("552 Unrecognized key \"b\"")
+        self.send("250-c=1")
+        self.send("250 d=2")
+        self.assertEqual(len(self.protocol.in_flight), 0)
+        self.assertTrue(self.protocol.command is None)
+
+        self.assertTrue(d0.called)
+        self.assertTrue(d2.called)
+        return self.assertFailure(d1, TorProtocolError)
+
+    def test_pipelined_callback_queues_command(self):
+        self.protocol.max_in_flight = 2
+        d0 = self.protocol.get_info_raw("a")
+        self.protocol.get_info_raw("b")
+        d0.addCallback(lambda _: self.protocol.get_info_raw("c"))
+        self.transport.clear()
+
+        self.send("250 a=1")
+        self.assertEqual(self.transport.value(), "GETINFO c\r\n")
+        self.assertEqual([x[1] for x in self.protocol.in_flight],
+                         ["GETINFO b", "GETINFO c"])
+
+    def test_priority_attach_first(self):
+        self.protocol.get_info_raw("version")
+        self.protocol.get_info_raw("ns/all")
+        self.protocol.get_info_raw("traffic/read")
+        self.protocol.queue_command("ATTACHSTREAM 1 0")
+        self.assertEqual([x[1] for x in self.protocol.commands],
+                         ["ATTACHSTREAM 1 0", "GETINFO traffic/read", "GETINFO ns/all"])
+        self.assertEqual(self.protocol.commands[2][1], "GETINFO ns/all")
+        self.transport.clear()
+
+        self.send("250 version=0.2.4")
+        self.assertEqual(self.transport.value(), "ATTACHSTREAM 1 0\r\n")
+
+    def test_priority_explicit(self):
+        self.protocol.get_info_raw("version")
+        self.protocol.queue_command("GETINFO a", priority=PRIORITY_BULK)
+        self.protocol.queue_command("GETINFO b")
+        self.protocol.queue_command("GETINFO c", priority=PRIORITY_CRITICAL)
+        self.assertEqual([x[1] for x in self.protocol.commands],
+                         ["GETINFO c", "GETINFO b", "GETINFO a"])
+
+    def test_priority_depth(self):
+        self.protocol.get_info_raw("version")
+        self.protocol.get_info_raw("ns/all")
+        self.protocol.get_info_raw("md/all")
+        self.protocol.get_info_raw("ip-to-country/1.2.3.4", "ip-to-country/5.6.7.8")
+        self.protocol.queue_command("CLOSECIRCUIT 1")
+        self.assertEqual(len(self.protocol.commands), 4)
+        self.assertEqual(self.protocol.commands.depth(PRIORITY_CRITICAL), 1)
+        self.assertEqual(self.protocol.commands.depth(PRIORITY_NORMAL), 0)
+        self.assertEqual(self.protocol.commands.depth(PRIORITY_BULK), 3)
+
+        self.send("250 version=0.2.4")
+        self.assertEqual(self.protocol.commands.depth(PRIORITY_CRITICAL), 0)
+        self.assertEqual(self.protocol.commands.max_depth, [1, 1, 3])
+
+    def test_priority_empty(self):
+        self.assertRaises(IndexError, self.protocol.commands.popleft)
+        self.assertRaises(IndexError, lambda: self.protocol.commands[0])
+
     def test_signal_error(self):
         try:
             self.protocol.signal('FOO')
@@ -438,6 +609,29 @@ OK''' % cookietmp.name)
         self.send("650-CONF_CHANGED")
         self.send("650-Foo=bar")
 
+    def test_typed_listener(self):
+        self.protocol._set_valid_events('CIRC')
+        raw = []
+        typed = []
+        self.protocol.add_event_listener('CIRC', raw.append)
+        self.protocol.add_event_listener('CIRC', typed.append, typed=True)
+        self.protocol.add_event_listener('CIRC', typed.append, typed=True)
+        self.send("250 OK")
+
+        self.send("650 CIRC 1000 EXTENDED moria1,moria2")
+        self.assertEqual(raw, ["1000 EXTENDED moria1,moria2"])
+        self.assertEqual(len(typed), 2)
+        self.assertTrue(isinstance(typed[0], CircEvent))
+        self.assertTrue(typed[0] is typed[1])
+        self.assertEqual(typed[0].id, 1000)
+
+    def test_remove_typed_listener(self):
+        self.protocol._set_valid_events('CIRC')
+        self.protocol.add_event_listener('CIRC', CallbackChecker(None), typed=True)
+        cb = self.protocol.valid_events['CIRC'].typed_callbacks[0]
+        self.protocol.remove_event_listener('CIRC', cb)
+        self.assertFalse('CIRC' in self.protocol.events)
+
     def test_notify_after_getinfo(self):
         self.protocol._set_valid_events('CIRC')
         self.protocol.add_event_listener('CIRC', CallbackChecker("1000 EXTENDED moria1,moria2"))
@@ -620,6 +814,467 @@ OK"""))
         self.protocol.lineReceived("650 OK\r\n")
 
 
+class CoalesceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.protocol.coalesce_info = True
+        self.clock = task.Clock()
+        self.protocol.scheduler = self.clock
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def send(self, line):
+        self.protocol.dataReceived(line.strip() + "\r\n")
+
+    def test_single_caller(self):
+        d = self.protocol.get_info('version')
+        d.addCallback(CallbackChecker({'version': '0.2.3.25'}))
+        self.assertEqual(self.transport.value(), '')
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), 'GETINFO version\r\n')
+        self.send('250-version=0.2.3.25')
+        self.send('250 OK')
+        return d
+
+    def test_coalesce(self):
+        d0 = self.protocol.get_info('version')
+        d0.addCallback(CallbackChecker({'version': '0.2.3.25'}))
+        d1 = self.protocol.get_info_raw('ns/id/foo', 'traffic/read')
+        d1.addCallback(CallbackChecker('ns/id/foo=\nr foo\ns Fast\ntraffic/read=1234\nOK'))
+        d2 = self.protocol.get_info_raw('version')
+        d2.addCallback(CallbackChecker('version=0.2.3.25\nOK'))
+
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), 'GETINFO version ns/id/foo traffic/read\r\n')
+        self.send('250-version=0.2.3.25')
+        self.send('250+ns/id/foo=')
+        self.send('r foo')
+        self.send('s Fast')
+        self.send('.')
+        self.send('250-traffic/read=1234')
+        self.send('250 OK')
+        return defer.DeferredList([d0, d1, d2], fireOnOneErrback=True)
+
+    def test_invalid_key(self):
+        d0 = self.protocol.get_info_raw('version')
+        d0.addCallback(CallbackChecker('version=0.2.3.25\nOK'))
+        d1 = self.protocol.get_info_raw('foo')
+
+        self.clock.advance(0)
+        self.send('552 Unrecognized key "foo"')
+        self.assertEqual(self.transport.value(),
+                         'GETINFO version foo\r\nGETINFO version\r\n')
+        self.send('250-version=0.2.3.25')
+        self.send('250 OK')
+        self.send('552 Unrecognized key "foo"')
+        self.assertTrue(self.transport.value().endswith('GETINFO foo\r\n'))
+        self.assertTrue(d0.called)
+        return self.assertFailure(d1, TorProtocolError)
+
+    def test_next_turn(self):
+        self.protocol.get_info_raw('a')
+        self.clock.advance(0)
+        self.protocol.get_info_raw('b')
+        self.protocol.get_info_raw('c')
+        self.clock.advance(0)
+        self.send('250 a=1')
+        self.assertEqual(self.transport.value(), 'GETINFO a\r\nGETINFO b c\r\n')
+
+    def test_split(self):
+        parts = split_info_reply('a=1\nb=\nb=x\nc=3\nOK', ['a', 'b', 'c'])
+        self.assertEqual(parts, {'a': 'a=1', 'b': 'b=\nb=x', 'c': 'c=3'})
+
+    def test_split_missing_key(self):
+        self.assertRaises(RuntimeError, split_info_reply, 'a=1\nOK', ['a', 'b'])
+        self.assertRaises(RuntimeError, split_info_reply, 'a=1\nOK', ['b'])
+
+    def test_cancel_one(self):
+        d0 = self.protocol.get_info_raw('version')
+        d1 = self.protocol.get_info_raw('traffic/read')
+        self.clock.advance(0)
+        d0.cancel()
+        self.send('250-version=0.2.3.25')
+        self.send('250-traffic/read=1234')
+        self.send('250 OK')
+        self.assertEqual(d1.result, 'traffic/read=1234\nOK')
+        return self.assertFailure(d0, defer.CancelledError)
+
+    def test_cancel_all(self):
+        d0 = self.protocol.get_info_raw('version')
+        d1 = self.protocol.get_info_raw('traffic/read')
+        self.clock.advance(0)
+        d0.cancel()
+        d1.cancel()
+        d2 = self.protocol.get_info_raw('traffic/written')
+        self.clock.advance(0)
+        self.send('250-version=0.2.3.25')
+        self.send('250-traffic/read=1234')
+        self.send('250 OK')
+        self.send('250-traffic/written=5678')
+        self.send('250 OK')
+        self.assertEqual(d2.result, 'traffic/written=5678\nOK')
+        self.assertFailure(d0, defer.CancelledError)
+        return self.assertFailure(d1, defer.CancelledError)
+
+    def test_cancel_before_sending(self):
+        d0 = self.protocol.get_info_raw('version')
+        d0.cancel()
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), '')
+        return self.assertFailure(d0, defer.CancelledError)
+
+    def test_cancel_retried(self):
+        d0 = self.protocol.get_info_raw('version')
+        d1 = self.protocol.get_info_raw('foo')
+        self.clock.advance(0)
+        self.send('552 Unrecognized key "foo"')
+        d0.cancel()
+        self.send('250-version=0.2.3.25')
+        self.send('250 OK')
+        self.send('552 Unrecognized key "foo"')
+        self.assertFailure(d1, TorProtocolError)
+        return self.assertFailure(d0, defer.CancelledError)
+
+
+class TimeoutTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.clock = task.Clock()
+        self.protocol.scheduler = self.clock
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def send(self, line):
+        self.protocol.dataReceived(line.strip() + "\r\n")
+
+    def test_cancel_queued(self):
+        d0 = self.protocol.queue_command("GETINFO a")
+        d1 = self.protocol.queue_command("GETINFO b")
+        d1.cancel()
+        self.assertEqual(len(self.protocol.commands), 0)
+
+        self.send("250 a=1")
+        self.assertEqual(d0.result, "a=1")
+        self.assertEqual(self.transport.value(), "GETINFO a\r\n")
+        return self.assertFailure(d1, defer.CancelledError)
+
+    def test_cancel_in_flight(self):
+        lines = []
+        d0 = self.protocol.queue_command("GETINFO a", lines.append)
+        d1 = self.protocol.queue_command("GETINFO b")
+        d0.cancel()
+        self.send("250-a=1")
+        self.send("250 OK")
+        self.assertEqual(lines, [])
+        self.assertEqual(self.transport.value(), "GETINFO a\r\nGETINFO b\r\n")
+
+        self.send("250 b=2")
+        self.assertEqual(d1.result, "b=2")
+        return self.assertFailure(d0, defer.CancelledError)
+
+    def test_timeout_queued(self):
+        self.protocol.queue_command("GETINFO a")
+        d1 = self.protocol.queue_command("GETINFO b", timeout=5)
+        self.clock.advance(5)
+        self.assertEqual(len(self.protocol.commands), 0)
+        self.assertFalse(self.transport.disconnecting)
+        return self.assertFailure(d1, TorCommandTimeout)
+
+    def test_timeout_in_flight(self):
+        d0 = self.protocol.queue_command("GETINFO a", timeout=5)
+        d1 = self.protocol.queue_command("GETINFO b")
+        self.clock.advance(4)
+        self.assertFalse(d0.called)
+        self.clock.advance(1)
+        self.assertTrue(self.transport.disconnecting)
+
+        self.protocol.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertEqual(len(self.protocol.in_flight), 0)
+        self.assertEqual(len(self.protocol.commands), 0)
+        self.assertFailure(d0, TorCommandTimeout)
+        self.assertFailure(d1, error.ConnectionDone)
+        return defer.DeferredList([d0, d1])
+
+    def test_reply_cancels_timeout(self):
+        d = self.protocol.get_info_raw("a", timeout=5)
+        self.send("250 a=1")
+        self.assertEqual(d.result, "a=1")
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_command_timeout_default(self):
+        self.protocol.command_timeout = 10
+        d = self.protocol.get_conf_raw("SocksPort")
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(10)
+        self.assertTrue(self.transport.disconnecting)
+        return self.assertFailure(d, TorCommandTimeout)
+
+    def test_helper_kwargs(self):
+        self.protocol.set_conf("a", "b", timeout=1)
+        self.protocol.get_info_lines("a", timeout=2)
+        self.assertEqual(sorted(c.getTime() for c in self.clock.getDelayedCalls()), [1, 2])
+        self.assertRaises(TypeError, self.protocol.get_info, "a", foo=1)
+
+    def test_coalesced_timeouts(self):
+        self.protocol.coalesce_info = True
+        d0 = self.protocol.get_info_raw("a", timeout=10)
+        d1 = self.protocol.get_info_raw("b", timeout=3)
+        d2 = self.protocol.get_info_raw("c")
+        self.clock.advance(0)
+        self.assertEqual(sorted(c.getTime() for c in self.clock.getDelayedCalls()), [3, 10])
+        self.assertEqual(self.transport.value(), 'GETINFO a b c\r\n')
+
+        self.clock.advance(3)
+        self.assertFalse(self.transport.disconnecting)
+        self.assertFalse(d0.called or d2.called)
+        self.protocol.dataReceived('250-a=1\r\n250-b=2\r\n250-c=3\r\n250 OK\r\n')
+        self.assertEqual(d0.result, 'a=1\nOK')
+        self.assertEqual(d2.result, 'c=3\nOK')
+        return self.assertFailure(d1, TorCommandTimeout)
+
+    def test_coalesced_longest_timeout(self):
+        self.protocol.coalesce_info = True
+        d0 = self.protocol.get_info_raw("a", timeout=10)
+        d1 = self.protocol.get_info_raw("b", timeout=3)
+        self.clock.advance(0)
+        self.clock.advance(3)
+        self.assertFailure(d1, TorCommandTimeout)
+        self.assertFalse(d0.called)
+        self.clock.advance(7)
+        self.assertTrue(self.transport.disconnecting)
+        return self.assertFailure(d0, TorCommandTimeout)
+
+
+class BatchedEventTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.clock = task.Clock()
+        self.protocol.scheduler = self.clock
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.protocol._set_valid_events('CIRC STREAM')
+
+    def send(self, line):
+        self.protocol.dataReceived(line.strip() + "\r\n")
+
+    def test_batch(self):
+        batches = []
+        self.protocol.add_event_listener('STREAM', batches.append, batch=0)
+        self.send("250 OK")
+        self.send("650 STREAM 1 NEW 0 www.example.com:80")
+        self.send("650 STREAM 1 SENTCONNECT 2 www.example.com:80")
+        self.assertEqual(batches, [])
+        self.clock.advance(0)
+        self.assertEqual(batches, [["1 NEW 0 www.example.com:80", "1 SENTCONNECT 2 www.example.com:80"]])
+
+    def test_collapse_typed(self):
+        batches = []
+        self.protocol.add_event_listener('CIRC', batches.append, typed=True, batch=0.1, collapse=True)
+        self.send("250 OK")
+        self.send("650 CIRC 1 LAUNCHED PURPOSE=GENERAL")
+        self.send("650 CIRC 2 LAUNCHED PURPOSE=GENERAL")
+        self.send("650 CIRC 1 BUILT PURPOSE=GENERAL")
+        self.clock.advance(0.1)
+        self.assertEqual([(e.id, e.state) for e in batches[0]], [(1, 'BUILT'), (2, 'LAUNCHED')])
+
+    def test_remove_batched(self):
+        batches = []
+        self.protocol.add_event_listener('CIRC', batches.append, collapse=True)
+        self.send("250 OK")
+        self.protocol.remove_event_listener('CIRC', batches.append)
+        self.assertFalse('CIRC' in self.protocol.events)
+
+
+class QueuedEventTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.clock = task.Clock()
+        self.protocol.scheduler = self.clock
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.protocol._set_valid_events('CIRC STREAM')
+
+    def send(self, line):
+        self.protocol.dataReceived(line.strip() + "\r\n")
+
+    def test_broken_listener(self):
+        def broken(event):
+            raise RuntimeError("oops")
+        q = self.protocol.add_event_listener('CIRC', broken, queue=10)
+        self.send("250 OK")
+        self.send("650 CIRC 1 LAUNCHED")
+        self.clock.advance(0)
+        self.assertEqual(q.errors, 1)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        self.assertFalse(self.transport.disconnecting)
+
+    def test_block_pauses_transport(self):
+        got0 = []
+        got1 = []
+        self.protocol.add_event_listener('CIRC', got0.append, queue=1, policy='block')
+        self.protocol.add_event_listener('STREAM', got1.append, queue=1, policy='block')
+        self.send("250 OK")
+        self.send("250 OK")
+        self.protocol.dataReceived("650 CIRC 1 LAUNCHED\r\n650 CIRC 1 BUILT\r\n650 STREAM 1 NEW 0 www.example.com:80\r\n650 STREAM 2 NEW 0 www.example.com:80\r\n")
+        self.assertEqual(self.transport.producerState, 'paused')
+        self.assertEqual(self.protocol._read_pauser.pauses, 2)
+
+        self.clock.advance(0)
+        self.assertEqual(self.transport.producerState, 'producing')
+        self.assertEqual(len(got0), 2)
+        self.assertEqual(len(got1), 2)
+
+    def test_remove_queued(self):
+        got = []
+        self.protocol.add_event_listener('CIRC', got.append, queue=10, policy='coalesce')
+        self.send("250 OK")
+        self.protocol.remove_event_listener('CIRC', got.append)
+        self.assertFalse('CIRC' in self.protocol.events)
+
+    def test_queue_and_batch(self):
+        self.assertRaises(ValueError, self.protocol.add_event_listener, 'CIRC', None, queue=1, batch=1)
+
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.clock = task.Clock()
+        self.protocol.scheduler = self.clock
+        self.protocol.metrics.clock = self.clock
+        self.protocol.metrics.reset()
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.metrics = self.protocol.metrics
+
+    def send(self, line):
+        self.protocol.dataReceived(line.strip() + "\r\n")
+
+    def test_command_timing(self):
+        self.protocol.get_info_raw("version")
+        self.clock.advance(1)
+        self.protocol.set_conf("a", "b")
+        self.clock.advance(2)
+        self.send("250-version=0.2.4")
+        self.send("250 OK")
+        self.clock.advance(4)
+        self.send("250 OK")
+
+        self.assertEqual(self.metrics.queue_wait['GETINFO'].max, 0)
+        self.assertEqual(self.metrics.wire_time['GETINFO'].max, 3)
+        self.assertEqual(self.metrics.queue_wait['SETCONF'].max, 2)
+        self.assertEqual(self.metrics.wire_time['SETCONF'].max, 4)
+        ## the GETINFO went straight out, so the queue was empty both times
+        self.assertEqual(self.metrics.queue_depth.count, 2)
+        self.assertEqual(self.metrics.queue_depth.max, 0)
+        self.assertEqual(self.metrics.lines_received, 3)
+        self.assertEqual(self.metrics.bytes_received, len("250-version=0.2.4\r\n250 OK\r\n250 OK\r\n"))
+
+    def test_events(self):
+        self.protocol._set_valid_events('CIRC')
+
+        def slow_listener(data):
+            self.clock.advance(0.5)
+        self.protocol.add_event_listener('CIRC', slow_listener)
+        self.send("250 OK")
+        self.send("650 CIRC 1 LAUNCHED")
+        self.send("650 CIRC 1 BUILT")
+
+        self.assertEqual(self.metrics.events, {'CIRC': 2})
+        self.assertEqual(self.metrics.callback_time['CIRC'].total, 1.0)
+        self.assertEqual(self.metrics.events_per_second(), {'CIRC': 2.0})
+
+
+class LineLengthTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def test_long_line(self):
+        value = 'x' * 100000
+        d = self.protocol.get_info_raw("network-status")
+        d.addCallback(CallbackChecker("network-status=" + value + "\nOK"))
+        data = "250-network-status=" + value + "\r\n250 OK\r\n"
+        for i in range(0, len(data), 1000):
+            self.protocol.dataReceived(data[i:i + 1000])
+        self.assertFalse(self.transport.disconnecting)
+        return d
+
+    def test_split_delimiter(self):
+        d0 = self.protocol.get_info_raw("a")
+        d0.addCallback(CallbackChecker("a=1"))
+        d1 = self.protocol.get_info_raw("b")
+        d1.addCallback(CallbackChecker("b=2"))
+        self.protocol.dataReceived("250 a=1\r")
+        self.assertFalse(d0.called)
+        self.protocol.dataReceived("\n250 b=")
+        self.assertTrue(d0.called)
+        self.protocol.dataReceived("2\r\n")
+        return d1
+
+    def test_too_long(self):
+        self.protocol.MAX_LENGTH = 100
+        d0 = self.protocol.get_info_raw("a")
+        d1 = self.protocol.get_info_raw("b")
+        d1.addCallback(CallbackChecker("b=2"))
+
+        self.protocol.dataReceived("250-a=" + ('x' * 150))
+        self.protocol.dataReceived(('x' * 150) + "\r\n250 OK\r\n")
+        self.protocol.dataReceived("250 b=2\r\n")
+        self.assertFalse(self.transport.disconnecting)
+        self.assertTrue(d1.called)
+        return self.assertFailure(d0, TorReplyTooLong)
+
+    def test_too_long_single_read(self):
+        self.protocol.MAX_LENGTH = 100
+        d0 = self.protocol.get_info_raw("a")
+        d1 = self.protocol.get_info_raw("b")
+        d1.addCallback(CallbackChecker("b=2"))
+
+        self.protocol.dataReceived("250+a=\r\n" + ('x' * 150) + "\r\n.\r\n250 OK\r\n250 b=2\r\n")
+        self.assertTrue(d1.called)
+        return self.assertFailure(d0, TorReplyTooLong)
+
+    def test_too_long_event(self):
+        self.protocol.MAX_LENGTH = 100
+        events = []
+        self.protocol._set_valid_events('STREAM')
+        self.protocol.add_event_listener('STREAM', events.append)
+        self.protocol.dataReceived("250 OK\r\n")
+
+        self.protocol.dataReceived("650 STREAM " + ('x' * 150) + "\r\n")
+        self.protocol.dataReceived("650 STREAM 1 NEW 0 foo:80\r\n")
+        self.assertEqual(events, ["1 NEW 0 foo:80"])
+
+    def test_default_too_long_loses_connection(self):
+        from txtorcon.torcontrolprotocol import UnboundedLineReceiver
+
+        class Receiver(UnboundedLineReceiver):
+            MAX_LENGTH = 10
+            lines = []
+
+            def lineReceived(self, line):
+                self.lines.append(line)
+
+        proto = Receiver()
+        proto.makeConnection(self.transport)
+        proto.dataReceived("short\r\n" + ('x' * 20))
+        self.assertEqual(proto.lines, ["short"])
+        self.assertTrue(self.transport.disconnecting)
+
+
 class ParseTests(unittest.TestCase):
 
     def setUp(self):
@@ -690,6 +1345,27 @@ class ParseTests(unittest.TestCase):
         x = parse_keywords('foo=')
         self.assertEqual(x, {'foo': ''})
 
+    def test_quoted_escapes(self):
+        x = parse_keywords(r'foo="a \"quoted\" \\ path\n\101"')
+        self.assertEqual(x, {'foo': 'a "quoted" \\ path\nA'})
+
+    def test_multiline_value_lines(self):
+        x = parse_keywords('ns/all=\nr one\ns Fast\nr two\nOK')
+        self.assertEqual(x, {'ns/all': '\nr one\ns Fast\nr two'})
+
+    def test_repeated_keys_after_others(self):
+        x = parse_keywords('foo=1\nbar=2\nfoo=3\nfoo=4')
+        self.assertEqual(x, {'foo': ['1', '3', '4'], 'bar': '2'})
+
+    def test_iter_keywords(self):
+        pairs = iter_keywords('foo=bar\nbaz="qu\\"x"\nfoo=zarimba\nOK')
+        self.assertEqual(pairs.next(), ('foo', 'bar'))
+        self.assertEqual(list(pairs), [('baz', 'qu"x'), ('foo', 'zarimba')])
+
+    def test_iter_keywords_lines(self):
+        x = list(iter_keywords(['foo=bar', 'more', 'baz', 'OK'], multiline_values=False))
+        self.assertEqual(x, [('foo', 'bar'), ('more', DEFAULT_VALUE), ('baz', DEFAULT_VALUE)])
+
     def test_network_status(self):
         self.controller._update_network_status("""ns/all=
 r right2privassy3 ADQ6gCT3DiFHKPDFr3rODBUI8HM JehnjB8l4Js47dyjLCEmE8VJqao 2011-12-02 03:36:40 50.63.8.215 9023 0
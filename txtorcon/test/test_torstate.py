@@ -2,12 +2,17 @@ from zope.interface import implements
 from zope.interface.verify import verifyClass
 from twisted.trial import unittest
 from twisted.test import proto_helpers
-from twisted.internet import task, defer
+from twisted.internet import task, defer, error
+from twisted.python import failure
 from twisted.internet.interfaces import IStreamClientEndpoint, IReactorCore
 
 import os
 
 from txtorcon import TorControlProtocol, TorProtocolError, TorState, Stream, Circuit, build_tor_connection
+from txtorcon.events import CircEvent, StreamEvent
+from txtorcon.router import hashFromHexId
+from txtorcon.faketor import FakeTor
+from txtorcon.torstate import parse_consensus
 from txtorcon.interface import ITorControlProtocol, IStreamAttacher, ICircuitListener, IStreamListener, StreamListenerMixin, CircuitListenerMixin
 
 
@@ -112,7 +117,7 @@ class FakeEndpoint:
     def get_info_raw(self, keys):
         return defer.succeed('\r\n'.join(map(lambda k: '%s=' % k, keys.split())))
 
-    def get_info_incremental(self, key, linecb):
+    def get_info_incremental(self, key, linecb, **kwargs):
         linecb('%s=' % key)
         return defer.succeed('')
 
@@ -142,7 +147,7 @@ class FakeEndpointAnswers:
             ans += '%s=%s\r\n' % (k, self.answers.pop())
         return ans[:-2]                 # don't want trailing \r\n
 
-    def get_info_incremental(self, key, linecb):
+    def get_info_incremental(self, key, linecb, **kwargs):
         linecb('%s=%s' % (key, self.answers.pop()))
         return defer.succeed('')
 
@@ -249,6 +254,19 @@ class StateTests(unittest.TestCase):
         self.state.set_attacher(attacher, FakeReactor(self))
         self.state._stream_update("76 CLOSED 0 www.example.com:0 REASON=DONE")
 
+    def test_connection_lost_fails_commands(self):
+        d = self.protocol.get_info_raw('version')
+        self.protocol.connectionLost(failure.Failure(error.ConnectionDone()))
+        return self.assertFailure(d, error.ConnectionDone)
+
+    def test_circuit_update_event(self):
+        self.state._circuit_update(CircEvent('1 LAUNCHED PURPOSE=GENERAL'))
+        self.assertEqual(self.state.circuits[1].purpose, 'GENERAL')
+
+    def test_stream_update_event(self):
+        self.state._stream_update(StreamEvent('1610 SUCCEEDED 0 74.125.224.243:80'))
+        self.assertEqual(self.state.streams[1610].target_port, 80)
+
     def test_stream_update(self):
         ## we use a circuit ID of 0 so it doesn't try to look anything up but it's
         ## not really correct to have a  SUCCEEDED w/o a valid circuit, I don't think
@@ -273,6 +291,9 @@ class StateTests(unittest.TestCase):
 
         self.protocol._set_valid_events(' '.join(self.state.event_map.keys()))
         self.state._bootstrap()
+        ## one SETEVENTS per event_map entry, before the snapshot
+        for ignored in self.state.event_map.items():
+            self.send("250 OK")
 
         self.send("250+ns/all=")
         self.send(".")
@@ -288,9 +309,6 @@ class StateTests(unittest.TestCase):
         self.send("250-address-mappings/all=")
         self.send("250 OK")
 
-        for ignored in self.state.event_map.items():
-            self.send("250 OK")
-
         fakerouter = object()
         self.state.routers['$0000000000000000000000000000000000000000'] = fakerouter
         self.state.routers['$9999999999999999999999999999999999999999'] = fakerouter
@@ -330,6 +348,9 @@ class StateTests(unittest.TestCase):
 
         self.protocol._set_valid_events(' '.join(self.state.event_map.keys()))
         self.state._bootstrap()
+        ## one SETEVENTS per event_map entry, before the snapshot
+        for ignored in self.state.event_map.items():
+            self.send("250 OK")
 
         self.send("250+ns/all=")
         self.send(".")
@@ -348,9 +369,6 @@ class StateTests(unittest.TestCase):
         self.send('.')
         self.send('250 OK')
 
-        for ignored in self.state.event_map.items():
-            self.send("250 OK")
-
         self.send("250-entry-guards=")
         self.send("250 OK")
 
@@ -375,6 +393,9 @@ class StateTests(unittest.TestCase):
 
         self.protocol._set_valid_events(' '.join(self.state.event_map.keys()))
         self.state._bootstrap()
+        ## one SETEVENTS per event_map entry, before the snapshot
+        for ignored in self.state.event_map.items():
+            self.send("250 OK")
 
         self.send("250+ns/all=")
         self.send(".")
@@ -390,9 +411,6 @@ class StateTests(unittest.TestCase):
         self.send('.')
         self.send('250 OK')
 
-        for ignored in self.state.event_map.items():
-            self.send("250 OK")
-
         self.send("250-entry-guards=")
         self.send("250 OK")
 
@@ -403,6 +421,83 @@ class StateTests(unittest.TestCase):
 
         return d
 
+    def test_bootstrap_issues_queries_together(self):
+        self.protocol.max_in_flight = 20
+        self.protocol._set_valid_events(' '.join(self.state.event_map.keys()))
+        self.state._bootstrap()
+
+        ## events first, then every snapshot query without waiting
+        ## for any replies; ns/all still ahead of circuit-status
+        lines = self.transport.value().split('\r\n')[:-1]
+        self.assertEqual(len(lines), len(self.state.event_map) + 6)
+        self.assertTrue(all(x.startswith('SETEVENTS') for x in lines[:len(self.state.event_map)]))
+        self.assertEqual(lines[len(self.state.event_map):],
+                         ['GETINFO ns/all', 'GETINFO circuit-status', 'GETINFO stream-status',
+                          'GETINFO address-mappings/all', 'GETINFO entry-guards',
+                          'GETINFO process/pid'])
+
+    def test_bootstrap_reconciles_events(self):
+        d = self.state.post_bootstrap
+
+        self.protocol._set_valid_events(' '.join(self.state.event_map.keys()))
+        self.state._bootstrap()
+        for ignored in self.state.event_map.items():
+            self.send("250 OK")
+
+        ## already reflected in the circuit-status (in which it's gone)
+        self.send("650 CIRC 1 LAUNCHED PURPOSE=GENERAL")
+
+        self.send("250+ns/all=")
+        self.send(".")
+        self.send("250 OK")
+
+        ## still ahead of the circuit-status reply
+        self.send("650 CIRC 1 CLOSED PURPOSE=GENERAL")
+        self.assertEqual(self.state.circuits, {})
+
+        self.send("250-circuit-status=2 BUILT PURPOSE=GENERAL")
+        self.send("250 OK")
+
+        ## newer than the snapshot
+        self.send("650 CIRC 2 CLOSED PURPOSE=GENERAL")
+        self.send("650 CIRC 3 LAUNCHED PURPOSE=GENERAL")
+
+        self.send("250-stream-status=")
+        self.send("250 OK")
+        self.send("250-address-mappings/all=")
+        self.send("250 OK")
+        self.send("250-entry-guards=")
+        self.send("250 OK")
+        self.send("250-process/pid=1234")
+        self.send("250 OK")
+
+        self.assertEqual(self.state.circuits.keys(), [3])
+        self.assertEqual(self.state.tor_pid, 1234)
+        return d
+
+    def test_bootstrap_snapshot_fails(self):
+        self.protocol._set_valid_events(' '.join(self.state.event_map.keys()))
+        d = self.state._bootstrap()
+        for ignored in self.state.event_map.items():
+            self.send("250 OK")
+
+        self.send("250+ns/all=")
+        self.send(".")
+        self.send("250 OK")
+        self.send('552 Unrecognized key "circuit-status"')
+        self.send("250-stream-status=")
+        self.send("250 OK")
+
+        ## without a circuit-status (or the rest), events are applied
+        ## as they arrive instead of waiting forever
+        self.send("650 CIRC 3 LAUNCHED PURPOSE=GENERAL")
+        self.send("650 STREAM 1 NEW 0 www.example.com:80 SOURCE_ADDR=127.0.0.1:54327 PURPOSE=USER")
+        self.assertEqual(self.state.circuits.keys(), [3])
+        self.assertEqual(self.state.streams.keys(), [1])
+        self.assertEqual(self.state._awaiting_snapshot, set())
+        self.assertEqual(self.state._held_events, {})
+        return self.assertFailure(d, TorProtocolError)
+
     def test_unset_attacher(self):
 
         class MyAttacher(object):
@@ -663,6 +758,38 @@ p reject 1-65535""")
         self.assertEqual(len(self.state.routers_by_name['PPrivCom012'][0].ip_v6), 1)
         self.assertEqual(self.state.routers_by_name['PPrivCom012'][0].ip_v6[0], '[2001:0:0:0::0]:4321')
 
+    def test_router_table(self):
+        self.state._update_network_status("""ns/all=
+r PPrivCom012 2CGDscCeHXeV/y1xFrq1EGqj5g4 QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 84.19.178.6 9001 0
+s Exit Fast Guard Running Stable Named Valid
+w Bandwidth=51500
+p accept 443""")
+        table = self.state.router_table
+        self.assertTrue(self.state.router_table is table)
+        self.assertEqual(table.routers, [self.state.routers['PPrivCom012']])
+        self.assertEqual(table.select(flags=['exit'], port=443), table.routers)
+
+        self.state._update_network_status("""ns/all=
+r foo YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80
+s Fast Running
+w Bandwidth=1000
+p reject 1-65535""")
+        ## the same table, with a row added
+        self.assertTrue(self.state.router_table is table)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.select(flags=['exit'], port=443), table.routers[:1])
+
+        ## a changed router has its row rewritten
+        self.state._update_network_status("""ns/all=
+r PPrivCom012 2CGDscCeHXeV/y1xFrq1EGqj5g4 QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 84.19.178.6 9001 0
+s Fast Guard Running Stable Named Valid
+w Bandwidth=100
+p accept 443""")
+        self.assertTrue(self.state.router_table is table)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.select(flags=['exit']), [])
+        self.assertEqual(list(table.bandwidth), [100, 1000])
+
     def test_invalid_routers(self):
         try:
             self.state._update_network_status('''ns/all=
@@ -1024,3 +1151,303 @@ s Fast Guard Running Stable Valid
     def test_listener_mixins(self):
         self.assertTrue(verifyClass(IStreamListener, StreamListenerMixin))
         self.assertTrue(verifyClass(ICircuitListener, CircuitListenerMixin))
+
+
+class LazyRouterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.clock = task.Clock()
+        self.state = TorState(self.protocol, bootstrap=False, lazy_routers=True,
+                              router_cache_size=3)
+        self.state.scheduler = self.clock
+
+    def send(self, line):
+        self.protocol.dataReceived(line.strip() + "\r\n")
+
+    def ns_lines(self, hexid, name, ip):
+        return ['r %s %s AAAAAAAAAAAAAAAAAAAAAAAAAAA 2013-01-01 00:00:00 %s 9001 0' %
+                (name, hashFromHexId(hexid), ip),
+                's Fast Running Valid',
+                'w Bandwidth=1000']
+
+    def test_bootstrap_skips_consensus(self):
+        self.protocol._set_valid_events(' '.join(self.state.event_map.keys()))
+        self.state._bootstrap()
+        for ignored in self.state.event_map.items():
+            self.send("250 OK")
+        self.assertEqual(self.transport.value().split('\r\n')[len(self.state.event_map)],
+                         'GETINFO circuit-status')
+
+    def test_lookups_batched(self):
+        a = self.state.router_from_id('$' + 'A' * 40)
+        b = self.state.router_from_id('$' + 'B' * 40 + '~bob')
+        self.assertTrue(self.state.router_from_id('$' + 'A' * 40 + '=alice') is a)
+        self.assertEqual(a.ip, 'unknown')
+        self.assertEqual(self.transport.value(), '')
+
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(),
+                         'GETINFO ns/id/%s ns/id/%s\r\n' % ('A' * 40, 'B' * 40))
+        self.send('250+ns/id/%s=' % ('A' * 40))
+        for line in self.ns_lines('A' * 40, 'alice', '1.2.3.4'):
+            self.send(line)
+        self.send('.')
+        self.send('250+ns/id/%s=' % ('B' * 40))
+        for line in self.ns_lines('B' * 40, 'bob', '1.2.3.5'):
+            self.send(line)
+        self.send('.')
+        self.send('250 OK')
+
+        ## the objects handed out earlier are filled in
+        self.assertEqual((a.name, a.ip, a.bandwidth, a.from_consensus), ('alice', '1.2.3.4', 1000, True))
+        self.assertEqual(b.ip, '1.2.3.5')
+        self.assertTrue(self.state.router_from_id('$' + 'B' * 40) is b)
+        self.assertEqual(self.state.routers_by_name, {})
+        self.assertEqual(self.state.guards, {})
+
+    def test_unknown_router(self):
+        a = self.state.router_from_id('$' + 'A' * 40)
+        self.state.router_from_id('$' + 'B' * 40)
+        self.clock.advance(0)
+        self.send('552 Unrecognized key "ns/id/%s"' % ('B' * 40))
+
+        ## asked for again one at a time
+        self.send('250+ns/id/%s=' % ('A' * 40))
+        for line in self.ns_lines('A' * 40, 'alice', '1.2.3.4'):
+            self.send(line)
+        self.send('.')
+        self.send('250 OK')
+        self.send('552 Unrecognized key "ns/id/%s"' % ('B' * 40))
+        self.assertEqual(self.transport.value().split('\r\n')[1:],
+                         ['GETINFO ns/id/%s' % ('A' * 40), 'GETINFO ns/id/%s' % ('B' * 40), ''])
+
+        self.assertEqual(a.name, 'alice')
+        self.assertEqual(self.state.router_from_id('$' + 'B' * 40).ip, 'unknown')
+
+    def test_cache_size(self):
+        for c in 'ABCD':
+            self.state.router_from_id('$' + c * 40)
+        self.assertEqual(len(self.state.routers), 3)
+        self.assertFalse('$' + 'A' * 40 in self.state.routers)
+
+    def test_new_consensus_forgets(self):
+        self.state.router_from_id('$' + 'A' * 40)
+        self.state._new_consensus('\n'.join(self.ns_lines('B' * 40, 'bob', '1.2.3.5')))
+        self.assertEqual(len(self.state.routers), 0)
+
+
+class ConsensusLoadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.state = TorState(FakeControlProtocol(), bootstrap=False)
+        self.state.scheduler = self.clock
+        self.tor = FakeTor(routers=300, seed=0, clock=task.Clock())
+        self.state._update_network_status('\n'.join(self.tor.ns_all()[:40]))   # the first 10
+
+    def run_load(self, d):
+        for i in range(1000):
+            if d.called:
+                return
+            self.clock.advance(0)
+        self.fail("consensus load didn't finish")
+
+    def test_small_consensus_right_away(self):
+        d = self.state._load_consensus('\n'.join(self.tor.ns_all()))
+        self.assertTrue(d.called)
+        self.assertEqual(len(self.state.routers_by_name), 300)
+
+    def test_sliced(self):
+        self.state.consensus_time_slice = 0
+        old = self.state.routers
+        first = self.state.routers[self.tor.routers[0].id_hex]
+
+        d = self.state._load_consensus('\n'.join(self.tor.ns_all()))
+        self.assertFalse(d.called)
+        self.assertTrue(self.state.routers is old)
+        self.assertEqual(len(self.state.routers_by_name), 10)
+
+        self.run_load(d)
+        self.assertEqual(len(self.state.routers_by_name), 300)
+        ## circuits etc. still refer to the same Router
+        self.assertTrue(self.state.routers[self.tor.routers[0].id_hex] is first)
+
+    def changed_consensus(self):
+        "ns_all, with the first router renamed, moved, given an IPv6 address and made a Guard"
+        lines = list(self.tor.ns_all())
+        r = lines[0].split()
+        r[1] = 'renamed'
+        r[6] = '10.9.8.7'
+        lines[0] = ' '.join(r)
+        lines[1] = 's Fast Guard Running Stable Valid'
+        lines.insert(1, 'a [2001:db8::1]:9001')
+        return '\n'.join(lines)
+
+    def test_live_routers_unchanged_until_swap(self):
+        self.state.consensus_time_slice = 0
+        first = self.state.routers[self.tor.routers[0].id_hex]
+        before = (first.name, first.ip, first.flag_mask, list(first.ip_v6))
+        self.assertFalse(first in self.state.guards.values())
+
+        d = self.state._load_consensus(self.changed_consensus())
+        self.assertFalse(d.called)
+        self.assertEqual((first.name, first.ip, first.flag_mask, first.ip_v6), before)
+
+        self.run_load(d)
+        self.assertTrue(self.state.routers[self.tor.routers[0].id_hex] is first)
+        self.assertEqual((first.name, first.ip, first.ip_v6), ('renamed', '10.9.8.7', ['[2001:db8::1]:9001']))
+        self.assertTrue('guard' in first.flags)
+        self.assertTrue(self.state.guards[first.id_hex] is first)
+        self.assertTrue(self.state.routers['renamed'] is first)
+        self.assertEqual(first.location.ip, '10.9.8.7')
+
+        ## and again: the IPv6 address isn't added twice
+        self.run_load(self.state._load_consensus(self.changed_consensus()))
+        self.assertEqual(first.ip_v6, ['[2001:db8::1]:9001'])
+
+    def test_ipv6_not_duplicated_by_updates(self):
+        self.state._update_network_status(self.changed_consensus())
+        self.state._update_network_status(self.changed_consensus())
+        first = self.state.routers[self.tor.routers[0].id_hex]
+        self.assertEqual(first.ip_v6, ['[2001:db8::1]:9001'])
+
+    def test_updates_during_load(self):
+        self.state.consensus_time_slice = 0
+        d = self.state._load_consensus('\n'.join(self.tor.ns_all()[:400]))
+        extra = self.tor.ns_all()[-4:]
+        self.state._update_network_status('\n'.join(extra))
+        name = extra[0].split()[1]
+        self.assertTrue(name in self.state.routers_by_name)
+
+        self.run_load(d)
+        self.assertEqual(len(self.state.routers_by_name), 101)
+        self.assertTrue(name in self.state.routers_by_name)
+
+    def test_update_for_router_already_loaded(self):
+        self.state.consensus_time_slice = 0
+        d = self.state._load_consensus('\n'.join(self.tor.ns_all()))
+        ## a router new in this consensus, which the load has already
+        ## got to (the first chunk is parsed straight away), changes
+        ## before the swap
+        lines = list(self.tor.ns_all()[60:64])
+        lines[1] = 's Fast Guard Running Stable Valid'
+        self.state._update_network_status('\n'.join(lines))
+        router = self.state.routers[self.tor.routers[15].id_hex]
+        self.assertFalse(d.called)
+
+        self.run_load(d)
+        self.assertTrue(self.state.routers[self.tor.routers[15].id_hex] is router)
+        self.assertTrue(self.state.routers[router.name] is router)
+        self.assertTrue(self.state.guards[router.id_hex] is router)
+
+    def test_superseded(self):
+        self.state.consensus_time_slice = 0
+        d0 = self.state._load_consensus('\n'.join(self.tor.ns_all()))
+        d1 = self.state._load_consensus('\n'.join(self.tor.ns_all()[:800]))
+        self.assertTrue(d0.called)
+        self.run_load(d1)
+        self.assertEqual(len(self.state.routers_by_name), 200)
+
+
+class ConsensusExecutorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.calls = []
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.state = TorState(self.protocol, bootstrap=False, consensus_executor=self.executor)
+        self.state.scheduler = self.clock
+        self.tor = FakeTor(routers=20, seed=0, clock=task.Clock())
+
+    def executor(self, func, *args):
+        d = defer.Deferred()
+        self.calls.append((d, func, args))
+        return d
+
+    def run_calls(self):
+        (d, func, args) = self.calls.pop(0)
+        d.callback(func(*args))
+        self.clock.advance(0)
+
+    def send(self, line):
+        self.protocol.dataReceived(line.strip() + "\r\n")
+
+    def test_parse_consensus(self):
+        lines = self.tor.ns_all()[:4]
+        table = parse_consensus('ns/all=\n' + '\n'.join(lines + ['a [::1]:9001']) + '\nOK')
+        self.assertEqual(len(table), 1)
+        r = self.tor.routers[0]
+        self.assertEqual(table[0][0], r.name)
+        self.assertEqual(table[0][4], r.ip)
+        self.assertEqual(table[0][7], r.flags.split())
+        self.assertEqual(table[0][8], r.bandwidth)
+        self.assertEqual(table[0][9], lines[3].split()[1:])
+        self.assertEqual(table[0][10], ['[::1]:9001'])
+
+    def test_same_as_parsing_here(self):
+        data = '\n'.join(self.tor.ns_all())
+        d = self.state._load_consensus(data)
+        self.assertEqual(self.state.routers, {})
+        self.assertEqual(self.calls[0][1:], (parse_consensus, (data,)))
+        self.run_calls()
+        self.assertTrue(d.called)
+
+        here = TorState(FakeControlProtocol(), bootstrap=False)
+        here._update_network_status(data)
+        self.assertEqual(sorted(self.state.routers.keys()), sorted(here.routers.keys()))
+        self.assertEqual(sorted(self.state.guards.keys()), sorted(here.guards.keys()))
+        for (k, router) in here.routers.items():
+            mine = self.state.routers[k]
+            self.assertEqual((mine.name, mine.ip, mine.flags, mine.bandwidth, mine.policy),
+                             (router.name, router.ip, router.flags, router.bandwidth, router.policy))
+
+    def test_superseded(self):
+        self.state._load_consensus('\n'.join(self.tor.ns_all()))
+        d = self.state._load_consensus('\n'.join(self.tor.ns_all()[:8]))
+        self.run_calls()                # the first one's result is ignored
+        self.assertEqual(self.state.routers, {})
+        self.run_calls()
+        self.assertTrue(d.called)
+        self.assertEqual(len(self.state.routers_by_name), 2)
+
+    def test_bootstrap_holds_events(self):
+        d = self.state.post_bootstrap
+        self.protocol._set_valid_events(' '.join(self.state.event_map.keys()))
+        self.state._bootstrap()
+        for ignored in self.state.event_map.items():
+            self.send("250 OK")
+
+        self.send("250+ns/all=")
+        for line in self.tor.ns_all():
+            self.send(line)
+        self.send(".")
+        self.send("250 OK")
+        self.assertEqual(len(self.calls), 1)
+
+        self.send("250-circuit-status=")
+        self.send("250 OK")
+        ## newer than the circuit-status, but that can't be applied
+        ## until the consensus is in
+        self.send("650 CIRC 7 LAUNCHED PURPOSE=GENERAL")
+        self.send("250-stream-status=")
+        self.send("250 OK")
+        self.send("250-address-mappings/all=")
+        self.send("250 OK")
+        self.send("250-entry-guards=")
+        self.send("250 OK")
+        self.send("250-process/pid=1234")
+        self.send("250 OK")
+        self.assertEqual(self.state.circuits, {})
+        self.assertFalse(d.called)
+
+        self.run_calls()
+        self.assertEqual(len(self.state.routers_by_name), 20)
+        self.assertEqual(self.state.circuits.keys(), [7])
+        return d
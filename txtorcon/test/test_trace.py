@@ -0,0 +1,195 @@
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.test import proto_helpers
+
+from txtorcon import TorControlProtocol
+from txtorcon.trace import TraceRecorder, TraceReplay, read_trace, replay_trace
+
+
+SESSION = '''# txtorcon trace 1
+0.000000 > PROTOCOLINFO 1
+0.001000 < 250-PROTOCOLINFO 1
+0.001000 < 250-AUTH METHODS=COOKIE COOKIEFILE="/does/not/exist"
+0.001000 < 250-VERSION Tor="0.2.4.10-alpha"
+0.001000 < 250 OK
+0.002000 > AUTHENTICATE 0123456789abcdef
+0.003000 < 250 OK
+0.004000 > GETINFO version events/names
+0.005000 < 250-version=0.2.4.10-alpha
+0.005000 < 250-events/names=CIRC STREAM
+0.005000 < 250 OK
+0.008000 > USEFEATURE EXTENDED_EVENTS
+0.009000 < 250 OK
+'''
+
+
+class RecorderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.output = StringIO()
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+        self.protocol.trace = TraceRecorder(self.output, self.clock)
+
+    def test_both_directions(self):
+        d = self.protocol.get_info_raw('version')
+        self.clock.advance(1.5)
+        self.protocol.dataReceived('250-version=0.2.4.10-alpha\r\n250 OK\r\n')
+        self.assertEqual(self.output.getvalue(),
+                         '# txtorcon trace 1\n'
+                         '0.000000 > GETINFO version\n'
+                         '1.500000 < 250-version=0.2.4.10-alpha\n'
+                         '1.500000 < 250 OK\n')
+        return d
+
+    def test_round_trip(self):
+        self.protocol.get_info_raw('version')
+        self.protocol.dataReceived('250-version=0.2.4.10-alpha\r\n250 OK\r\n')
+        self.output.seek(0)
+        self.assertEqual(read_trace(self.output),
+                         [(0.0, '>', 'GETINFO version'),
+                          (0.0, '<', '250-version=0.2.4.10-alpha'),
+                          (0.0, '<', '250 OK')])
+
+    def test_multiline_command(self):
+        self.protocol.queue_command('+LOADCONF\r\nSocksPort 9050\r\n.')
+        self.output.seek(0)
+        self.assertEqual([r[2] for r in read_trace(self.output)],
+                         ['+LOADCONF', 'SocksPort 9050', '.'])
+
+    def test_credentials_redacted(self):
+        self.protocol.queue_command('AUTHENTICATE 0123456789abcdef')
+        self.protocol.dataReceived('250 OK\r\n')
+        self.protocol.queue_command('AUTHCHALLENGE SAFECOOKIE 5A5A5A5A5A5A5A5A')
+        self.protocol.dataReceived('250 AUTHCHALLENGE SERVERHASH=FEEDFACEFEEDFACE '
+                                   'SERVERNONCE=C0FFEEC0FFEEC0FF\r\n')
+        self.protocol.queue_command('AUTHENTICATE "my password"')
+        self.protocol.dataReceived('250 OK\r\n')
+
+        trace = self.output.getvalue()
+        for secret in ['0123456789abcdef', '5A5A5A5A5A5A5A5A', 'FEEDFACEFEEDFACE',
+                       'C0FFEEC0FFEEC0FF', 'password']:
+            self.assertFalse(secret in trace, secret)
+        self.output.seek(0)
+        self.assertEqual([r[2] for r in read_trace(self.output)],
+                         ['AUTHENTICATE REDACTED', '250 OK',
+                          'AUTHCHALLENGE SAFECOOKIE REDACTED',
+                          '250 AUTHCHALLENGE SERVERHASH=REDACTED SERVERNONCE=REDACTED',
+                          'AUTHENTICATE REDACTED', '250 OK'])
+
+    def test_bad_line(self):
+        self.assertRaises(RuntimeError, read_trace, StringIO('0.0 ? foo\n'))
+
+
+class ReplayTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.protocol = TorControlProtocol()
+
+    def test_bootstrap_skips_authentication(self):
+        bootstrapped = []
+        self.protocol.post_bootstrap.addCallback(bootstrapped.append)
+        d = replay_trace(StringIO(SESSION), self.protocol, self.clock)
+        self.clock.advance(0)
+        self.clock.advance(0)
+        self.clock.advance(0)
+
+        self.assertEqual(bootstrapped, [self.protocol])
+        self.assertEqual(self.protocol.version, '0.2.4.10-alpha')
+        self.assertEqual(self.protocol.valid_events.keys(), ['CIRC', 'STREAM'])
+
+        replays = []
+        d.addCallback(replays.append)
+        self.assertEqual(len(replays), 1)
+        self.assertEqual(replays[0].mismatches, [])
+        self.assertTrue('PROTOCOLINFO 1' not in replays[0].transport.written)
+
+    def test_waits_for_commands(self):
+        records = [(0.0, '>', 'GETINFO version'),
+                   (0.0, '<', '250-version=foo'),
+                   (0.0, '<', '250 OK')]
+        replay = TraceReplay(records, self.protocol, self.clock)
+        done = replay.start()
+        self.assertFalse(done.called)
+        self.assertEqual(self.protocol.metrics.lines_received, 0)
+
+        result = []
+        self.protocol.get_info('version').addCallback(result.append)
+        self.clock.advance(0)
+        self.assertEqual(result, [{'version': 'foo'}])
+        self.assertTrue(done.called)
+
+    def test_mismatch(self):
+        records = [(0.0, '>', 'GETINFO version'),
+                   (0.0, '<', '250-net/listeners/socks=foo'),
+                   (0.0, '<', '250 OK')]
+        replay = TraceReplay(records, self.protocol, self.clock)
+        replay.start()
+        self.protocol.get_info_raw('net/listeners/socks')
+        self.clock.advance(0)
+        self.assertEqual(replay.mismatches, [('GETINFO version', 'GETINFO net/listeners/socks')])
+
+    def test_realtime(self):
+        records = [(0.0, '>', 'SETEVENTS CIRC'),
+                   (0.0, '<', '250 OK'),
+                   (0.0, '<', '650 CIRC 1 LAUNCHED'),
+                   (1.0, '<', '650 CIRC 1 EXTENDED'),
+                   (3.0, '<', '650 CIRC 1 BUILT')]
+        self.protocol._set_valid_events('CIRC')
+        events = []
+        replay = TraceReplay(records, self.protocol, self.clock, realtime=True, speed=2.0)
+        done = replay.start()
+        self.protocol.add_event_listener('CIRC', events.append)
+        self.clock.advance(0)
+        self.assertEqual(events, ['1 LAUNCHED'])
+
+        self.clock.advance(0.4)
+        self.assertEqual(events, ['1 LAUNCHED'])
+        self.clock.advance(0.1)
+        self.assertEqual(events, ['1 LAUNCHED', '1 EXTENDED'])
+        self.clock.advance(0.9)
+        self.assertEqual(len(events), 2)
+        self.clock.advance(0.1)
+        self.assertEqual(events, ['1 LAUNCHED', '1 EXTENDED', '1 BUILT'])
+        self.assertTrue(done.called)
+
+    def test_fast(self):
+        records = [(0.0, '>', 'SETEVENTS CIRC'),
+                   (0.0, '<', '250 OK'),
+                   (0.0, '<', '650 CIRC 1 LAUNCHED'),
+                   (100.0, '<', '650 CIRC 1 BUILT')]
+        self.protocol._set_valid_events('CIRC')
+        events = []
+        done = TraceReplay(records, self.protocol, self.clock).start()
+        self.protocol.add_event_listener('CIRC', events.append)
+        self.clock.advance(0)
+        self.assertEqual(events, ['1 LAUNCHED', '1 BUILT'])
+        self.assertTrue(done.called)
+
+    def test_paused(self):
+        records = [(0.0, '>', 'SETEVENTS CIRC'),
+                   (0.0, '<', '250 OK'),
+                   (0.0, '<', '650 CIRC 1 LAUNCHED'),
+                   (0.0, '<', '650 CIRC 1 BUILT')]
+        self.protocol._set_valid_events('CIRC')
+        events = []
+
+        def listener(event):
+            events.append(event)
+            self.protocol.transport.pauseProducing()
+        replay = TraceReplay(records, self.protocol, self.clock)
+        replay.start()
+        self.protocol.add_event_listener('CIRC', listener)
+        self.clock.advance(0)
+        self.assertEqual(events, ['1 LAUNCHED'])
+
+        self.protocol.add_event_listener('CIRC', events.append)
+        self.protocol.remove_event_listener('CIRC', listener)
+        replay.transport.resumeProducing()
+        self.clock.advance(0)
+        self.assertEqual(events, ['1 LAUNCHED', '1 BUILT'])
@@ -5,6 +5,7 @@ from twisted.internet.interfaces import IProtocolFactory
 from zope.interface import implements
 
 from txtorcon.util import process_from_address, delete_file_or_tree, find_keywords, ip_from_int
+from txtorcon.util import split_args, unescape_quoted, keyword_flags, LRUDict
 
 import os
 import tempfile
@@ -40,6 +41,68 @@ class TestFindKeywords(unittest.TestCase):
         self.assertEqual(find_keywords("foo=bar $1234567890=routername baz=quux".split()),
                          {'foo': 'bar', 'baz': 'quux'})
 
+    def test_custom_filter(self):
+        self.assertEqual(find_keywords(['foo=bar', '$1234=name', 'baz=a=b'], lambda k: k != 'foo'),
+                         {'$1234': 'name', 'baz': 'a=b'})
+
+    def test_flags(self):
+        flags = keyword_flags({'REASON': 'DONE'})
+        self.assertEqual(flags, {'REASON': 'DONE', 'reason': 'DONE'})
+
+
+class TestSplitArgs(unittest.TestCase):
+
+    def test_plain(self):
+        self.assertEqual(split_args('1 BUILT  $ABCD~foo PURPOSE=GENERAL\n'),
+                         ['1', 'BUILT', '$ABCD~foo', 'PURPOSE=GENERAL'])
+
+    def test_quoted_value(self):
+        args = split_args('NOTICE BOOTSTRAP PROGRESS=100 TAG=done SUMMARY="Done here"')
+        self.assertEqual(args, ['NOTICE', 'BOOTSTRAP', 'PROGRESS=100', 'TAG=done', 'SUMMARY=Done here'])
+        self.assertEqual(find_keywords(args)['SUMMARY'], 'Done here')
+
+    def test_quoted_arg(self):
+        self.assertEqual(split_args('www.example.com 1.2.3.4 "2013-04-03 22:31:22" EXPIRES="2013-04-03 20:31:22"'),
+                         ['www.example.com', '1.2.3.4', '2013-04-03 22:31:22', 'EXPIRES=2013-04-03 20:31:22'])
+
+    def test_escapes(self):
+        self.assertEqual(split_args(r'KEY="a \"b\" c\\" other'), ['KEY=a "b" c\\', 'other'])
+
+    def test_unterminated(self):
+        self.assertEqual(split_args('foo KEY="no end'), ['foo', 'KEY=no end'])
+
+    def test_unescape(self):
+        self.assertEqual(unescape_quoted(r'\n\t\101\\\q'), '\n\tA\\q')
+
+
+class TestLRUDict(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        d = LRUDict(2)
+        d['a'] = 1
+        d['b'] = 2
+        d['a']
+        d['c'] = 3
+        self.assertEqual(d.keys(), ['a', 'c'])
+
+    def test_set_existing(self):
+        d = LRUDict(2)
+        d['a'] = 1
+        d['b'] = 2
+        d['a'] = 3
+        d['c'] = 4
+        self.assertEqual(d.items(), [('a', 3), ('c', 4)])
+
+    def test_iterating_isnt_use(self):
+        d = LRUDict(3)
+        for k in 'abc':
+            d[k] = k
+        self.assertEqual(d.values(), ['a', 'b', 'c'])
+        self.assertEqual(list(d.iteritems()), [('a', 'a'), ('b', 'b'), ('c', 'c')])
+        self.assertTrue('a' in d)
+        d['d'] = 'd'
+        self.assertEqual(d.keys(), ['b', 'c', 'd'])
+
 
 class TestProcessFromUtil(unittest.TestCase):
 
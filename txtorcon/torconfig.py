@@ -8,7 +8,6 @@ import functools
 import random
 import tempfile
 from StringIO import StringIO
-import shlex
 if sys.platform in ('linux2', 'darwin'):
     import pwd
 
@@ -18,8 +17,8 @@ from twisted.internet.interfaces import IStreamServerEndpoint, IReactorTime
 from twisted.internet.endpoints import TCP4ClientEndpoint, TCP4ServerEndpoint
 from zope.interface import implements
 
-from txtorcon.torcontrolprotocol import parse_keywords, TorProtocolFactory
-from txtorcon.util import delete_file_or_tree, find_keywords, find_tor_binary
+from txtorcon.torcontrolprotocol import DEFAULT_VALUE, TorProtocolFactory
+from txtorcon.util import delete_file_or_tree, find_keywords, find_tor_binary, split_args
 from txtorcon.log import txtorlog
 from txtorcon.interface import ITorControlProtocol
 
@@ -366,7 +365,7 @@ class TorProcessProtocol(protocol.ProcessProtocol):
         self.attempted_connect = False
 
     def status_client(self, arg):
-        args = shlex.split(arg)
+        args = split_args(arg)
         if args[1] != 'BOOTSTRAP':
             return
 
@@ -930,10 +929,18 @@ class TorConfig(object):
           Undefined configuration options contain only the KEYWORD.
         """
 
-        conf = parse_keywords(arg, multiline_values=False)
-        for (k, v) in conf.items():
-            ## v will be txtorcon.DEFAULT_VALUE already from
-            ## parse_keywords if it was unspecified
+        ## one keyword per line, values as Tor sent them (not
+        ## unquoted), and a keyword listed more than once (like
+        ## HiddenServicePort) keeps its last value, as it always has
+        ## here -- parse_keywords would make a list of those.
+        for line in arg.split('\n'):
+            line = line.strip()
+            if not line or line == 'OK':
+                continue
+            if '=' in line:
+                (k, v) = line.split('=', 1)
+            else:
+                (k, v) = (line, DEFAULT_VALUE)
             self.config[self._find_real_name(k)] = v
 
     def bootstrap(self, *args):
@@ -1,25 +1,37 @@
 from __future__ import with_statement
 
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.internet import defer
-from twisted.internet.interfaces import IProtocolFactory
-from twisted.protocols.basic import LineOnlyReceiver
+from twisted.internet.interfaces import IProtocolFactory, IReactorTime
+from twisted.internet.protocol import Protocol
+from twisted.internet import reactor
 from zope.interface import implements
 
-from txtorcon.util import hmac_sha256, compare_via_hash
+from txtorcon.util import hmac_sha256, compare_via_hash, unescape_quoted
 from txtorcon.log import txtorlog
 
 from txtorcon.interface import ITorControlProtocol
-from spaghetti import FSM, State, Transition
+from txtorcon.cache import ResponseCache
+from txtorcon.events import event_class, event_key, EventBatcher, EventQueue
+from txtorcon.metrics import ProtocolMetrics
 
 import os
 import re
 import types
 import base64
+import functools
+import itertools
+from collections import deque
 
 DEFAULT_VALUE = 'DEFAULT'
 DEBUG = False
 
+## priority classes for TorControlProtocol.queue_command; lower
+## numbers are issued first
+PRIORITY_CRITICAL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
 
 class TorProtocolError(RuntimeError):
     """
@@ -39,6 +51,153 @@ class TorProtocolError(RuntimeError):
         return str(self.code) + ' ' + self.text
 
 
+class TorReplyTooLong(RuntimeError):
+    """
+    A command's reply contained a line longer than
+    :attr:`UnboundedLineReceiver.MAX_LENGTH`; the line was discarded
+    and the command failed with this, but the control connection is
+    still usable.
+    """
+
+
+class CommandQueue(object):
+    """
+    The commands a TorControlProtocol has waiting to be issued, in
+    one FIFO deque per priority class. :meth:`popleft` takes the
+    oldest command from the most urgent non-empty class, so commands
+    that hold things up inside Tor (like ATTACHSTREAM, where Tor is
+    holding an application's stream open) don't wait behind bulk
+    GETINFO traffic.
+
+    Iterating, indexing and ``len()`` see the commands in the order
+    they'll be issued.
+    """
+
+    critical = ['ATTACHSTREAM', 'REDIRECTSTREAM', 'CLOSESTREAM', 'CLOSECIRCUIT',
+                'PROTOCOLINFO', 'AUTHCHALLENGE', 'AUTHENTICATE']
+    """Commands classified as PRIORITY_CRITICAL by :meth:`classify`"""
+
+    bulk = ['ns/all', 'desc/all-recent', 'md/all', 'network-status', 'dir/',
+            'ip-to-country/']
+    """GETINFO keys (or key prefixes) classified as PRIORITY_BULK by
+    :meth:`classify`"""
+
+    def __init__(self):
+        self.queues = [deque(), deque(), deque()]
+        self.max_depth = [0, 0, 0]
+        """The deepest each class's queue has been."""
+
+    def classify(self, cmd):
+        """
+        :return: the priority class for a command line which wasn't
+            given one explicitly.
+        """
+
+        verb = cmd.split(' ', 1)[0].upper()
+        if verb in self.critical:
+            return PRIORITY_CRITICAL
+        if verb == 'GETINFO':
+            for key in cmd.split()[1:]:
+                if key.startswith(tuple(self.bulk)):
+                    return PRIORITY_BULK
+        return PRIORITY_NORMAL
+
+    def append(self, command, priority=PRIORITY_NORMAL):
+        """
+        Queue a ``(Deferred, cmd, arg, time queued)`` tuple in the
+        given class.
+        """
+
+        queue = self.queues[priority]
+        queue.append(command)
+        if len(queue) > self.max_depth[priority]:
+            self.max_depth[priority] = len(queue)
+
+    def popleft(self):
+        "Remove and return the next command to issue."
+        for queue in self.queues:
+            if queue:
+                return queue.popleft()
+        raise IndexError('pop from an empty CommandQueue')
+
+    def remove(self, d):
+        """
+        Remove the queued command whose Deferred is ``d``.
+
+        :return: True if it was found.
+        """
+
+        for queue in self.queues:
+            for command in queue:
+                if command[0] is d:
+                    queue.remove(command)
+                    return True
+        return False
+
+    def depth(self, priority):
+        "How many commands are waiting in one class."
+        return len(self.queues[priority])
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def __iter__(self):
+        return itertools.chain(*self.queues)
+
+    def __getitem__(self, index):
+        for queue in self.queues:
+            if index < len(queue):
+                return queue[index]
+            index -= len(queue)
+        raise IndexError('CommandQueue index out of range')
+
+
+class TorCommandTimeout(RuntimeError):
+    """
+    A command wasn't answered within its timeout (see
+    :meth:`TorControlProtocol.queue_command`). If it had already been
+    sent to Tor, the control connection is dropped.
+    """
+
+
+class _InfoBatch(object):
+    """
+    The callers sharing one coalesced GETINFO; see
+    TorControlProtocol._coalesce_info.
+    """
+
+    def __init__(self):
+        self.callers = []               # (Deferred, keys, timeout)
+        self.command = None             # queue_command's Deferred, once issued
+        self.retries = {}               # caller's Deferred -> its own command, after a rejection
+
+    def waiting(self, but=None):
+        "the callers still waiting for their reply (other than but)"
+        return [c for c in self.callers if not c[0].called and c[0] is not but]
+
+
+class ReadPauser(object):
+    """
+    Pauses a protocol's transport while anyone (e.g. a full
+    :class:`txtorcon.events.EventQueue`) wants it paused, and resumes
+    it when they all say so.
+    """
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.pauses = 0
+
+    def pauseProducing(self):
+        self.pauses += 1
+        if self.pauses == 1:
+            self.protocol.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.pauses -= 1
+        if self.pauses == 0:
+            self.protocol.transport.resumeProducing()
+
+
 class TorProtocolFactory(object):
     """
     Builds TorControlProtocol objects. Implements IProtocolFactory for
@@ -50,7 +209,7 @@ class TorProtocolFactory(object):
 
     implements(IProtocolFactory)
 
-    def __init__(self, password_function=lambda: None):
+    def __init__(self, password_function=lambda: None, max_in_flight=1):
         """
         Builds protocols to talk to a Tor client on the specified
         address. For example::
@@ -66,8 +225,13 @@ class TorProtocolFactory(object):
            password (or a Deferred). By default, it returns None. This
            is only queried if the Tor we connect to doesn't support
            (or hasn't enabled) COOKIE authentication.
+
+        :param max_in_flight:
+           Passed on to every :class:`txtorcon.TorControlProtocol`
+           built; see there.
         """
         self.password_function = password_function
+        self.max_in_flight = max_in_flight
 
     def doStart(self):
         ":api:`twisted.internet.interfaces.IProtocolFactory` API"
@@ -77,7 +241,8 @@ class TorProtocolFactory(object):
 
     def buildProtocol(self, addr):
         ":api:`twisted.internet.interfaces.IProtocolFactory` API"
-        proto = TorControlProtocol(self.password_function)
+        proto = TorControlProtocol(self.password_function,
+                                   max_in_flight=self.max_in_flight)
         proto.factory = self
         return proto
 
@@ -90,38 +255,135 @@ class Event(object):
     This allows you to listen for such an event; see
     TorController.add_event The callbacks will be called every time
     the event in question is received.
+
+    "typed" callbacks are called with an instance of
+    :attr:`event_class` (see :mod:`txtorcon.events`) instead of the
+    raw string; all of them share one instance per event.
     """
     def __init__(self, name):
         self.name = name
         self.callbacks = []
+        self.typed_callbacks = []
+        self.event_class = event_class(name)
 
-    def listen(self, cb):
-        self.callbacks.append(cb)
+    def listen(self, cb, typed=False):
+        if typed:
+            self.typed_callbacks.append(cb)
+        else:
+            self.callbacks.append(cb)
 
     def unlisten(self, cb):
-        self.callbacks.remove(cb)
+        if cb in self.typed_callbacks:
+            self.typed_callbacks.remove(cb)
+        else:
+            self.callbacks.remove(cb)
 
     def got_update(self, data):
         #print self.name,"got_update:",data
         for cb in self.callbacks:
             cb(data)
+        if self.typed_callbacks:
+            event = self.event_class(data)
+            for cb in self.typed_callbacks:
+                cb(event)
 
 
 def unquote(word):
-    if len(word) == 0:
+    """
+    Removes the quotes from a quoted value. A double-quoted value is a
+    control-spec QuotedString, so its escapes are decoded too (see
+    :func:`txtorcon.util.unescape_quoted`).
+    """
+
+    if len(word) < 2:
         return word
     if word[0] == '"' and word[-1] == '"':
-        return word[1:-1]
+        return unescape_quoted(word[1:-1])
     elif word[0] == "'" and word[-1] == "'":
         return word[1:-1]
     return word
 
 
+def _iter_lines(lines):
+    "the lines of a string (without splitting it all at once), or of an iterable of lines"
+    if not isinstance(lines, types.StringTypes):
+        for line in lines:
+            yield line
+        return
+
+    start = 0
+    while True:
+        end = lines.find('\n', start)
+        if end == -1:
+            yield lines[start:]
+            return
+        yield lines[start:end]
+        start = end + 1
+
+
+def _value(first, more):
+    "a (possibly multi-line) value, unquoted"
+    if more:
+        more.insert(0, first)
+        first = '\n'.join(more)
+    if first[:1] in ('"', "'"):
+        return unquote(first)
+    return first
+
+
+def iter_keywords(lines, multiline_values=True):
+    """
+    Generator version of :func:`parse_keywords`: yields ``(key,
+    value)`` pairs in order as it works through the reply (so a
+    repeated key is yielded repeatedly), without building the whole
+    result -- or splitting the whole reply up front. ``lines`` may be
+    a string or an iterable of lines (for example, from
+    :meth:`TorControlProtocol.get_info_lines`).
+    """
+
+    key = None
+    value = None                        # first line of the current value
+    more = None                         # any further lines of it
+    for line in _iter_lines(lines):
+        if '=' in line:
+            if key is not None:
+                yield (key, _value(value, more))
+            (key, value) = line.split('=', 1)
+            more = None
+            continue
+
+        stripped = line.strip()
+        if stripped == 'OK':
+            continue
+
+        if key is None:
+            yield (stripped, DEFAULT_VALUE)
+
+        elif multiline_values is False:
+            yield (key, _value(value, more))
+            yield (stripped, DEFAULT_VALUE)
+            key = None
+
+        elif more is None:
+            more = [line]
+
+        else:
+            more.append(line)
+
+    if key is not None:
+        yield (key, _value(value, more))
+
+
 def parse_keywords(lines, multiline_values=True):
     """
     Utility method to parse name=value pairs (GETINFO etc). Takes a
     string with newline-separated lines and expects at most one = sign
-    per line. Accumulates multi-line values.
+    per line. Accumulates multi-line values. Quoted values are
+    unquoted (see :func:`unquote`) and a key appearing more than once
+    gets a list of its values.
+
+    This is a single pass over the reply; see :func:`iter_keywords`
+    to get the pairs one at a time instead.
 
     :param multiline_values:
         The default is True which allows for multi-line values until a
@@ -131,49 +393,150 @@ def parse_keywords(lines, multiline_values=True):
         'Bar' with value DEFAULT_VALUE.
     """
 
+    if isinstance(lines, types.StringTypes):
+        lines = lines.split('\n')
     rtn = {}
-    key = None
-    value = ''
-    ## FIXME could use some refactoring to reduce code duplication!
-    for line in lines.split('\n'):
-        if line.strip() == 'OK':
-            continue
+    repeated = set()                    # keys whose value is already a list
+    for (key, value) in iter_keywords(lines, multiline_values):
+        if key not in rtn or value is DEFAULT_VALUE:
+            rtn[key] = value
+        elif key in repeated:
+            rtn[key].append(value)
+        else:
+            rtn[key] = [rtn[key], value]
+            repeated.add(key)
+    return rtn
 
-        if '=' in line:
-            if key:
-                if key in rtn:
-                    if isinstance(rtn[key], types.ListType):
-                        rtn[key].append(unquote(value))
-                    else:
-                        rtn[key] = [rtn[key], unquote(value)]
-                else:
-                    rtn[key] = unquote(value)
-            (key, value) = line.split('=', 1)
 
+def split_info_reply(reply, keys):
+    """
+    Splits the raw reply to a multi-key GETINFO back up by key,
+    returning a dict mapping each key to its own part of the reply
+    (for example ``'version=0.2.3.25'`` or ``'ns/all=\\nr ...'``).
+
+    Tor answers the keys in the order they were asked for, so each
+    key's part runs from the line starting with ``key=`` up to the
+    next key's line.
+    """
+
+    if reply.endswith('\nOK'):
+        reply = reply[:-3]
+    parts = {}
+    start = 0
+    for (i, key) in enumerate(keys):
+        if not reply.startswith(key + '=', start):
+            raise RuntimeError('Expected "%s=" in GETINFO reply at offset %d' % (key, start))
+        if i + 1 < len(keys):
+            end = reply.find('\n' + keys[i + 1] + '=', start)
+            if end < 0:
+                raise RuntimeError('Expected "%s=" in GETINFO reply' % keys[i + 1])
         else:
-            if key is None:
-                rtn[line.strip()] = DEFAULT_VALUE
+            end = len(reply)
+        parts[key] = reply[start:end]
+        start = end + 1
+    return parts
 
-            elif multiline_values is False:
-                rtn[key] = value
-                rtn[line.strip()] = DEFAULT_VALUE
-                key = None
-                value = ''
 
+def _timeout_kwarg(kwargs):
+    """
+    Pops the keyword-only ``timeout`` argument of the ``*args``
+    helper methods (get_info, get_conf, ...).
+    """
+
+    timeout = kwargs.pop('timeout', None)
+    if kwargs:
+        raise TypeError("Unexpected keyword arguments: %s" % ', '.join(kwargs.keys()))
+    return timeout
+
+
+class UnboundedLineReceiver(Protocol):
+    """
+    Like :api:`twisted.protocols.basic.LineOnlyReceiver` but without
+    its small (16KiB) maximum line length; some single-line Tor
+    replies (``GETINFO network-status`` for example) are much bigger
+    than that.
+
+    Received data is appended to one bytearray and complete lines are
+    sliced out through a memoryview, so a long line arriving in many
+    chunks is neither re-copied nor re-scanned for the delimiter on
+    every dataReceived.
+
+    MAX_LENGTH is still a hard cap on memory: the rest of a line
+    longer than that is discarded and :meth:`lineLengthExceeded` is
+    called with its beginning instead of lineReceived.
+    """
+
+    delimiter = '\r\n'
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    _buffer = None
+    _search_from = 0                    # no delimiter in _buffer before this
+    _discarding = False                 # dropping the rest of an over-long line
+
+    def dataReceived(self, data):
+        "Protocol API"
+
+        if self._buffer is None:
+            self._buffer = bytearray()
+        buf = self._buffer
+        buf.extend(data)
+        delim = self.delimiter
+
+        lines = []                      # (too_long, line) pairs
+        start = 0
+        end = buf.find(delim, self._search_from)
+        if end >= 0:
+            view = memoryview(buf)
+            while end >= 0:
+                if self._discarding:
+                    self._discarding = False
+                elif end - start > self.MAX_LENGTH:
+                    lines.append((True, view[start:start + 128].tobytes()))
+                else:
+                    lines.append((False, view[start:end].tobytes()))
+                start = end + len(delim)
+                end = buf.find(delim, start)
+            del view                    # a bytearray can't resize while viewed
+            del buf[:start]
+
+        if len(buf) > self.MAX_LENGTH and not self._discarding:
+            lines.append((True, str(buf[:128])))
+            self._discarding = True
+        if self._discarding:
+            ## keep enough to spot a delimiter split across reads
+            del buf[:1 - len(delim)]
+        self._search_from = max(0, len(buf) + 1 - len(delim))
+
+        for (too_long, line) in lines:
+            if self.transport.disconnecting:
+                return
+            if too_long:
+                self.lineLengthExceeded(line)
             else:
-                value = value + '\n' + line
-    if key:
-        if key in rtn:
-            if isinstance(rtn[key], types.ListType):
-                rtn[key].append(unquote(value))
-            else:
-                rtn[key] = [rtn[key], unquote(value)]
-        else:
-            rtn[key] = unquote(value)
-    return rtn
+                self.lineReceived(line)
 
+    def lineReceived(self, line):
+        """
+        Override this for when each line is received.
+        """
+        raise NotImplementedError
 
-class TorControlProtocol(LineOnlyReceiver):
+    def lineLengthExceeded(self, line):
+        """
+        Called with the beginning of a line longer than MAX_LENGTH
+        (the rest of it is discarded). By default, drops the
+        connection.
+        """
+        return self.transport.loseConnection()
+
+    def sendLine(self, line):
+        """
+        Sends a line, adding the delimiter.
+        """
+        return self.transport.write(line + self.delimiter)
+
+
+class TorControlProtocol(UnboundedLineReceiver):
     """
     This is the main class that talks to a Tor and implements the "raw"
     procotol.
@@ -194,12 +557,19 @@ class TorControlProtocol(LineOnlyReceiver):
 
     implements(ITorControlProtocol)
 
-    def __init__(self, password_function=None):
+    def __init__(self, password_function=None, max_in_flight=1):
         """
         :param password_function:
             A zero-argument callable which returns a password (or
             Deferred). It is only called if the Tor doesn't have
             COOKIE authentication turned on. Tor's default is COOKIE.
+
+        :param max_in_flight:
+            How many commands may be on the wire awaiting a reply at
+            once. The default of 1 waits for each reply before
+            issuing the next command; anything larger pipelines
+            commands (Tor answers in order, so replies are matched
+            to commands first-in, first-out).
         """
 
         self.password_function = password_function
@@ -242,82 +612,225 @@ class TorControlProtocol(LineOnlyReceiver):
         See the helper method :func:`txtorcon.build_tor_connection`.
         """
 
+        self.max_in_flight = max_in_flight
+        """Maximum number of commands awaiting a reply at once (see
+        the constructor). May be changed at any time."""
+
+        self.command_timeout = None
+        """If not None, the timeout (in seconds) for commands queued
+        without an explicit one; see :meth:`queue_command`."""
+
+        self.coalesce_info = False
+        """If True, all the get_info and get_info_raw calls made during
+        one reactor turn are sent as a single multi-key GETINFO and
+        the reply split back up for each caller."""
+
+        self.scheduler = IReactorTime(reactor)
+        self._pending_info = None       # _InfoBatch for the next coalesced GETINFO
+
+        self.cache = None
+        """A :class:`txtorcon.cache.ResponseCache` for GETINFO and
+        GETCONF replies, if set; see :meth:`enable_cache`."""
+
+        self._read_pauser = ReadPauser(self)  # for "block" EventQueues
+
+        self.metrics = ProtocolMetrics(self.scheduler)
+        """A :class:`txtorcon.metrics.ProtocolMetrics` with counters
+        and timings for this connection."""
+
+        self.trace = None
+        """If set, a :class:`txtorcon.trace.TraceRecorder` which is
+        given every line sent to and received from Tor."""
+
         ## variables related to the state machine
         self.defer = None               # Deferred we returned for the current command
-        self.response = ''
+        self.response = []              # lines of the current reply; joined once, in _broadcast_response
         self.code = None
         self.command = None             # currently processing this command
-        self.commands = []              # queued commands
-
-        ## Here we build up the state machine. Mostly it's pretty
-        ## simply, confounded by the fact that 600's (notify) can come
-        ## at any time AND can be multi-line itself. Luckily, these
-        ## can't be nested, nor can the responses be interleaved.
-
-        idle = State("IDLE")
-        recv = State("RECV")
-        recvmulti = State("RECV_PLUS")
-        recvnotify = State("NOTIFY_MULTILINE")
-
-        idle.add_transition(Transition(idle,
-                                       self._is_single_line_response,
-                                       self._broadcast_response))
-        idle.add_transition(Transition(recvmulti,
-                                       self._is_multi_line,
-                                       self._start_command))
-        idle.add_transition(Transition(recv,
-                                       self._is_continuation_line,
-                                       self._start_command))
-
-        recv.add_transition(Transition(recv,
-                                       self._is_continuation_line,
-                                       self._accumulate_response))
-        recv.add_transition(Transition(idle,
-                                       self._is_finish_line,
-                                       self._broadcast_response))
-
-        recvmulti.add_transition(Transition(recv,
-                                            self._is_end_line,
-                                            lambda x: None))
-        recvmulti.add_transition(Transition(recvmulti,
-                                            self._is_not_end_line,
-                                            self._accumulate_multi_response))
-
-        self.fsm = FSM([recvnotify, idle, recvmulti, recv])
-        self.state_idle = idle
-        ## hand-set initial state default start state is first in the
-        ## list; the above looks nice in dotty though
-        self.fsm.state = idle
+        self.commands = CommandQueue()  # queued commands, by priority
+        self.in_flight = deque()        # issued commands, awaiting replies in order
+
+        ## Reply framing. Mostly it's pretty simple, confounded by
+        ## the fact that 600's (notify) can come at any time AND can
+        ## be multi-line themselves. Luckily, these can't be nested,
+        ## nor can the responses be interleaved. Each line is looked
+        ## at once: lineReceived picks a handler out of one of these
+        ## tables by the character following the status code,
+        ## depending on whether we're between replies or part-way
+        ## through one.
+        self._reply_code = None         # status code (string) of the reply in progress
+        self._in_data = False           # inside a "+" data block, until a lone "."
+        self._too_long = False          # a line of the current reply/event was discarded
+        self._idle_handlers = {' ': self._reply_single,
+                               '-': self._reply_begin,
+                               '+': self._reply_begin_data}
+        self._reply_handlers = {' ': self._reply_end,
+                                '-': self._accumulate_response,
+                                '+': self._reply_continue_data}
+
         if DEBUG:
             self.debuglog = open('txtorcon-debug.log', 'w')
-            with open('fsm.dot', 'w') as fsmfile:
-                fsmfile.write(self.fsm.dotty())
 
-    ## see end of file for all the state machine matcher and
-    ## transition methods.
+    ## see end of file for the reply-framing handlers.
 
-    def get_info_raw(self, *args):
+    def get_info_raw(self, *args, **kwargs):
         """
         Mostly for internal use; gives you the raw string back from
         the GETINFO command. See :meth:`getinfo <txtorcon.TorControlProtocol.get_info>`
+
+        If :attr:`coalesce_info` is set, the command isn't sent until
+        the end of this reactor turn so it can be combined with other
+        callers' GETINFOs.
+
+        :param timeout: keyword-only; see :meth:`queue_command`
         """
+        timeout = _timeout_kwarg(kwargs)
         info = ' '.join(map(lambda x: str(x), list(args)))
-        return self.queue_command('GETINFO %s' % info)
+        if self.cache is not None and info.strip():
+            return self.cache.fetch('GETINFO', info.split(),
+                                    functools.partial(self._get_info_raw, info, timeout))
+        return self._get_info_raw(info, timeout)
+
+    def _get_info_raw(self, info, timeout=None):
+        "get_info_raw, minus the cache"
+        if self.coalesce_info and info.strip():
+            return self._coalesce_info(info.split(), timeout)
+        return self.queue_command('GETINFO %s' % info, timeout=timeout)
+
+    def _coalesce_info(self, keys, timeout=None):
+        """
+        Queues the keys for the next coalesced GETINFO (see
+        _issue_coalesced_info), returning a Deferred for just these
+        keys' raw reply. Its timeout and cancellation are its own: it
+        gives up on the shared command without affecting the other
+        callers.
+        """
 
-    def get_info_incremental(self, key, line_cb):
+        if timeout is None:
+            timeout = self.command_timeout
+        if self._pending_info is None:
+            self._pending_info = _InfoBatch()
+            self.scheduler.callLater(0, self._issue_coalesced_info)
+        batch = self._pending_info
+        d = defer.Deferred(functools.partial(self._drop_coalesced, batch))
+        batch.callers.append((d, keys, timeout))
+        return d
+
+    def _drop_coalesced(self, batch, d):
+        """
+        Canceller for the Deferreds from _coalesce_info (and called
+        when one times out): the shared command is only cancelled once
+        no other caller is waiting on it.
+        """
+
+        if d in batch.retries:
+            batch.retries.pop(d).cancel()
+        elif batch.command is not None and not batch.waiting(d):
+            batch.command.cancel()
+
+    def _coalesced_timed_out(self, batch, d, timeout):
+        "scheduled by _issue_coalesced_info"
+        d.errback(TorCommandTimeout('No reply to "GETINFO" after %s seconds.' % timeout))
+        self._drop_coalesced(batch, d)
+
+    def _issue_coalesced_info(self):
+        """
+        Sends one GETINFO for every key asked for during the last
+        reactor turn. If Tor rejects it (e.g. one of the keys is
+        invalid) each caller's request is re-sent on its own, so only
+        the offending callers see the error.
+
+        The command gets the longest of the callers' timeouts; each
+        caller with a shorter one times out on its own, leaving the
+        command to the rest.
+        """
+
+        batch = self._pending_info
+        self._pending_info = None
+        callers = batch.waiting()
+        if not callers:
+            return
+
+        timeouts = [timeout for (d, keys, timeout) in callers]
+        longest = None if None in timeouts else max(timeouts)
+        for (d, keys, timeout) in callers:
+            if timeout is not None and timeout != longest:
+                call = self.scheduler.callLater(timeout, self._coalesced_timed_out, batch, d, timeout)
+                d.addBoth(self._cancel_timeout, call)
+
+        if len(callers) == 1:
+            (d, keys, timeout) = callers[0]
+            batch.command = self.queue_command('GETINFO %s' % ' '.join(keys), timeout=timeout)
+            batch.command.chainDeferred(d)
+            return
+
+        allkeys = []
+        seen = set()
+        for (d, keys, timeout) in callers:
+            for k in keys:
+                if k not in seen:
+                    seen.add(k)
+                    allkeys.append(k)
+
+        def split(reply):
+            parts = split_info_reply(reply, allkeys)
+            for (d, keys, timeout) in batch.waiting():
+                d.callback('\n'.join(parts[k] for k in keys) + '\nOK')
+
+        def relay(result, d):
+            batch.retries.pop(d, None)
+            if d.called:
+                return None
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+        def retry(fail):
+            fail.trap(TorProtocolError)
+            for (d, keys, timeout) in batch.waiting():
+                cmd = batch.retries[d] = self.queue_command('GETINFO %s' % ' '.join(keys), timeout=timeout)
+                cmd.addBoth(relay, d)
+
+        def failed(fail):
+            for (d, keys, timeout) in batch.waiting():
+                d.errback(fail)
+
+        batch.command = self.queue_command('GETINFO %s' % ' '.join(allkeys), timeout=longest)
+        batch.command.addCallbacks(split, retry).addErrback(failed)
+
+    def get_info_incremental(self, key, line_cb, timeout=None, priority=None):
         """
         Mostly for internal use; calls GETINFO for a single key and
         calls line_cb with each line received, as it is received.
 
-        See :meth:`getinfo <txtorcon.TorControlProtocol.get_info>`
+        See :meth:`getinfo <txtorcon.TorControlProtocol.get_info>`;
+        ``timeout`` and ``priority`` are as for :meth:`queue_command`.
         """
 
-        return self.queue_command('GETINFO %s' % key, line_cb)
+        return self.queue_command('GETINFO %s' % key, line_cb, priority=priority, timeout=timeout)
+
+    def get_info_lines(self, *args, **kwargs):
+        """
+        Like :meth:`get_info_raw
+        <txtorcon.TorControlProtocol.get_info_raw>` except the
+        Deferred callbacks with a list of the reply lines (including
+        the final ``OK``) rather than one string. For very large
+        replies (``ns/all``, ``desc/all-recent``, ...) this avoids
+        building the whole reply as a single string.
+        """
+
+        timeout = _timeout_kwarg(kwargs)
+        info = ' '.join(map(lambda x: str(x), list(args)))
+        lines = []
+        d = self.queue_command('GETINFO %s' % info, lines.append, timeout=timeout)
+        d.addCallback(lambda _: lines)
+        return d
 
     ## The following methods are the main TorController API and
     ## probably the most interesting for users.
 
-    def get_info(self, *args):
+    def get_info(self, *args, **kwargs):
         """
         Uses GETINFO to obtain informatoin from Tor.
 
@@ -334,10 +847,12 @@ class TorControlProtocol(LineOnlyReceiver):
             the keys you asked for. This just inserts ``parse_keywords``
             in the callback chain; if you want to avoid the parsing
             into a dict, you can use get_info_raw instead.
+
+        :param timeout: keyword-only; see :meth:`queue_command`
         """
-        return self.get_info_raw(*args).addCallback(parse_keywords).addErrback(log.err)
+        return self.get_info_raw(*args, **kwargs).addCallback(parse_keywords).addErrback(log.err)
 
-    def get_conf(self, *args):
+    def get_conf(self, *args, **kwargs):
         """
         Uses GETCONF to obtain configuration values from Tor.
 
@@ -358,18 +873,57 @@ class TorControlProtocol(LineOnlyReceiver):
         differentiate these by setting the value in the dict to
         DEFAULT_VALUE for the default value case, or an empty string
         otherwise.
+
+        :param timeout: keyword-only; see :meth:`queue_command`
         """
 
-        return self.queue_command('GETCONF %s' % ' '.join(args)).addCallback(parse_keywords).addErrback(log.err)
+        return self.get_conf_raw(*args, **kwargs).addCallback(parse_keywords).addErrback(log.err)
 
-    def get_conf_raw(self, *args):
+    def get_conf_raw(self, *args, **kwargs):
         """
         Same as get_conf, except that the results are not parsed into a dict
         """
 
-        return self.queue_command('GETCONF %s' % ' '.join(args))
+        timeout = _timeout_kwarg(kwargs)
+        conf = ' '.join(args)
+        if self.cache is not None and conf.strip():
+            return self.cache.fetch('GETCONF', conf.split(),
+                                    functools.partial(self.queue_command, 'GETCONF %s' % conf,
+                                                      timeout=timeout))
+        return self.queue_command('GETCONF %s' % conf, timeout=timeout)
 
-    def set_conf(self, *args):
+    def enable_cache(self):
+        """
+        Turns on caching of GETINFO and GETCONF replies (see
+        :class:`txtorcon.cache.ResponseCache` for how long things are
+        kept), including sharing one command between identical
+        requests already in flight. Once we're bootstrapped (or right
+        away, if we already are), we listen for the CONF_CHANGED and
+        NEWCONSENSUS events (if this Tor has them) to throw out stale
+        replies.
+
+        :return: the ResponseCache instance (also available as
+            :attr:`cache`)
+        """
+
+        if self.cache is None:
+            self.cache = ResponseCache(self.scheduler)
+            if self.post_bootstrap is None:
+                ## _bootstrap has finished
+                self._listen_for_cache_invalidation()
+            else:
+                self.post_bootstrap.addCallback(self._listen_for_cache_invalidation)
+        return self.cache
+
+    def _listen_for_cache_invalidation(self, arg=None):
+        "post_bootstrap callback (or called directly); see enable_cache"
+        for (name, cb) in [('CONF_CHANGED', self.cache.conf_changed),
+                           ('NEWCONSENSUS', self.cache.new_consensus)]:
+            if name in self.valid_events:
+                self.add_event_listener(name, cb)
+        return arg
+
+    def set_conf(self, *args, **kwargs):
         """
         set configuration values. see control-spec for valid
         keys. args is treated as a list containing name then value
@@ -379,7 +933,10 @@ class TorControlProtocol(LineOnlyReceiver):
         :return: a ``Deferred`` that will callback with the response
             ('OK') or errback with the error code and message (e.g.
             ``"552 Unrecognized option: Unknown option 'foo'.  Failing."``)
+
+        :param timeout: keyword-only; see :meth:`queue_command`
         """
+        timeout = _timeout_kwarg(kwargs)
         if len(args) % 2:
             d = defer.Deferred()
             d.errback(RuntimeError("Expected an even number of arguments."))
@@ -394,9 +951,11 @@ class TorControlProtocol(LineOnlyReceiver):
             return s
         values = map(maybe_quote, values)
         args = ' '.join(map(lambda x, y: '%s=%s' % (x, y), keys, values))
-        return self.queue_command('SETCONF ' + args)
+        if self.cache is not None:
+            self.cache.conf_changed()
+        return self.queue_command('SETCONF ' + args, timeout=timeout)
 
-    def signal(self, nm):
+    def signal(self, nm, timeout=None):
         """
         Issues a signal to Tor. See control-spec or
         :attr:`txtorcon.TorControlProtocol.valid_signals` for which ones
@@ -407,9 +966,10 @@ class TorControlProtocol(LineOnlyReceiver):
         """
         if not nm in self.valid_signals:
             raise RuntimeError("Invalid signal " + nm)
-        return self.queue_command('SIGNAL %s' % nm)
+        return self.queue_command('SIGNAL %s' % nm, timeout=timeout)
 
-    def add_event_listener(self, evt, callback):
+    def add_event_listener(self, evt, callback, typed=False, batch=None, collapse=False,
+                           queue=None, policy='drop-oldest'):
         """
         :param evt: event name, see also
         :var:`txtorcon.TorControlProtocol.events` .keys()
@@ -422,7 +982,33 @@ class TorControlProtocol(LineOnlyReceiver):
         argument, that is the text collected for the event from the
         tor control protocol.
 
-        :Return: ``None``
+        :param typed: if True, the callback is instead given a
+            :class:`txtorcon.events.TorEvent` (e.g. a
+            :class:`txtorcon.events.CircEvent` for CIRC) which parses
+            fields out of the text on demand.
+
+        :param batch: if not None, the callback is instead called
+            with a list of the events received in each window of this
+            many seconds (0 means: each reactor turn); see
+            :class:`txtorcon.events.EventBatcher`.
+
+        :param collapse: if True (or a key function; see
+            :func:`txtorcon.events.event_key`, the default) a batched
+            event replaces any earlier one for the same circuit,
+            stream, etc. still waiting in the batch. Implies batching.
+
+        :param queue: if not None, the callback is called from a
+            queue of at most this many events, drained each reactor
+            turn, so a slow (or broken) listener can't hold up the
+            connection; see :class:`txtorcon.events.EventQueue`. Can't
+            be combined with batch.
+
+        :param policy: what the queue does when full: "drop-oldest",
+            "coalesce" or "block" (stop reading from Tor until it
+            drains).
+
+        :Return: ``None``, or the EventBatcher or EventQueue wrapping
+            callback (e.g. to look at its counters).
 
         .. todo:: need an interface for the callback
         """
@@ -433,11 +1019,24 @@ class TorControlProtocol(LineOnlyReceiver):
             except:
                 raise RuntimeError("Unknown event type: " + evt)
 
+        wrapper = None
+        if queue is not None:
+            if batch is not None or collapse:
+                raise ValueError("Can't both queue and batch an event listener.")
+            wrapper = EventQueue(callback, self.scheduler, queue, policy, self._read_pauser)
+
+        elif batch is not None or collapse:
+            if collapse and not callable(collapse):
+                collapse = event_key
+            wrapper = EventBatcher(callback, self.scheduler, batch or 0, collapse or None)
+
         if evt.name not in self.events:
             self.events[evt.name] = evt
             self.queue_command('SETEVENTS %s' % ' '.join(self.events.keys()))
-        evt.listen(callback)
-        return None
+        if wrapper is not None:
+            callback = wrapper
+        evt.listen(callback, typed)
+        return wrapper
 
     def remove_event_listener(self, evt, cb):
         if not evt in self.valid_events.values():
@@ -447,7 +1046,7 @@ class TorControlProtocol(LineOnlyReceiver):
                 raise RuntimeError("Unknown event type: " + evt)
 
         evt.unlisten(cb)
-        if len(evt.callbacks) == 0:
+        if len(evt.callbacks) == 0 and len(evt.typed_callbacks) == 0:
             del self.events[evt.name]
             self.queue_command('SETEVENTS %s' % ' '.join(self.events.keys()))
 
@@ -465,35 +1064,153 @@ class TorControlProtocol(LineOnlyReceiver):
     def quit(self):
         return self.queue_command('QUIT')
 
-    def queue_command(self, cmd, arg=None):
+    def queue_command(self, cmd, arg=None, priority=None, timeout=None):
         """
         returns a Deferred which will fire with the response data when
         we get it
+
+        Cancelling the Deferred (``d.cancel()``) removes the command
+        from the queue if it hasn't been sent yet; if it has, Tor's
+        reply is discarded when it arrives.
+
+        :param priority: one of PRIORITY_CRITICAL, PRIORITY_NORMAL or
+            PRIORITY_BULK; queued commands are issued most urgent
+            class first (and in order within a class). If None, the
+            class is picked by :meth:`CommandQueue.classify
+            <txtorcon.torcontrolprotocol.CommandQueue.classify>`:
+            stream attachment, closing and authentication commands are
+            critical, and GETINFOs of things like ns/all are bulk.
+
+        :param timeout: if not None (the default is
+            :attr:`command_timeout`), seconds after which the Deferred
+            errbacks with :class:`TorCommandTimeout
+            <txtorcon.torcontrolprotocol.TorCommandTimeout>`. A command
+            still in the queue is simply removed; one already sent to
+            Tor means Tor has stopped answering us (and every reply
+            after it is stuck behind it), so the connection is dropped
+            and all other outstanding commands fail too.
         """
 
-        d = defer.Deferred()
-        self.commands.append((d, cmd, arg))
+        if priority is None:
+            priority = self.commands.classify(cmd)
+        if timeout is None:
+            timeout = self.command_timeout
+        d = defer.Deferred(self._cancel_command)
+        self.metrics.command_queued(len(self.commands))
+        self.commands.append((d, cmd, arg, self.scheduler.seconds()), priority)
+        if timeout is not None:
+            call = self.scheduler.callLater(timeout, self._command_timed_out, d, cmd, timeout)
+            d.addBoth(self._cancel_timeout, call)
         self._maybe_issue_command()
         return d
 
+    def connectionLost(self, reason):
+        """
+        Protocol API
+
+        Fails every command that's queued or awaiting a reply.
+        """
+
+        pending = list(self.in_flight)
+        self.in_flight.clear()
+        while len(self.commands):
+            pending.append(self.commands.popleft())
+        self.command = None
+        self.defer = None
+        self.code = None
+        self.response = []
+        for command in pending:
+            if not command[0].called:
+                command[0].errback(reason)
+
     ## the remaining methods are internal API implementations,
     ## callbacks and state-tracking methods -- you shouldn't have any
     ## need to call them.
 
+    def _cancel_command(self, d):
+        "canceller for the Deferreds returned by queue_command"
+
+        if self.commands.remove(d):
+            return
+        ## already sent, so Tor's reply still has its place in the
+        ## order; drop any line callback and discard the reply (see
+        ## _broadcast_response) when it arrives.
+        for (i, command) in enumerate(self.in_flight):
+            if command[0] is d:
+                self.in_flight[i] = (d, command[1], None, command[3])
+                if self.command is command:
+                    self.command = self.in_flight[i]
+
+    def _command_timed_out(self, d, cmd, timeout):
+        "scheduled by queue_command"
+
+        sent = not self.commands.remove(d)
+        d.errback(TorCommandTimeout('No reply to "%s" after %s seconds.' % (cmd.split(' ', 1)[0], timeout)))
+        if sent:
+            txtorlog.msg("command timed out; dropping connection:", cmd)
+            self.transport.loseConnection()
+
+    def _cancel_timeout(self, arg, call):
+        "callback/errback to cancel a queue_command timeout"
+        if call.active():
+            call.cancel()
+        return arg
+
+    def dataReceived(self, data):
+        "Protocol API"
+        self.metrics.bytes_received += len(data)
+        UnboundedLineReceiver.dataReceived(self, data)
+
+    def lineLengthExceeded(self, line):
+        """
+        :class:`txtorcon.torcontrolprotocol.UnboundedLineReceiver` API
+
+        Rather than dropping the connection, the current reply (or
+        event) is marked as failed and its framing carries on as
+        though the line were empty; see _broadcast_response.
+        """
+
+        txtorlog.msg("discarding line longer than %d bytes:" % self.MAX_LENGTH, line[:64])
+        self._too_long = True
+        if not self._in_data:
+            self.lineReceived(line[:4])
+
     def lineReceived(self, line):
         """
-        :api:`twisted.protocols.basic.LineOnlyReceiver` API
+        :class:`txtorcon.torcontrolprotocol.UnboundedLineReceiver` API
         """
 
+        self.metrics.lines_received += 1
+        if self.trace is not None:
+            self.trace.received(line)
         if DEBUG:
             self.debuglog.write(line + '\n')
             self.debuglog.flush()
 
-        self.fsm.process(line)
+        if self._in_data:
+            if line.strip() == '.':
+                self._in_data = False
+            else:
+                self._accumulate_multi_response(line)
+            return
+
+        code = line[:3]
+        if self._reply_code is None:
+            handler = self._idle_handlers.get(line[3:4])
+        else:
+            handler = self._reply_handlers.get(line[3:4])
+            if handler is not self._reply_end and code != self._reply_code:
+                raise RuntimeError("Unexpected code %s, wanted %s" % (code, self._reply_code))
+
+        if handler is None or not code.isdigit():
+            raise RuntimeError('Unexpected line from Tor: "%s"' % line)
+        handler(line)
 
     def connectionMade(self):
         "LineOnlyReceiver API (or parent?)"
         txtorlog.msg('got connection, authenticating')
+        if self.cache is not None:
+            self.cache.clear()
         self.protocolinfo().addCallback(self._do_authenticate).addErrback(self._auth_failed)
 
     def _handle_notify(self, code, rest):
@@ -504,32 +1221,43 @@ class TorControlProtocol(LineOnlyReceiver):
         firstline = rest[:rest.find('\n')]
         args = firstline.split()
         if args[0] in self.events:
+            started = self.scheduler.seconds()
             self.events[args[0]].got_update(rest[len(args[0]) + 1:])
+            self.metrics.event_delivered(args[0], self.scheduler.seconds() - started)
             return
 
         raise RuntimeError("Wasn't listening for event of type " + args[0])
 
     def _maybe_issue_command(self):
         """
-        If there's at least one command queued and we're not currently
-        processing a command, this will issue the next one on the
-        wire.
+        Issues queued commands on the wire until there are
+        max_in_flight of them awaiting a reply. The oldest in-flight
+        command is the one whose reply we're processing
+        (self.command).
         """
-        if self.command:
-            return
 
-        if len(self.commands):
-            self.command = self.commands.pop(0)
-            (d, cmd, cmd_arg) = self.command
-            self.defer = d
+        while len(self.commands) and len(self.in_flight) < self.max_in_flight:
+            command = self.commands.popleft()
+            cmd = command[1]
+            now = self.scheduler.seconds()
+            self.metrics.command_sent(cmd.split(' ', 1)[0], now - command[3])
+            ## the in-flight copy has the time it was sent
+            command = command[:3] + (now,)
+            self.in_flight.append(command)
 
             if DEBUG:
                 #print "NOTIFY",code,rest
                 self.debuglog.write(cmd + '\n')
                 self.debuglog.flush()
+            if self.trace is not None:
+                self.trace.sent(cmd)
 
             self.transport.write(cmd + '\r\n')
 
+        if self.command is None and len(self.in_flight):
+            self.command = self.in_flight[0]
+            self.defer = self.command[0]
+
     def _auth_failed(self, fail):
         """
         Errback if authentication fails.
@@ -631,118 +1359,104 @@ class TorControlProtocol(LineOnlyReceiver):
         ## any signal name and just wait for the reply?
         self.valid_signals = ["RELOAD", "DUMP", "DEBUG", "NEWNYM", "CLEARDNSCACHE"]
 
-        self.version = yield self.get_info('version')
-        self.version = self.version['version']
+        ## none of these depend on each other, so they all go out at
+        ## once (and both keys in one GETINFO) rather than waiting on
+        ## each reply in turn.
+        info = self.get_info('version', 'events/names')
+        feature = self.queue_command('USEFEATURE EXTENDED_EVENTS')
+
+        info = yield info
+        self.version = info['version']
         txtorlog.msg("Connected to a Tor with VERSION", self.version)
-        eventnames = yield self.get_info('events/names')
-        eventnames = eventnames['events/names']
-        self._set_valid_events(eventnames)
+        self._set_valid_events(info['events/names'])
 
-        yield self.queue_command('USEFEATURE EXTENDED_EVENTS')
+        yield feature
 
         self.post_bootstrap.callback(self)
         self.post_bootstrap = None
         defer.returnValue(self)
 
     ##
-    ## State Machine transitions and matchers. See the __init__ method
-    ## for a way to output a GraphViz dot diagram of the machine.
+    ## Reply-framing handlers; see lineReceived and the tables built
+    ## in __init__.
     ##
 
-    def _is_end_line(self, line):
-        "for FSM"
-        return line.strip() == '.'
-
-    def _is_not_end_line(self, line):
-        "for FSM"
-        return not self._is_end_line(line)
-
-    def _is_single_line_response(self, line):
-        "for FSM"
-        try:
-            code = int(line[:3])
-        except:
-            return False
-
-        sl = len(line) > 3 and line[3] == ' '
-        #print "single line?",line,sl
-        if sl:
-            self.code = code
-            return True
-        return False
+    def _reply_single(self, line):
+        "a complete one-line reply"
+        self.code = int(line[:3])
+        self._broadcast_response(line)
+
+    def _reply_begin(self, line):
+        "first line of a multi-line reply"
+        self._reply_code = line[:3]
+        self._start_command(line)
+
+    def _reply_begin_data(self, line):
+        "first line of a reply, followed by a data block"
+        self._reply_begin(line)
+        self._in_data = True
+
+    def _reply_continue_data(self, line):
+        "a mid-reply line followed by a data block"
+        self._accumulate_response(line)
+        self._in_data = True
+
+    def _reply_end(self, line):
+        "final line of a multi-line reply"
+        self._reply_code = None
+        self._broadcast_response(line)
 
     def _start_command(self, line):
-        "for FSM"
-        # print "startCommand",self.code,line
         self.code = int(line[:3])
-        # print "startCommand:",self.code
-        if self.command and self.command[2] is not None:
+        if self.code < 600 and self.command and self.command[2] is not None:
             self.command[2](line[4:])
         else:
-            self.response = line[4:] + '\n'
+            self.response = [line[4:]]
         return None
 
-    def _is_continuation_line(self, line):
-        "for FSM"
-        # print "isContinuationLine",self.code,line
-        code = int(line[:3])
-        if self.code and self.code != code:
-            raise RuntimeError("Unexpected code %d, wanted %d" % (code,
-                                                                  self.code))
-        return line[3] == '-'
-
-    def _is_multi_line(self, line):
-        "for FSM"
-        # print "isMultiLine",self.code,line,line[3] == '+'
-        code = int(line[:3])
-        if self.code and self.code != code:
-            raise RuntimeError("Unexpected code %d, wanted %d" % (code,
-                                                                  self.code))
-        return line[3] == '+'
-
     def _accumulate_multi_response(self, line):
-        "for FSM"
-        if self.command and self.command[2] is not None:
+        if self.code < 600 and self.command and self.command[2] is not None:
             self.command[2](line)
 
         else:
-            self.response += (line + '\n')
+            self.response.append(line)
         return None
 
     def _accumulate_response(self, line):
-        "for FSM"
-        if self.command and self.command[2] is not None:
+        if self.code < 600 and self.command and self.command[2] is not None:
             self.command[2](line[4:])
 
         else:
-            self.response += (line[4:] + '\n')
+            self.response.append(line[4:])
         return None
 
-    def _is_finish_line(self, line):
-        "for FSM"
-        # print "isFinish",line
-        if len(line) < 1:
-            return False
-        if line[0] == '.':
-            return True
-        if len(line) > 3 and line[3] == ' ':
-            return True
-        return False
-
     def _broadcast_response(self, line):
-        "for FSM"
-        # print "BCAST",line
         if len(line) > 3:
             if self.code >= 200 and self.code < 300 and self.command and self.command[2] is not None:
                 self.command[2](line[4:])
                 resp = ''
 
             else:
-                resp = self.response + line[4:]
+                self.response.append(line[4:])
+                resp = '\n'.join(self.response)
+        elif len(self.response):
+            resp = '\n'.join(self.response) + '\n'
         else:
-            resp = self.response
-        self.response = ''
-        if self.code >= 200 and self.code < 300:
+            resp = ''
+        self.response = []
+        if self._too_long and self.code >= 600:
+            self._too_long = False
+            txtorlog.msg("dropped event with an over-long line")
+            self.code = None
+            return
+        elif self.code < 600 and self.defer is not None and self.defer.called:
+            ## the command was cancelled, or timed out
+            self._too_long = False
+            txtorlog.msg("discarding reply to", self.command[1])
+        elif self._too_long and self.code >= 200:
+            self._too_long = False
+            self.defer.errback(TorReplyTooLong("Reply contained a line longer than %d bytes." % self.MAX_LENGTH))
+        elif self.code >= 200 and self.code < 300:
             if self.defer is None:
                 raise RuntimeError("Got a response, but didn't issue a command.")
             self.defer.callback(resp)
@@ -759,6 +1473,8 @@ class TorControlProtocol(LineOnlyReceiver):
             raise RuntimeError("Unknown code in broadcast response %d." % self.code)
 
         ## note: we don't do this for 600-level responses
+        command = self.in_flight.popleft()
+        self.metrics.command_answered(command[1].split(' ', 1)[0], self.scheduler.seconds() - command[3])
         self.command = None
         self.code = None
         self.defer = None
@@ -197,9 +197,9 @@ class TorInfo(object):
             x.dump('')
 
     def _do_setup(self, data):
-        # FIXME figure out why network-status doesn't work (get nothing back from
-        # Tor it seems, although stem does get an answer). this is a space-separated
-        # list of ~2500 OR id's; could it be that LineReceiver can't handle it?
+        ## note that some of these (network-status, for example) reply
+        ## with a single line far longer than LineOnlyReceiver allowed;
+        ## TorControlProtocol no longer has a small line-length limit.
         added_magic = []
         for line in data.split('\n'):
             if line == "info/names=" or line == "OK" or line.strip() == '':
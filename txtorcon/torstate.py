@@ -1,23 +1,27 @@
 import datetime
 import os
 import stat
+import time
 import types
 import warnings
 
 from twisted.python import log
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
 from twisted.internet.endpoints import TCP4ClientEndpoint, UNIXClientEndpoint
-from twisted.internet.interfaces import IReactorCore, IStreamClientEndpoint
+from twisted.internet.interfaces import IReactorCore, IReactorTime, IStreamClientEndpoint
 from zope.interface import implements
 
 from txtorcon import TorProtocolFactory
 from txtorcon.stream import Stream
 from txtorcon.circuit import Circuit
-from txtorcon.router import Router, hashFromHexId
+from txtorcon.router import Router, hashFromHexId, hexIdFromHash, FLAG_BITS
+from txtorcon.routertable import RouterTable
 from txtorcon.addrmap import AddrMap
+from txtorcon.util import LRUDict
+from txtorcon.events import CircEvent, StreamEvent
 from txtorcon.torcontrolprotocol import parse_keywords
 from txtorcon.log import txtorlog
-from txtorcon.torcontrolprotocol import TorProtocolError
+from txtorcon.torcontrolprotocol import TorProtocolError, PRIORITY_NORMAL
 
 from txtorcon.interface import ITorControlProtocol, IRouterContainer, ICircuitListener
 from txtorcon.interface import ICircuitContainer, IStreamListener, IStreamAttacher
@@ -34,7 +38,7 @@ def _wait_for_proto(proto):
 
 
 def build_tor_connection(connection, build_state=True, wait_for_proto=True,
-                         password_function=lambda: None):
+                         password_function=lambda: None, max_in_flight=1):
     """
     This is used to build a valid TorState (which has .protocol for
     the TorControlProtocol). For example::
@@ -56,6 +60,10 @@ def build_tor_connection(connection, build_state=True, wait_for_proto=True,
     :param password_function:
         See :class:`txtorcon.TorControlProtocol`
 
+    :param max_in_flight:
+        See :class:`txtorcon.TorControlProtocol`; setting this above 1
+        pipelines commands to Tor.
+
     :param build_state:
         If True (the default) a TorState object will be
         built as well. If False, just a TorControlProtocol will be
@@ -93,7 +101,8 @@ def build_tor_connection(connection, build_state=True, wait_for_proto=True,
                         'Endpoint for argument "connection", got %s' %
                         (connection, ))
 
-    d = endpoint.connect(TorProtocolFactory(password_function=password_function))
+    d = endpoint.connect(TorProtocolFactory(password_function=password_function,
+                                            max_in_flight=max_in_flight))
     if build_state:
         d.addCallback(build_state if callable(build_state) else _build_state)
     elif wait_for_proto:
@@ -127,6 +136,61 @@ def build_local_tor_connection(reactor, host='127.0.0.1', port=9051,
         return build_tor_connection((reactor, host, port), *args, **kwargs)
 
 
+def parse_consensus(data):
+    """
+    Parses network-status text (``GETINFO ns/all``, a NEWCONSENSUS
+    event...) into a list of tuples, one per router: ``(name, idhash,
+    orhash, published, ip, or_port, dir_port, flags, bandwidth,
+    policy, ipv6_addresses)``, where the first seven are as for
+    :meth:`Router.update <txtorcon.router.Router.update>`, flags and
+    policy are lists of words and bandwidth is an int (or None).
+
+    This only uses the text it's given and returns only builtin
+    types, so it can run in a thread or another process; see
+    :class:`TorState`'s ``consensus_executor``.
+    """
+
+    table = []
+    row = None
+    for line in data.split('\n'):
+        kind = line[:2]
+        if kind == 'r ':
+            args = line.split()
+            row = [args[1], args[2], args[3],
+                   datetime.datetime.strptime(args[4] + args[5], '%Y-%m-%f%H:%M:%S'),
+                   args[6], args[7], args[8], [], None, None, []]
+            table.append(row)
+        elif row is None:
+            continue
+        elif kind == 's ':
+            row[7] = line.split()[1:]
+        elif kind == 'a ':
+            row[10].append(line.split()[1].strip())
+        elif kind == 'w ':
+            row[8] = int(line.split()[1].split('=')[1])
+        elif kind == 'p ':
+            row[9] = line.split()[1:]
+    return [tuple(r) for r in table]
+
+
+class RouterView(object):
+    """
+    The routers from one consensus, as :class:`TorState` keeps them
+    (see its ``routers``, ``routers_by_name``, ``guards`` and
+    ``authorities``). A new consensus is parsed into one of these and
+    swapped in once it's complete.
+    """
+
+    def __init__(self):
+        self.routers = {}
+        self.routers_by_name = {}
+        self.guards = {}
+        self.authorities = {}
+        self._router = None             # the one being parsed
+        self._target = None             # the one to put in the dicts for it
+        self._updates = []              # (live Router, Router with its new values)
+
+
 class TorState(object):
     """
     This tracks the current state of Tor using a TorControlProtocol.
@@ -144,6 +208,15 @@ class TorState(object):
     provide a custom mapping for Strams to Circuits (by default Tor
     picks by itself).
 
+    With ``lazy_routers=True`` the consensus isn't loaded at all:
+    :meth:`router_from_id` looks each router up (``GETINFO
+    ns/id/...``) the first time it's asked for, and :attr:`routers`
+    only keeps the ``router_cache_size`` most recently used
+    (:attr:`routers_by_name`, :attr:`guards` and :attr:`authorities`
+    stay empty). This makes bootstrapping much quicker and a lot
+    smaller for controllers that only care about circuits and
+    streams.
+
     This is also a good example of the various listeners, and acts as
     an :class:`txtorcon.interface.ICircuitContainer` and
     :class:`txtorcon.interface.IRouterContainer`.
@@ -152,8 +225,10 @@ class TorState(object):
     implements(ICircuitListener, ICircuitContainer, IRouterContainer,
                IStreamListener)
 
-    def __init__(self, protocol, bootstrap=True, write_state_diagram=False):
+    def __init__(self, protocol, bootstrap=True, write_state_diagram=False,
+                 lazy_routers=False, router_cache_size=1000, consensus_executor=None):
         self.protocol = ITorControlProtocol(protocol)
+        self._protocol_connection_lost = getattr(self.protocol, 'connectionLost', None)
         self.protocol.connectionLost = self.connection_lost
 
         ## could override these to get your own Circuit/Stream subclasses
@@ -175,7 +250,11 @@ class TorState(object):
         self.circuits = {}               # keys on id (integer)
         self.streams = {}                # keys on id (integer)
 
-        self.routers = {}                # keys by hexid (string) and by unique names
+        self.lazy_routers = lazy_routers
+        if lazy_routers:
+            self.routers = LRUDict(router_cache_size)  # keys by hexid only
+        else:
+            self.routers = {}            # keys by hexid (string) and by unique names
         self.routers_by_name = {}        # keys on name, value always list (many duplicate "Unnamed" routers, for example)
         self.guards = {}                 # potentially-usable as entry guards, I think? (any router with 'Guard' flag)
         self.entry_guards = {}           # from GETINFO entry-guards, our current entry guards
@@ -183,6 +262,56 @@ class TorState(object):
         self.authorities = {}            # keys by name
 
         self.cleanup = None              # see set_attacher
+        self.scheduler = IReactorTime(reactor)
+        self._pending_routers = None     # hex ids for the next ns/id lookup; see router_from_id
+
+        ## the network-status parser's handlers add routers to
+        ## whatever _view is: normally ourselves, or a new RouterView
+        ## being filled in by _load_consensus
+        self._view = self
+        self._router = None
+        self._target = None
+        self._consensus_load = None      # see _load_consensus
+        self._consensus_view = None      # the RouterView it's loading into
+        self._consensus_updates = []     # network-status updates received during it
+        self._cooperator = None
+        self._router_table = None        # see router_table
+        self._changed_routers = set()    # Routers whose rows in it are out of date
+        self.consensus_time_slice = 0.01
+        """When a new consensus arrives, it is parsed for at most this
+        many seconds at a time before letting the reactor get on with
+        other things; the old routers stay in place until it's
+        done."""
+        self.consensus_executor = consensus_executor
+        """If not None, consensuses (ns/all and NEWCONSENSUS) are
+        parsed by calling this with :func:`parse_consensus` and the
+        text (like :func:`twisted.internet.threads.deferToThread`);
+        it returns a Deferred of the result. Only creating the
+        Router objects is left for the reactor thread. As Python
+        threads share one core for Python code, running it in a
+        process pool is what actually uses another core; the result
+        is builtin types, so it pickles."""
+
+        self._network_status_parser = self._network_status_fsm()
+        if write_state_diagram:
+            with open('routerfsm.dot', 'w') as fsmfile:
+                fsmfile.write(self._network_status_parser.dotty())
+
+        ## events (from event_map) whose bootstrap snapshot hasn't
+        ## been received yet, and the events held back until it's
+        ## applied; see _bootstrap
+        self._awaiting_snapshot = set()
+        self._held_events = {}
+
+        self.post_bootstrap = defer.Deferred()
+        if bootstrap:
+            if self.protocol.post_bootstrap:
+                self.protocol.post_bootstrap.addCallback(self._bootstrap).addErrback(self.post_bootstrap.errback)
+            else:
+                self._bootstrap()
+
+    def _network_status_fsm(self):
+        "a new state-machine parsing network-status lines (see _view)"
 
         class die(object):
             __name__ = 'die'             # FIXME? just to ease spagetti.py:82's pain
@@ -227,109 +356,193 @@ class TorState(object):
         waiting_p.add_transition(Transition(waiting_r, lambda x: x[:2] != 'p ', die('Expected "p " while parsing routers not "%s"')))
         waiting_p.add_transition(Transition(waiting_r, lambda x: x.strip() == '.', nothing))
 
-        self._network_status_parser = FSM([waiting_r, waiting_s, waiting_w, waiting_p])
-        if write_state_diagram:
-            with open('routerfsm.dot', 'w') as fsmfile:
-                fsmfile.write(self._network_status_parser.dotty())
-
-        self.post_bootstrap = defer.Deferred()
-        if bootstrap:
-            if self.protocol.post_bootstrap:
-                self.protocol.post_bootstrap.addCallback(self._bootstrap).addErrback(self.post_bootstrap.errback)
-            else:
-                self._bootstrap()
+        return FSM([waiting_r, waiting_s, waiting_w, waiting_p])
 
     def _router_begin(self, data):
         args = data.split()
-        self._router = Router(self.protocol)
-        self._router.from_consensus = True
-        self._router.update(args[1],         # nickname
-                            args[2],         # idhash
-                            args[3],         # orhash
-                            datetime.datetime.strptime(args[4] + args[5], '%Y-%m-%f%H:%M:%S'),
-                            args[6],         # ip address
-                            args[7],         # ORPort
-                            args[8])         # DirPort
-
-        if self._router.id_hex in self.routers:
+        self._add_router((args[1],         # nickname
+                          args[2],         # idhash
+                          args[3],         # orhash
+                          datetime.datetime.strptime(args[4] + args[5], '%Y-%m-%f%H:%M:%S'),
+                          args[6],         # ip address
+                          args[7],         # ORPort
+                          args[8]))        # DirPort
+
+    def _add_router(self, fields):
+        """
+        Adds the router from an "r" line (fields as for
+        Router.update) to _view, or finds it if it's already there,
+        and makes it the one the following lines are about.
+        """
+
+        view = self._view
+        id_hex = hexIdFromHash(fields[1])
+        if id_hex in view.routers:
             ## FIXME should I do an update() on this one??
-            self._router = self.routers[self._router.id_hex]
+            existing = view.routers[id_hex]
+            if not existing.from_consensus:
+                ## a lazy_routers placeholder from router_from_id
+                existing.update(*fields)
+                existing.from_consensus = True
+            existing.ip_v6 = []         # the "a" lines that follow are all of them
+            view._router = view._target = existing
+            if view is self and self._router_table is not None:
+                self._changed_routers.add(existing)
             return
 
-        if self._router.name in self.routers_by_name:
-            self.routers_by_name[self._router.name].append(self._router)
+        router = None
+        if view is self and self._consensus_view is not None:
+            ## new in the consensus being loaded too: use the Router
+            ## it'll make live, rather than a second one
+            router = self._consensus_view.routers.get(id_hex)
+            if router is not None:
+                router.ip_v6 = []
+        if router is None:
+            router = Router(self.protocol)
+            router.from_consensus = True
+        router.update(*fields)
+        view._router = router
+        if view is not self and id_hex in self.routers:
+            ## a new consensus: the Router objects circuits etc.
+            ## already refer to stay, and are given the new values
+            ## when it's swapped in (until then, they keep the old)
+            live = self.routers[id_hex]
+            view._updates.append((live, router))
+            router = live
+        view._target = router
+        if view is self and self._router_table is not None:
+            self._changed_routers.add(router)
+
+        ## (keyed by the new name, if it's changed)
+        name = view._router.name
+        if self.lazy_routers:
+            view.routers[id_hex] = router
+            return
+
+        if name in view.routers_by_name:
+            view.routers_by_name[name].append(router)
 
         else:
-            self.routers_by_name[self._router.name] = [self._router]
+            view.routers_by_name[name] = [router]
 
-        if self._router.name in self.routers:
-            self.routers[self._router.name] = None
+        if name in view.routers:
+            view.routers[name] = None
 
         else:
-            self.routers[self._router.name] = self._router
-        self.routers[self._router.id_hex] = self._router
+            view.routers[name] = router
+        view.routers[id_hex] = router
 
     def _router_flags(self, data):
-        args = data.split()
-        self._router.flags = args[1:]
-        if 'guard' in self._router.flags:
-            self.guards[self._router.id_hex] = self._router
-        if 'authority' in self._router.flags:
-            self.authorities[self._router.name] = self._router
+        self._set_router_flags(data.split()[1:])
+
+    def _set_router_flags(self, flags):
+        view = self._view
+        view._router.flags = flags
+        if self.lazy_routers:
+            return
+        if view._router.flag_mask & FLAG_BITS['guard']:
+            view.guards[view._router.id_hex] = view._target
+        if view._router.flag_mask & FLAG_BITS['authority']:
+            view.authorities[view._router.name] = view._target
 
     def _router_address(self, data):
         """only for IPv6 addresses"""
-        self._router.ip_v6.append(data.split()[1].strip())
+        self._view._router.ip_v6.append(data.split()[1].strip())
 
     def _router_bandwidth(self, data):
         args = data.split()
-        self._router.bandwidth = int(args[1].split('=')[1])
+        self._view._router.bandwidth = int(args[1].split('=')[1])
 
     def _router_policy(self, data):
         args = data.split()
-        self._router.policy = args[1:]
-        self._router = None
+        self._view._router.policy = args[1:]
+        self._view._router = None
 
     def connection_lost(self, *args):
-        pass
+        ## the protocol still needs to fail its outstanding commands
+        if self._protocol_connection_lost is not None:
+            self._protocol_connection_lost(*args)
 
     @defer.inlineCallbacks
     def _bootstrap(self, arg=None):
         "This takes an arg so we can use it as a callback (see __init__)."
 
-        ## update list of routers (must be before we do the
-        ## circuit-status) note that we're feeding each line
+        ## subscribe to events before asking for the current state of
+        ## things. Tor sends replies and events down the connection in
+        ## order, so an event arriving before a snapshot's reply is
+        ## already reflected in that reply and one arriving after it
+        ## is newer: until its snapshot's reply, each event's listener
+        ## ignores it, and until the snapshot is applied it's held
+        ## back (see _add_events and snapshots)
+        for events in self.snapshots.values():
+            self._awaiting_snapshot.update(events)
+        self._add_events()
+
+        ## the snapshot queries all go out together rather than each
+        ## waiting on the previous reply, and the replies are applied
+        ## as they arrive, in the order issued. ns/all (which would
+        ## otherwise be bulk) has to come before the circuit-status,
+        ## so it gets normal priority. We're feeding each line of it
         ## incrementally to a state-machine called
         ## _network_status_parser, set up in constructor. "ns" should
         ## be the empty string, but we call _update_network_status for
-        ## the de-duplication of named routers
-
-        ns = yield self.protocol.get_info_incremental('ns/all',
-                                                      self._network_status_parser.process)
-        self._update_network_status(ns)
-
-        ## update list of existing circuits
-        cs = yield self.protocol.get_info_raw('circuit-status')
-        self._circuit_status(cs)
-
-        ## update list of streams
-        ss = yield self.protocol.get_info_raw('stream-status')
-        self._stream_status(ss)
-
-        ## update list of existing address-maps
+        ## the de-duplication of named routers. With a
+        ## consensus_executor, the lines are collected up and parsed
+        ## there instead.
+        ns = None
+        ns_lines = []
+        if self.lazy_routers:
+            self._snapshot_received(None, 'ns/all')
+        elif self.consensus_executor is None:
+            ns = self.protocol.get_info_incremental('ns/all', self._network_status_parser.process,
+                                                    priority=PRIORITY_NORMAL)
+        else:
+            ns = self.protocol.get_info_incremental('ns/all', ns_lines.append,
+                                                    priority=PRIORITY_NORMAL)
+        if ns is not None:
+            ns = defer.maybeDeferred(lambda: ns).addCallback(self._snapshot_received, 'ns/all')
+        cs = self._snapshot_query('circuit-status')
+        ss = self._snapshot_query('stream-status')
         key = 'address-mappings/all'
-        am = yield self.protocol.get_info_raw(key)
-        ## strip addressmappsings/all= and OK\n from raw data
-        am = am[len(key) + 1:]
-        if am.strip() != 'OK':
-            for line in am.split('\n')[:-1]:
-                if len(line.strip()) == 0:
-                    continue            # FIXME
-                self.addrmap.update(line)
-
-        self._add_events()
+        am = self._snapshot_query(key)
+        entries = self.protocol.get_info_raw("entry-guards")
+        pid = defer.maybeDeferred(self.protocol.get_info_raw, "process/pid")
 
-        entries = yield self.protocol.get_info_raw("entry-guards")
+        try:
+            if ns is not None:
+                ns = yield ns
+                if ns_lines:
+                    yield self._load_consensus('\n'.join(ns_lines))
+                else:
+                    self._update_network_status(ns)
+            self._snapshot_applied('ns/all')
+
+            ## update list of existing circuits
+            self._circuit_status((yield cs))
+            self._snapshot_applied('circuit-status')
+
+            ## update list of streams
+            self._stream_status((yield ss))
+            self._snapshot_applied('stream-status')
+
+            ## update list of existing address-maps
+            am = yield am
+            ## strip addressmappsings/all= and OK\n from raw data
+            am = am[len(key) + 1:]
+            if am.strip() != 'OK':
+                for line in am.split('\n')[:-1]:
+                    if len(line.strip()) == 0:
+                        continue            # FIXME
+                    self.addrmap.update(line)
+            self._snapshot_applied(key)
+        except Exception:
+            ## without the rest of the snapshots, events are better
+            ## than nothing: stop ignoring or holding any back
+            for snapshot in self.snapshots:
+                self._snapshot_applied(snapshot)
+            raise
+
+        entries = yield entries
         for line in entries.split('\n')[1:]:
             if len(line.strip()) == 0 or line.strip() == 'OK':
                 continue
@@ -354,7 +567,7 @@ class TorState(object):
         ## guessed using psutil, but that only works if there's
         ## exactly one tor running anyway)
         try:
-            pid = yield self.protocol.get_info_raw("process/pid")
+            pid = yield pid
         except TorProtocolError:
             pid = None
         self.tor_pid = 0
@@ -566,17 +779,175 @@ class TorState(object):
         from NS and NEWCONSENSUS events.
         """
 
+        if self._consensus_load is not None:
+            ## applied again once the new consensus is swapped in
+            self._consensus_updates.append(data)
+
         for line in data.split('\n'):
             self._network_status_parser.process(line)
+        self._remove_duplicate_names(self)
+
+    @property
+    def router_table(self):
+        """
+        A :class:`txtorcon.routertable.RouterTable` of :attr:`routers`,
+        for queries over the whole network. It's built the first time
+        it's asked for after a new consensus; after that, the rows of
+        routers changed by NS events (or ns/id lookups) are updated
+        the next time it's asked for.
+        """
 
-        txtorlog.msg(len(self.routers_by_name), "named routers found.")
+        if self._router_table is None:
+            self._router_table = RouterTable(r for (k, r) in self.routers.iteritems()
+                                             if k.startswith('$'))
+            self._changed_routers = set()
+        elif self._changed_routers:
+            self._router_table.update(self._changed_routers)
+            self._changed_routers = set()
+        return self._router_table
+
+    def _remove_duplicate_names(self, view):
+        txtorlog.msg(len(view.routers_by_name), "named routers found.")
         ## remove any names we added that turned out to have dups
-        for (k, v) in self.routers.items():
+        for (k, v) in view.routers.items():
             if v is None:
-                txtorlog.msg(len(self.routers_by_name[k]), "dups:", k)
-                del self.routers[k]
+                txtorlog.msg(len(view.routers_by_name[k]), "dups:", k)
+                del view.routers[k]
+
+        txtorlog.msg(len(view.guards), "GUARDs")
+
+    def _time_slice(self):
+        "Cooperator terminationPredicateFactory; see consensus_time_slice"
+        end = time.time() + self.consensus_time_slice
+        return lambda: time.time() >= end
+
+    def _parse_consensus(self, view, lines, chunk=100):
+        """
+        Generator parsing lines of network-status into view, a chunk
+        at a time (so the caller can stop between chunks).
+        """
+
+        parser = self._network_status_fsm()
+        for start in xrange(0, len(lines), chunk):
+            self._view = view
+            try:
+                for line in lines[start:start + chunk]:
+                    parser.process(line)
+            finally:
+                self._view = self
+            yield None
+
+    def _merge_consensus(self, view, parsed, chunk=100):
+        """
+        Generator like _parse_consensus, except the parsing has been
+        handed to consensus_executor (parsed is the Deferred it
+        returned) and this just adds the resulting routers to view.
+        """
+
+        table = []
+        yield parsed.addCallback(table.extend)
+        for start in xrange(0, len(table), chunk):
+            self._view = view
+            try:
+                for row in table[start:start + chunk]:
+                    self._add_router(row[:7])
+                    router = view._router
+                    self._set_router_flags(row[7])
+                    if row[8] is not None:
+                        router.bandwidth = row[8]
+                    if row[9] is not None:
+                        router.policy = row[9]
+                    router.ip_v6 = list(row[10])
+                    view._router = None
+            finally:
+                self._view = self
+            yield None
+
+    def _load_consensus(self, data):
+        """
+        Parses a whole new consensus into a :class:`RouterView`,
+        which replaces our routers once it's done. Parsing goes on for
+        at most :attr:`consensus_time_slice` seconds at a time (a
+        small consensus is simply done right away) so events and
+        replies still get handled in between; with a
+        :attr:`consensus_executor` it's done there instead. Until the
+        swap, we still have the old routers. A consensus arriving
+        before the previous one is done replaces it.
+
+        :return: a Deferred that fires once the new routers are in
+            place.
+        """
+
+        if self._consensus_load is not None:
+            self._consensus_load.stop()
+            self._consensus_load = None
+            self._consensus_view = None
+        self._consensus_updates = []
+        view = RouterView()
+
+        if self.consensus_executor is None:
+            work = self._parse_consensus(view, data.split('\n'))
+            done = self._time_slice()
+            for ignored in work:
+                if done():
+                    break
+            else:
+                self._swap_routers(view)
+                return defer.succeed(None)
+        else:
+            work = self._merge_consensus(view, self.consensus_executor(parse_consensus, data))
+
+        if self._cooperator is None:
+            self._cooperator = task.Cooperator(terminationPredicateFactory=self._time_slice,
+                                               scheduler=lambda x: self.scheduler.callLater(0, x))
+        load = self._consensus_load = self._cooperator.cooperate(work)
+        self._consensus_view = view
+        d = load.whenDone()
+        d.addCallback(lambda ignored: self._swap_routers(view))
+
+        def failed(fail):
+            if self._consensus_load is load:
+                self._consensus_load = None
+                self._consensus_view = None
+            fail.trap(task.TaskStopped)
+            return None
+        d.addErrback(failed)
+        return d
+
+    def _swap_routers(self, view):
+        "Makes view (from _load_consensus) our routers."
+
+        self._consensus_load = None
+        self._consensus_view = None
+        self._router_table = None
+        for (live, router) in view._updates:
+            live._update_from(router)
+        view._updates = []
+        self._remove_duplicate_names(view)
+        self.routers = view.routers
+        self.routers_by_name = view.routers_by_name
+        self.guards = view.guards
+        self.authorities = view.authorities
+
+        ## anything that came in meanwhile is newer than the consensus
+        updates = self._consensus_updates
+        self._consensus_updates = []
+        for data in updates:
+            self._update_network_status(data)
+
+    def _new_consensus(self, data):
+        """
+        Callback for NEWCONSENSUS events (see :meth:`_load_consensus`);
+        with lazy_routers, instead of loading the whole thing we
+        forget the routers we've looked up so they're looked up again
+        (from the new consensus) next time they're needed.
+        """
 
-        txtorlog.msg(len(self.guards), "GUARDs")
+        if self.lazy_routers:
+            self.routers.clear()
+            self._router_table = None
+            return
+        self._load_consensus(data).addErrback(log.err)
 
     def _newdesc_update(self, args):
         """
@@ -589,6 +960,8 @@ class TorState(object):
 
         hsh = args[:41]
         if hsh not in self.routers:
+            if self.lazy_routers:
+                return                  # we'll look it up if anyone asks
             txtorlog.msg("haven't seen", hsh, "yet!")
         self.protocol.get_info_raw('ns/id/%s' % hsh[1:]).addCallback(self._update_network_status).addErrback(log.err)
         txtorlog.msg("NEWDESC", args)
@@ -606,31 +979,38 @@ class TorState(object):
     def _circuit_update(self, line):
         """
         Used internally as a callback to update Circuit information
-        from CIRC events.
+        from CIRC events (a :class:`txtorcon.events.CircEvent`, or a
+        line from GETINFO circuit-status).
         """
 
         #print "circuit_update",line
-        args = line.split()
-        circ_id = int(args[0])
+        if isinstance(line, CircEvent):
+            event = line
+        else:
+            event = CircEvent(line)
 
-        c = self._maybe_create_circuit(circ_id)
-        c.update(args)
+        c = self._maybe_create_circuit(event.id)
+        c.update(event)
 
     def _stream_update(self, line):
         """
         Used internally as a callback to update Stream information
-        from STREAM events.
+        from STREAM events (a :class:`txtorcon.events.StreamEvent`, or
+        a line from GETINFO stream-status).
         """
 
         #print "stream_update",line
-        if line.strip() == 'stream-status=':
-            ## this happens if there are no active streams
-            return
+        if isinstance(line, StreamEvent):
+            event = line
+        else:
+            if line.strip() == 'stream-status=':
+                ## this happens if there are no active streams
+                return
+            event = StreamEvent(line)
 
-        args = line.split()
-        assert len(args) >= 3
+        assert len(event.args) >= 3
 
-        stream_id = int(args[0])
+        stream_id = event.id
         wasnew = False
         if stream_id not in self.streams:
             stream = self.stream_factory(self)
@@ -638,7 +1018,7 @@ class TorState(object):
             stream.listen(self)
             [stream.listen(x) for x in self.stream_listeners]
             wasnew = True
-        self.streams[stream_id].update(args)
+        self.streams[stream_id].update(event)
 
         ## if the update closed the stream, it won't be in our list
         ## anymore. FIXME: how can we ever hit such a case as the
@@ -654,10 +1034,22 @@ class TorState(object):
     event_map = {'STREAM': _stream_update,
                  'CIRC': _circuit_update,
                  'NS': _update_network_status,
-                 'NEWCONSENSUS': _update_network_status,
+                 'NEWCONSENSUS': _new_consensus,
                  'NEWDESC': _newdesc_update,
                  'ADDRMAP': _addr_map}
     """event_map used by add_events to map event_name -> unbound method"""
+
+    typed_events = ['STREAM', 'CIRC', 'ADDRMAP']
+    """events in event_map whose handlers take a
+    :class:`txtorcon.events.TorEvent` rather than a string"""
+
+    snapshots = {'ns/all': ['NS', 'NEWCONSENSUS', 'NEWDESC'],
+                 'circuit-status': ['CIRC'],
+                 'stream-status': ['STREAM'],
+                 'address-mappings/all': ['ADDRMAP']}
+    """GETINFO key of each bootstrap snapshot -> the events it
+    covers, which are ignored until it has been applied"""
+
     @defer.inlineCallbacks
     def _add_events(self):
         """
@@ -667,7 +1059,52 @@ class TorState(object):
         for (event, func) in self.event_map.items():
             ## the map contains unbound methods, so we bind them
             ## to self so they call the right thing
-            yield self.protocol.add_event_listener(event, types.MethodType(func, self, TorState))
+            ## CIRC, STREAM and ADDRMAP listeners get pre-split
+            ## txtorcon.events objects; the rest take strings
+            listener = self._snapshot_gate(event, types.MethodType(func, self, TorState))
+            yield self.protocol.add_event_listener(event, listener,
+                                                   typed=event in self.typed_events)
+
+    def _snapshot_gate(self, event, listener):
+        """
+        wraps an event_map listener to ignore events until its
+        snapshot's reply and hold them until it's applied
+        """
+
+        def gated(data):
+            if event in self._awaiting_snapshot:
+                return None
+            held = self._held_events.get(event)
+            if held is not None:
+                held.append((listener, data))
+                return None
+            return listener(data)
+        return gated
+
+    def _snapshot_query(self, key):
+        "GETINFO for a bootstrap snapshot (see _snapshot_received)"
+        d = defer.maybeDeferred(self.protocol.get_info_raw, key)
+        return d.addCallback(self._snapshot_received, key)
+
+    def _snapshot_received(self, reply, key):
+        """
+        Callback for the reply to a bootstrap snapshot's GETINFO:
+        events from now on are newer, so they're held until it's
+        applied (unless bootstrapping has already given up on it).
+        """
+
+        for event in self.snapshots[key]:
+            if event in self._awaiting_snapshot:
+                self._awaiting_snapshot.discard(event)
+                self._held_events[event] = []
+        return reply
+
+    def _snapshot_applied(self, key):
+        "the bootstrap snapshot for GETINFO key is in; start applying its events"
+        for event in self.snapshots[key]:
+            self._awaiting_snapshot.discard(event)
+            for (listener, data) in self._held_events.pop(event, []):
+                listener(data)
 
     ## ICircuitContainer
 
@@ -697,8 +1134,50 @@ class TorState(object):
             router.update(nick, hashFromHexId(idhash), '0' * 27, 'unknown',
                           'unknown', '0', '0')
             router.name_is_unique = is_named
+            if self.lazy_routers:
+                ## "$hexid~name" etc. are all cached under "$hexid"
+                if routerid[:41] in self.routers:
+                    return self.routers[routerid[:41]]
+                ## the placeholder is filled in when Tor answers
+                self.routers[router.id_hex] = router
+                self._lookup_router(idhash)
             return router
 
+    def _lookup_router(self, idhash):
+        """
+        Queues a router for the next ns/id lookup: every router looked
+        up during the same reactor turn is asked for in one GETINFO.
+        """
+
+        if self._pending_routers is None:
+            self._pending_routers = []
+            self.scheduler.callLater(0, self._lookup_pending_routers)
+        self._pending_routers.append(idhash)
+
+    def _lookup_pending_routers(self):
+        "Sends the GETINFO for the routers queued by _lookup_router."
+
+        keys = ['ns/id/%s' % idhash for idhash in self._pending_routers]
+        self._pending_routers = None
+        d = self.protocol.get_info_raw(*keys)
+        d.addCallback(self._update_network_status)
+        d.addErrback(self._lookup_routers_failed, keys)
+
+    def _lookup_routers_failed(self, fail, keys):
+        """
+        Tor refuses the whole GETINFO if it doesn't know one of the
+        routers (e.g. one that's left the consensus), so each is asked
+        for on its own; unknown ones just stay placeholders.
+        """
+
+        fail.trap(TorProtocolError)
+        if len(keys) == 1:
+            return None
+        for key in keys:
+            d = self.protocol.get_info_raw(key)
+            d.addCallback(self._update_network_status)
+            d.addErrback(lambda f: f.trap(TorProtocolError))
+
     ## implement IStreamListener
 
     def stream_new(self, stream):
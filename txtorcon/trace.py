@@ -0,0 +1,277 @@
+"""
+Recording control-port sessions, and replaying them into a
+:class:`txtorcon.TorControlProtocol` (and so, e.g., a
+:class:`txtorcon.TorState`) without a Tor.
+
+A trace is text, one line per control-protocol line in either
+direction::
+
+    # txtorcon trace 1
+    0.000000 > GETINFO version
+    0.001523 < 250-version=0.2.4.10-alpha (git-...)
+    0.001540 < 250 OK
+
+The first field is the seconds since recording started, the second
+is ``>`` for lines we sent to Tor and ``<`` for lines Tor sent us,
+and the rest of the line is the control-protocol line itself (minus
+the CRLF).
+"""
+
+import re
+
+from twisted.internet import defer, reactor
+from twisted.internet.interfaces import ITransport, IReactorTime
+from zope.interface import implements
+
+HEADER = '# txtorcon trace 1\n'
+SENT = '>'
+RECEIVED = '<'
+REDACTED = 'REDACTED'
+"""What a trace has in place of credentials (see :class:`TraceRecorder`)."""
+
+_server_secret_re = re.compile(r'(SERVERHASH|SERVERNONCE)=\S+')
+
+
+def _redact_sent(line):
+    "a command line, minus any password, cookie or nonce"
+    words = line.split(' ', 2)
+    verb = words[0].upper()
+    if verb == 'AUTHENTICATE' and len(words) > 1:
+        return '%s %s' % (words[0], REDACTED)
+    if verb == 'AUTHCHALLENGE' and len(words) > 2:
+        return '%s %s %s' % (words[0], words[1], REDACTED)
+    return line
+
+
+def _redact_received(line):
+    "a reply line, minus the server's AUTHCHALLENGE hash and nonce"
+    if 'AUTHCHALLENGE' in line[:20]:
+        return _server_secret_re.sub(r'\1=' + REDACTED, line)
+    return line
+
+
+class TraceRecorder(object):
+    """
+    Writes a trace of a control connection to a file; set it as a
+    :class:`txtorcon.TorControlProtocol`'s ``trace`` attribute::
+
+        proto.trace = TraceRecorder(open('session.trace', 'w'))
+
+    Lines go through the file's own buffering, so recording doesn't
+    cost a write system-call per line like ``DEBUG`` does; call
+    :meth:`close` (or flush the file) when done.
+
+    Traces are meant to be shared, so the arguments of AUTHENTICATE
+    and AUTHCHALLENGE, and the server's hash and nonce in the reply
+    to AUTHCHALLENGE, are written as :data:`REDACTED` (replaying
+    skips authentication anyway).
+    """
+
+    def __init__(self, fileobj, clock=None):
+        """
+        :param clock: an IReactorTime provider, for the timestamps
+            (default: the reactor).
+        """
+        self.file = fileobj
+        self.clock = IReactorTime(clock or reactor)
+        self.started = self.clock.seconds()
+        self.file.write(HEADER)
+
+    def _record(self, direction, line):
+        self.file.write('%.6f %s %s\n' % (self.clock.seconds() - self.started, direction, line))
+
+    def sent(self, command):
+        "A command we sent to Tor (which may be several lines)."
+        for line in command.split('\r\n'):
+            self._record(SENT, _redact_sent(line))
+
+    def received(self, line):
+        "A line Tor sent us."
+        self._record(RECEIVED, _redact_received(line))
+
+    def close(self):
+        self.file.close()
+
+
+def read_trace(fileobj):
+    """
+    :return: a list of ``(seconds, direction, line)`` tuples from a
+        trace written by :class:`TraceRecorder`.
+    """
+
+    records = []
+    for line in fileobj:
+        if line[:1] == '#':
+            continue
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        (when, direction, rest) = line.split(' ', 2)
+        if direction not in (SENT, RECEIVED):
+            raise RuntimeError('Bad trace line: "%s"' % line)
+        records.append((float(when), direction, rest))
+    return records
+
+
+class ReplayTransport(object):
+    """
+    The transport a :class:`TraceReplay` connects its protocol to;
+    collects what the protocol writes.
+    """
+
+    implements(ITransport)
+
+    disconnecting = False
+
+    def __init__(self, replay):
+        self.replay = replay
+        self.written = []               # lines the protocol has sent
+        self._partial = ''
+        self.paused = False
+
+    def write(self, data):
+        lines = (self._partial + data).split('\r\n')
+        self._partial = lines.pop()
+        if lines:
+            self.written.extend(lines)
+            self.replay._wrote()
+
+    def writeSequence(self, seq):
+        self.write(''.join(seq))
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.replay._wrote()
+
+
+class TraceReplay(object):
+    """
+    Feeds the received side of a trace into a protocol, keeping it in
+    step with what the protocol sends: before feeding what Tor said
+    after a command, we wait for the protocol to send its own command
+    (so a replayed :class:`txtorcon.TorState` bootstrap sees each
+    reply after asking for it, just as it did live).
+
+    Authentication can't be replayed (cookies and nonces), so if the
+    trace includes AUTHENTICATE, everything up to Tor's reply to it
+    is skipped and the protocol starts from its post-authentication
+    bootstrap instead. Either way, the protocol's connectionMade isn't
+    called.
+
+    :ivar mismatches: ``(recorded, sent)`` pairs for each command the
+        protocol sent which differs from the trace.
+
+    :ivar transport: the :class:`ReplayTransport`
+    """
+
+    def __init__(self, records, protocol, clock=None, realtime=False, speed=1.0):
+        """
+        :param records: from :func:`read_trace`
+
+        :param realtime: if True, Tor's lines are fed with the same
+            spacing as when they were recorded (divided by speed);
+            otherwise, as fast as possible.
+        """
+        self.records = records
+        self.protocol = protocol
+        self.clock = IReactorTime(clock or reactor)
+        self.realtime = realtime
+        self.speed = speed
+        self.mismatches = []
+        self.transport = ReplayTransport(self)
+        self.done = defer.Deferred()
+
+        self._position = 0
+        self._sent = 0                  # how many of transport.written we've matched
+        self._running = False
+        self._delayed = None
+        self._last_time = None
+
+    def start(self):
+        """
+        Connect the protocol and start feeding it.
+
+        :return: a Deferred which fires with this TraceReplay once
+            the whole trace has been fed.
+        """
+
+        bootstrap = False
+        for (i, (when, direction, line)) in enumerate(self.records):
+            if direction == SENT and line.startswith('AUTHENTICATE'):
+                for j in range(i + 1, len(self.records)):
+                    (_, direction, line) = self.records[j]
+                    if direction == RECEIVED and line[3:4] == ' ':
+                        self._position = j + 1
+                        bootstrap = True
+                        break
+                break
+
+        self.protocol.connectionMade = lambda: None
+        self.protocol.makeConnection(self.transport)
+        del self.protocol.connectionMade
+        if bootstrap:
+            self.protocol._bootstrap()
+        self._advance()
+        return self.done
+
+    def _wrote(self):
+        "ReplayTransport calls this when the protocol sends a line"
+        if not self._running and self._delayed is None:
+            self._delayed = self.clock.callLater(0, self._advance)
+
+    def _advance(self):
+        self._delayed = None
+        self._running = True
+        try:
+            while self._position < len(self.records):
+                if self.transport.paused or self.transport.disconnecting:
+                    return
+
+                (when, direction, line) = self.records[self._position]
+                if direction == SENT:
+                    if self._sent >= len(self.transport.written):
+                        return          # _wrote will get us going again
+                    actual = self.transport.written[self._sent]
+                    if actual != line:
+                        self.mismatches.append((line, actual))
+                    self._sent += 1
+
+                else:
+                    if self.realtime and self._last_time is not None and when > self._last_time:
+                        delay = (when - self._last_time) / self.speed
+                        self._last_time = when
+                        self._delayed = self.clock.callLater(delay, self._advance)
+                        return
+                    self.protocol.dataReceived(line + '\r\n')
+
+                self._last_time = when
+                self._position += 1
+        finally:
+            self._running = False
+
+        if not self.done.called:
+            self.done.callback(self)
+
+
+def replay_trace(fileobj, protocol, clock=None, realtime=False, speed=1.0):
+    """
+    Convenience: read a trace from a file and replay it into a
+    protocol; see :class:`TraceReplay`.
+
+    :return: a Deferred which fires with the :class:`TraceReplay`
+        once it's done.
+    """
+
+    return TraceReplay(read_trace(fileobj), protocol, clock, realtime, speed).start()
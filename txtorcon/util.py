@@ -5,12 +5,15 @@
 
 import glob
 import os
+import re
 import hmac
 import hashlib
 import shutil
 import socket
 import subprocess
 import struct
+import threading
+from collections import OrderedDict
 
 try:
     import GeoIP
@@ -100,10 +103,16 @@ def maybe_ip_addr(addr):
     return str(addr)
 
 
-def find_keywords(args, key_filter=lambda x: not x.startswith("$")):
+def _not_router(key):
+    "the default key_filter for find_keywords"
+    return not key.startswith('$')
+
+
+def find_keywords(args, key_filter=_not_router):
     """
-    This splits up strings like name=value, foo=bar into a dict. Does NOT deal
-    with quotes in value (e.g. key="value with space" will not work
+    This splits up strings like name=value, foo=bar into a dict. Give
+    it arguments from :func:`split_args` for quoted values (e.g.
+    key="value with space") to come out right.
 
     By default, note that it takes OUT any key which starts with $ (i.e. a single dollar sign) since for many use-cases the way Tor encodes nodes with "$hash=name" looks like a keyword argument (but it isn't). If you don't want this, override the "key_filter" argument to this method.
 
@@ -111,7 +120,76 @@ def find_keywords(args, key_filter=lambda x: not x.startswith("$")):
         a dict of key->value (both strings) of all name=value type
         keywords found in args.
     """
-    return dict(x.split('=', 1) for x in args if '=' in x and key_filter(x.split('=')[0]))
+
+    kw = {}
+    for x in args:
+        eq = x.find('=')
+        if eq == -1:
+            continue
+        key = x[:eq]
+        if key_filter is _not_router:
+            if key[:1] == '$':
+                continue
+        elif not key_filter(key):
+            continue
+        kw[key] = x[eq + 1:]
+    return kw
+
+
+_escapes = {'n': '\n', 't': '\t', 'r': '\r'}
+_escape_re = re.compile(r'\\([0-7]{1,3}|.)', re.DOTALL)
+_arg_re = re.compile(r'(?:[^\s"]+|"(?:[^"\\]|\\.)*"?)+', re.DOTALL)
+_quoted_re = re.compile(r'"((?:[^"\\]|\\.)*)"?', re.DOTALL)
+
+
+def _unescape(match):
+    c = match.group(1)
+    if c[0] in '01234567':
+        return chr(int(c, 8) & 0xff)
+    return _escapes.get(c, c)
+
+
+def unescape_quoted(data):
+    """
+    Decodes the backslash escapes (``\\"``, ``\\\\``, ``\\n``, octal
+    ``\\NNN`` and so on) of the inside of a control-spec QuotedString.
+    """
+
+    if '\\' not in data:
+        return data
+    return _escape_re.sub(_unescape, data)
+
+
+def _unquote_match(match):
+    return unescape_quoted(match.group(1))
+
+
+def split_args(data):
+    """
+    Splits the arguments of an event (or reply line) on whitespace,
+    like ``data.split()``, except that double-quoted strings -- whole
+    arguments, or the values of ``KEY="quoted value"`` arguments --
+    stay in one piece and have their quotes removed and escapes
+    decoded. This replaces ``shlex.split``, which is much slower and
+    doesn't know the control-spec's escapes.
+    """
+
+    if '"' not in data:
+        return data.split()
+    return [_quoted_re.sub(_unquote_match, arg) if '"' in arg else arg
+            for arg in _arg_re.findall(data)]
+
+
+def keyword_flags(kw):
+    """
+    A copy of the keywords dict with a lower-case version of every key
+    added too, as given to e.g. ``circuit_closed`` and
+    ``stream_failed`` listeners.
+    """
+
+    flags = dict(kw)
+    flags.update(zip([k.lower() for k in kw], kw.itervalues()))
+    return flags
 
 
 def delete_file_or_tree(*args):
@@ -183,6 +261,49 @@ def compare_via_hash(x, y):
             hmac_sha256(CRYPTOVARIABLE_EQUALITY_COMPARISON_NONCE, y))
 
 
+class LRUDict(OrderedDict):
+    """
+    A dict holding at most ``maxsize`` items: reading or setting an
+    item makes it the most-recently used, and setting one when full
+    throws out the least-recently used. Iterating (or ``items()``
+    etc.) and ``in`` don't count as use.
+    """
+
+    def __init__(self, maxsize):
+        OrderedDict.__init__(self)
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = OrderedDict.__getitem__(self, key)
+        OrderedDict.__delitem__(self, key)
+        OrderedDict.__setitem__(self, key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self:
+            OrderedDict.__delitem__(self, key)
+        OrderedDict.__setitem__(self, key, value)
+        while len(self) > self.maxsize:
+            OrderedDict.__delitem__(self, next(iter(self)))
+
+    ## OrderedDict builds these with self[key], which would reorder
+    ## the dict while iterating over it
+
+    def itervalues(self):
+        for key in self:
+            yield OrderedDict.__getitem__(self, key)
+
+    def iteritems(self):
+        for key in self:
+            yield (key, OrderedDict.__getitem__(self, key))
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+
 class NetLocation:
     """
     Represents the location of an IP address, either city or country
@@ -198,6 +319,10 @@ class NetLocation:
         self.city = None
         self.asn = None
 
+        with _geoip_lock:
+            self._lookup(ipaddr)
+
+    def _lookup(self, ipaddr):
         if city:
             r = city.record_by_addr(self.ip)
             if r is not None:
@@ -213,3 +338,16 @@ class NetLocation:
 
         if asn:
             self.asn = asn.org_by_addr(self.ip)
+
+
+## the GeoIP readers seek around in their files, so only one thread
+## uses them at a time (router.resolve_locations does its lookups on a
+## worker thread, while the reactor thread may be doing its own)
+_geoip_lock = threading.Lock()
+
+location_cache = LRUDict(10000)
+"""
+:class:`NetLocation` instances by IP address, shared by all the
+:class:`txtorcon.Router` instances (their ``location``). Bounded; set
+its ``maxsize`` to change how many it keeps.
+"""